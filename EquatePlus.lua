@@ -47,6 +47,56 @@ function split(inputstr, sep)
   return t
 end
 
+-- CSRF token patterns, anchored at the "csrf" they contain
+local CSRF_JSON = '^"csrfpId"%s*:%s*"([^"]+)"'
+local CSRF_REGISTER = '^csrfRegisterAjax%(%s*"csrfpId"%s*,%s*"([^"]+)"'
+local CSRF_LINKS = '^csrfModifyLinks%(%s*"csrfpId"%s*,%s*"([^"]+)"'
+local CSRF2_CONFIG = "^['\"]equateCsrfToken2['\"]%s*:%s*['\"]([^'\"]+)['\"]"
+local CSRF2_INPUT = "^name=['\"]EQUATE%-CSRF2%-TOKEN%-PARTICIPANT2['\"]%s+value=['\"]([^'\"]+)['\"]"
+
+-- Statements and other binary bodies never carry tokens but can be large.
+local function carriesCsrfTokens(url, mimeType)
+  if string.find(url, "/services/statements/download", 1, true) then
+    return false
+  end
+  if mimeType == nil or mimeType == "" then
+    return true
+  end
+  mimeType = string.lower(mimeType)
+  return string.find(mimeType, "^text/") ~= nil or
+    string.find(mimeType, "json", 1, true) ~= nil or
+    string.find(mimeType, "javascript", 1, true) ~= nil or
+    string.find(mimeType, "xml", 1, true) ~= nil
+end
+
+-- Returns the csrfpId and CSRF2 tokens that matching each pattern over the
+-- whole body in order of preference would find, in a single pass over the
+-- spellings of "csrf" in it.
+local function scanCsrfTokens(content)
+  local json, register, links, config, input
+  local position = string.find(content, "[cC][sS][rR][fF]")
+  while position and not (json and config) do
+    local word = string.sub(content, position, position + 3)
+    if word == "csrf" then
+      if json == nil and position > 1 then
+        json = string.match(content, CSRF_JSON, position - 1)
+      end
+      if register == nil then
+        register = string.match(content, CSRF_REGISTER, position)
+      end
+      if links == nil then
+        links = string.match(content, CSRF_LINKS, position)
+      end
+    elseif word == "Csrf" and config == nil and position > 7 then
+      config = string.match(content, CSRF2_CONFIG, position - 7)
+    elseif word == "CSRF" and input == nil and position > 13 then
+      input = string.match(content, CSRF2_INPUT, position - 13)
+    end
+    position = string.find(content, "[cC][sS][rR][fF]", position + 1)
+  end
+  return json or register or links, config or input
+end
+
 function connectWithCSRF(method, url, postContent, postContentType, headers)
   -- Normalize URL to selected datacenter host
   local function normalize(u)
@@ -68,6 +118,7 @@ function connectWithCSRF(method, url, postContent, postContentType, headers)
 
   local content
   local respHeaders
+  local requestUrl
 
   -- Support Request object from HTML:submit()
   if type(method) ~= 'string' then
@@ -100,6 +151,7 @@ function connectWithCSRF(method, url, postContent, postContentType, headers)
     if CSRF_TOKEN ~= nil then h['csrfpId']=CSRF_TOKEN else if debugging then print("without CSRF_TOKEN") end end
     if CSRF2_TOKEN ~= nil then h["EQUATE-CSRF2-TOKEN-PARTICIPANT2"]=CSRF2_TOKEN end
 
+    requestUrl = u
     content, charset, mimeType, filename, respHeaders = connection:request(m, u, body, ct, h)
   else
     -- Classic call signature
@@ -123,27 +175,18 @@ function connectWithCSRF(method, url, postContent, postContentType, headers)
     if method == 'POST' then
       if postContent == nil then postContent="" end
     end
+    requestUrl = url
     content, charset, mimeType, filename, respHeaders = connection:request(method, url, postContent, postContentType, headers)
   end
-  -- Try to extract CSRF token from JSON and HTML patterns
-  local csrfpIdTemp = string.match(content, '"csrfpId"%s*:%s*"([^"]+)"')
-  if csrfpIdTemp == nil or csrfpIdTemp == '' then
-    csrfpIdTemp = string.match(content, 'csrfRegisterAjax%(%s*"csrfpId"%s*,%s*"([^"]+)"')
-  end
-  if csrfpIdTemp == nil or csrfpIdTemp == '' then
-    csrfpIdTemp = string.match(content, 'csrfModifyLinks%(%s*"csrfpId"%s*,%s*"([^"]+)"')
-  end
-  if csrfpIdTemp ~= nil and csrfpIdTemp ~= '' then
-    CSRF_TOKEN=csrfpIdTemp
-  end
-  -- Try multiple patterns to extract CSRF2
-  local csrf2Temp
-  csrf2Temp = string.match(content, "['\"]equateCsrfToken2['\"]%s*:%s*['\"]([^'\"]+)['\"]")
-  if csrf2Temp == nil or csrf2Temp == '' then
-    csrf2Temp = string.match(content, "name=['\"]EQUATE%-CSRF2%-TOKEN%-PARTICIPANT2['\"]%s+value=['\"]([^'\"]+)['\"]")
-  end
-  if csrf2Temp ~= nil and csrf2Temp ~= '' then
-    CSRF2_TOKEN = csrf2Temp
+  -- Try to extract CSRF tokens from JSON and HTML bodies
+  if carriesCsrfTokens(requestUrl, mimeType) then
+    local csrfpIdTemp, csrf2Temp = scanCsrfTokens(content)
+    if csrfpIdTemp ~= nil then
+      CSRF_TOKEN=csrfpIdTemp
+    end
+    if csrf2Temp ~= nil then
+      CSRF2_TOKEN = csrf2Temp
+    end
   end
   if debugging then
     local headersToLog = {}
@@ -471,6 +514,130 @@ local function isLoginRedirect(content)
   )
 end
 
+-- Lot keys in lookup order, the first one present wins.
+local QUANTITY_KEYS = {"LOCKED_PERF_QTY", "LOCKED_QTY", "TOTAL_UNITS", "NET_UNITS", "AVAILABLE_UNITS", "UNITS", "AVAIL_QTY", "QUANTITY"}
+local PRICE_KEYS = {"PURCHASE_PRICE", "MARKET_PRICE", "COST_BASIS", "SELL_PURCHASE_PRICE"}
+local DATE_KEYS = {"TRANSACTION_DATE", "ALLOC_DATE"}
+local NAME_KEYS = {"VEHICLE_NAME", "SECURITY", "VEHICLE_DESCRIPTION", "VEHICLE"}
+
+local function firstAmount(lot, keys)
+  for i = 1, #keys do
+    local field = lot[keys[i]]
+    if field and field["amount"] then
+      return field
+    end
+  end
+end
+
+-- Adds one lot of a market to securities, merging lots of the same security
+-- when cummulate is set.
+local function parseLot(securities, lot, marketName, marketPrice, pendingShare, planNameFallback)
+  local field = firstAmount(lot, QUANTITY_KEYS)
+  local quantity = field and field["amount"] or 0
+
+  local purchasePrice = nil
+  local currencyOfPrice = nil
+  field = firstAmount(lot, PRICE_KEYS)
+  if field then
+    purchasePrice = field["amount"]
+    currencyOfPrice = field["unit"] and field["unit"]["code"] or nil
+  end
+
+  if purchasePrice == nil and quantity <= 0 then
+    return
+  end
+
+  local tradeTimestamp = nil
+  for i = 1, #DATE_KEYS do
+    field = lot[DATE_KEYS[i]]
+    if field and field["date"] then
+      -- Example: "2016-02-12T00:00:00.000"
+      local year, month, day = field["date"]:match("^(%d%d%d%d)%-(%d%d)%-(%d%d)")
+      tradeTimestamp=os.time({year=year,month=month,day=day})
+      break
+    end
+  end
+
+  local name = nil
+  for i = 1, #NAME_KEYS do
+    name = lot[NAME_KEYS[i]]
+    if name ~= nil then
+      break
+    end
+  end
+
+  local secName = name or planNameFallback or "EquatePlus Position"
+
+  -- Future feature for MoneyMoney (confirmed 2022-02-10 by MRH):
+  -- requires a property similar to "booked" for accounts
+  if pendingShare then
+    print("These shares are not tradable: " .. tostring(secName))
+  end
+
+  local security = {
+    -- String name: Security name
+    name=secName,
+
+    -- String isin: ISIN
+    -- String securityNumber: WKN
+    -- String market: Exchange
+    market=marketName,
+
+    -- String currency: Currency for nominal or nil for units
+    -- Number quantity: Nominal amount or units
+    quantity=quantity,
+
+    -- Number amount: Position value in account currency
+    -- Number originalCurrencyAmount: Position value in original currency
+    -- Number exchangeRate: FX rate
+
+    -- Number tradeTimestamp: Quote timestamp (POSIX)
+    tradeTimestamp=tradeTimestamp,
+
+    -- Number price: Current price
+    price=marketPrice,
+
+    -- String currencyOfPrice: Price currency (if different)
+    currencyOfPrice=currencyOfPrice,
+
+    -- Number purchasePrice: Purchase price
+    purchasePrice=purchasePrice,
+
+    -- String currencyOfPurchasePrice: Purchase price currency (if different)
+  }
+  if not cummulate then
+    table.insert(securities,security)
+    return
+  end
+  local known = securities[secName]
+  if known == nil then
+    if purchasePrice ~= nil then
+      security['sumPrice']=purchasePrice*quantity
+    end
+    securities[secName]=security
+    table.insert(securities,security)
+  else
+    known['quantity']=known['quantity']+quantity
+    if purchasePrice ~= nil and known['sumPrice'] ~= nil then
+      known['sumPrice']=known['sumPrice']+purchasePrice*quantity
+      known['purchasePrice']=known['sumPrice']/known['quantity']
+    else
+      known['sumPrice']=nil
+      known['purchasePrice']=nil
+    end
+  end
+end
+
+local function parseMarket(securities, market, planNameFallback)
+  local marketName=market["marketName"]
+  local marketPrice=market["marketPrice"]["amount"]
+  local pendingShare = (market["canTrade"] == false)
+  for k,v in pairs(market["entries"]) do
+    local status,err = pcall(parseLot, securities, v, marketName, marketPrice, pendingShare, planNameFallback)
+    bugReport(status,err,v)
+  end
+end
+
 function RefreshAccount (account, since)
   -- Try POST (preferred on some backends)
   local summaryContent = connectWithCSRF(
@@ -522,147 +689,7 @@ function RefreshAccount (account, since)
         for k,v in pairs(details["entries"]) do
           local status,err = pcall( function()
             for k,v in pairs(v["entries"]) do
-              local status,err = pcall( function()
-                local marketName=v["marketName"]
-                local marketPrice=v["marketPrice"]["amount"]
-                local pendingShare = (v["canTrade"] == false)
-                for k,v in pairs(v["entries"]) do
-                  local status,err = pcall( function()
-                    -- Support multiple quantity keys
-                    local quantityKeyList = nil
-                    quantityKeyList = {next = quantityKeyList, value = "QUANTITY"}
-                    quantityKeyList = {next = quantityKeyList, value = "AVAIL_QTY"}
-                    quantityKeyList = {next = quantityKeyList, value = "UNITS"}
-                    quantityKeyList = {next = quantityKeyList, value = "AVAILABLE_UNITS"}
-                    quantityKeyList = {next = quantityKeyList, value = "NET_UNITS"}
-                    quantityKeyList = {next = quantityKeyList, value = "TOTAL_UNITS"}
-                    quantityKeyList = {next = quantityKeyList, value = "LOCKED_QTY"}
-                    quantityKeyList = {next = quantityKeyList, value = "LOCKED_PERF_QTY"}
-
-                    local quantity = 0
-                    local quantityKey = quantityKeyList
-                    while quantityKey do
-                      if v[quantityKey.value] and v[quantityKey.value]["amount"] then
-                        quantity = v[quantityKey.value]["amount"]
-                        break
-                      end
-                      quantityKey = quantityKey.next
-                    end
-
-                    -- Support multiple price keys
-                    local purchasePrice = nil
-                    local currencyOfPrice = nil
-                    local priceKeyList = nil
-                    priceKeyList = {next = priceKeyList, value = "SELL_PURCHASE_PRICE"}
-                    priceKeyList = {next = priceKeyList, value = "COST_BASIS"}
-                    priceKeyList = {next = priceKeyList, value = "MARKET_PRICE"}
-                    priceKeyList = {next = priceKeyList, value = "PURCHASE_PRICE"}
-                    local priceKey = priceKeyList
-                    while priceKey do
-                      if v[priceKey.value] and v[priceKey.value]["amount"] then
-                        purchasePrice = v[priceKey.value]["amount"]
-                        currencyOfPrice = v[priceKey.value]["unit"] and v[priceKey.value]["unit"]["code"] or nil
-                        break
-                      end
-                      priceKey = priceKey.next
-                    end
-
-                    if purchasePrice ~= nil or quantity > 0 then
-                      -- Support multiple date keys
-                      local tradeTimestamp = nil
-                      local dateKeyList = nil
-                      dateKeyList = {next = dateKeyList, value = "ALLOC_DATE"}
-                      dateKeyList = {next = dateKeyList, value = "TRANSACTION_DATE"}
-                      local dateKey = dateKeyList
-                      while dateKey do
-                        if v[dateKey.value] and v[dateKey.value]["date"] then
-                          -- Example: "2016-02-12T00:00:00.000"
-                          local year, month, day = v[dateKey.value]["date"]:match("^(%d%d%d%d)%-(%d%d)%-(%d%d)")
-                          -- print(year .. "-" .. month .. "-" .. day)
-                          tradeTimestamp=os.time({year=year,month=month,day=day})
-                          break
-                        end
-                        dateKey = dateKey.next
-                      end
-
-                      -- Support multiple name keys
-                      local name = nil
-                      local nameKeyList = nil
-                      nameKeyList = {next = nameKeyList, value = "VEHICLE"}
-                      nameKeyList = {next = nameKeyList, value = "VEHICLE_DESCRIPTION"}
-                      nameKeyList = {next = nameKeyList, value = "SECURITY"}
-                      nameKeyList = {next = nameKeyList, value = "VEHICLE_NAME"}
-                      local nameKey = nameKeyList
-                      while nameKey and name == nil do
-                        name = v[nameKey.value]
-                        nameKey = nameKey.next
-                      end
-
-                      local secName = name or planNameFallback or "EquatePlus Position"
-
-                      -- Future feature for MoneyMoney (confirmed 2022-02-10 by MRH):
-                      -- requires a property similar to "booked" for accounts
-                      if pendingShare then
-                        print("These shares are not tradable: " .. tostring(secName))
-                      end
-
-                      local security = {
-                        -- String name: Security name
-                        name=secName,
-
-                        -- String isin: ISIN
-                        -- String securityNumber: WKN
-                        -- String market: Exchange
-                        market=marketName,
-
-                        -- String currency: Currency for nominal or nil for units
-                        -- Number quantity: Nominal amount or units
-                        quantity=quantity,
-
-                        -- Number amount: Position value in account currency
-                        -- Number originalCurrencyAmount: Position value in original currency
-                        -- Number exchangeRate: FX rate
-
-                        -- Number tradeTimestamp: Quote timestamp (POSIX)
-                        tradeTimestamp=tradeTimestamp,
-
-                        -- Number price: Current price
-                        price=marketPrice,
-
-                        -- String currencyOfPrice: Price currency (if different)
-                        currencyOfPrice=currencyOfPrice,
-
-                        -- Number purchasePrice: Purchase price
-                        purchasePrice=purchasePrice,
-
-                      -- String currencyOfPurchasePrice: Purchase price currency (if different)
-
-                      }
-                      if cummulate then
-                        if securities[secName] == nil then
-                          if security['purchasePrice'] ~= nil then
-                            security['sumPrice']=security['purchasePrice']*quantity
-                          end
-                          securities[secName]=security
-                          table.insert(securities,security)
-                        else
-                          securities[secName]['quantity']=securities[secName]['quantity']+quantity
-                          if security['purchasePrice'] ~= nil and securities[secName]['sumPrice'] ~= nil then
-                            securities[secName]['sumPrice']=securities[secName]['sumPrice']+security['purchasePrice']*quantity
-                            securities[secName]['purchasePrice']=securities[secName]['sumPrice']/securities[secName]['quantity']
-                          else
-                            securities[secName]['sumPrice']=nil
-                            securities[secName]['purchasePrice']=nil
-                          end
-                        end
-                      else
-                        table.insert(securities,security)
-                      end
-                    end
-                  end) --pcall
-                  bugReport(status,err,v)
-                end
-              end)--pcall
+              local status,err = pcall(parseMarket, securities, v, planNameFallback)
               bugReport(status,err,v)
             end
           end) --pcall
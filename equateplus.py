@@ -7,27 +7,92 @@ Please provide:
 Please act during verify_qr_code:
 - equateplus_qr.png: Scan QR code with EquateAccess app
 """
+import gzip
+import re
+import zlib
+import socket
+import socketserver
+import sqlite3
+from array import array
 from base64 import b64decode
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from contextlib import AbstractContextManager, contextmanager
+from dataclasses import asdict, dataclass, field
 from datetime import datetime
+from email.utils import parsedate_to_datetime
+from functools import wraps
+from hashlib import file_digest, sha256
+from io import BytesIO
+from json import JSONDecodeError, dumps, loads
+from os import O_CREAT, O_EXCL, O_WRONLY, link, umask, utime
+from os import open as os_open
 from pathlib import Path
-from pickle import dumps, loads
-from random import randint
-from time import sleep
+from queue import Empty, Queue
+from random import randint, uniform
+from shutil import copyfile, copyfileobj
+from threading import Event, Lock, Thread, get_ident
+from time import monotonic, perf_counter, sleep, time
+from typing import Callable, Iterable, Iterator, Mapping
+from urllib.parse import parse_qsl, urlencode, urlsplit
 
 import click
 import requests
 
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
-def debug(func):
-    def wrapper(*args, **kwargs):
-        print(func.__name__, end=" ", flush=True)
-        result = func(*args, **kwargs)
-        print("->", result)
-        sleep(0.5)
+try:
+    import pypdf
+except ImportError:
+    pypdf = None
+
+# Raised for planDetails bodies that are not the expected JSON
+PLAN_DETAILS_ERRORS: tuple[type[Exception], ...] = (
+    KeyError,
+    IndexError,
+    ValueError,
+) + ((ijson.JSONError,) if ijson is not None else ())
+
+
+def step(func):
+    # Traces and reports a login or fetch step, then applies optional pacing
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        start: float = perf_counter()
+        with self.tracer.step(func.__name__):
+            result = func(self, *args, **kwargs)
+        self.notify(
+            "step",
+            name=func.__name__,
+            result=result,
+            elapsed=perf_counter() - start,
+        )
+        if self.pace > 0:
+            sleep(self.pace)
         return result
     return wrapper
 
 
+def poll_delays(
+    initial: float = 0.5,
+    factor: float = 1.5,
+    maximum: float = 2.0,
+    jitter: float = 0.2,
+) -> Iterator[float]:
+    # Backoff from a fast first poll, randomized so clients do not align
+    delay: float = initial
+    while True:
+        yield delay * uniform(1 - jitter, 1 + jitter)
+        delay = min(delay * factor, maximum)
+
+
+def prompt_otp() -> str:
+    return click.prompt("Please enter the SMS code", hide_input=True)
+
+
 def random_digits(n):
     range_start = 10**(n-1)
     range_end = (10**n)-1
@@ -40,18 +105,1495 @@ def get_data(data: dict, keys: tuple[str, ...]) -> str:
             return data[key]
 
 
-def get_name(data: dict) -> str:
-    return get_data(data, ("VEHICLE", "VEHICLE_DESCRIPTION"))
+# Markers of the SMS one-time code page
+OTP_MARKERS: tuple[bytes, ...] = (
+    b'id="otpCodeId"',
+    b'class="otpCodeSms"',
+    b'Security Step Code',
+)
+QR_FINAL_STATUSES: tuple[str, ...] = (
+    "succeeded",
+    "failed_retry_please",
+    "failed",
+)
+
+
+# Token, pattern name, anchor and the value expected right after it.
+# Earlier patterns win for the same token.
+CSRF_PATTERNS: tuple[tuple[str, str, bytes, re.Pattern], ...] = (
+    (
+        "csrf",
+        "register_ajax",
+        b'csrfRegisterAjax("csrfpId", "',
+        re.compile(rb'([^"]*)"\)'),
+    ),
+    (
+        "csrf2",
+        "json_token2",
+        b',"equateCsrfToken2":"',
+        re.compile(rb'([^"]*)",'),
+    ),
+    (
+        "csrf2",
+        "hidden_input",
+        b'name="EQUATE-CSRF2-TOKEN-PARTICIPANT2" value="',
+        re.compile(rb'([^"]*)"'),
+    ),
+)
+
+
+def is_text_content(content_type: str | None) -> bool:
+    # Tokens only appear in HTML, JSON and script responses
+    if not content_type:
+        return True
+    media_type: str = content_type.split(";")[0].strip().lower()
+    return media_type.startswith("text/") or media_type.endswith(
+        ("json", "javascript", "xml")
+    )
+
+
+def extract_csrf(content: bytes) -> dict[str, tuple[str, str]]:
+    # Token name -> (value, name of the pattern that matched). Anchors are
+    # located with bytes.find, which beats a combined regex in CPython, and
+    # the value is matched in place without copying the body.
+    tokens: dict[str, tuple[str, str]] = {}
+    for token, name, anchor, value_pattern in CSRF_PATTERNS:
+        if token in tokens:
+            continue
+        start: int = content.find(anchor)
+        if start < 0:
+            continue
+        match = value_pattern.match(content, start + len(anchor))
+        if match is not None:
+            tokens[token] = (match.group(1).decode("utf-8"), name)
+    return tokens
+
+
+def parse_plan_summary(content: bytes) -> tuple[list[str], bool] | None:
+    # Plan ids and whether the summary has any plans, None if unparsable
+    try:
+        data = loads(content)
+        plan_ids: list[str] = [plan["id"] for plan in data.get("entries", [])]
+    except (ValueError, AttributeError):
+        return None
+    return plan_ids, not data.get("empty", False) and len(plan_ids) > 0
+
+
+# Lot fields by key priority, resolved once for all lots
+LOT_NAME_KEYS: tuple[str, ...] = ("VEHICLE", "VEHICLE_DESCRIPTION")
+LOT_QUANTITY_KEYS: tuple[str, ...] = (
+    "QUANTITY",
+    "AVAIL_QTY",
+    "LOCKED_QTY",
+    "LOCKED_PERF_QTY",
+)
+LOT_PRICE_KEYS: tuple[str, ...] = (
+    "PURCHASE_PRICE",
+    "MARKET_PRICE",
+    "COST_BASIS",
+    "SELL_PURCHASE_PRICE",
+)
+LOT_DATE_KEYS: tuple[str, ...] = ("TRANSACTION_DATE", "ALLOC_DATE")
+
+NAN: float = float("nan")
+
+
+class LotTable:
+    # One row per lot, stored column-wise. Names, plans and markets are
+    # stored once and referenced by code, missing prices are NaN and
+    # missing dates 0 (dates are proleptic ordinals).
+    __slots__ = (
+        "names",
+        "plans",
+        "markets",
+        "name",
+        "plan",
+        "market",
+        "quantity",
+        "purchase_price",
+        "market_price",
+        "date",
+    )
+
+    def __init__(self) -> None:
+        self.names: dict[str | None, int] = {}
+        self.plans: dict[str, int] = {}
+        self.markets: dict[str | None, int] = {}
+        self.name: array = array("I")
+        self.plan: array = array("I")
+        self.market: array = array("I")
+        self.quantity: array = array("d")
+        self.purchase_price: array = array("d")
+        self.market_price: array = array("d")
+        self.date: array = array("I")
+
+    def __len__(self) -> int:
+        return len(self.quantity)
+
+    def add_plan(self, plan_id: str, data: dict) -> None:
+        self.add_lots(plan_id, iter_plan_lots(data))
+
+    def add_lots(
+        self,
+        plan_id: str,
+        lots: Iterable[tuple[dict, dict]],
+    ) -> None:
+        # Fills the columns as lots arrive. A failing iterator leaves the
+        # rows added so far, so callers parse into a fresh table and
+        # extend the full one once the plan is complete.
+        names: dict[str | None, int] = self.names
+        plan: int = self.plans.setdefault(plan_id, len(self.plans))
+        start: int = len(self)
+        containers: list[dict] = []
+        container_index: array = array("I")
+        for container, lot in lots:
+            quantity = get_data(lot, LOT_QUANTITY_KEYS)
+            if quantity is None:
+                continue
+            price = get_data(lot, LOT_PRICE_KEYS) or {}
+            date = get_data(lot, LOT_DATE_KEYS) or {}
+            if not containers or containers[-1] is not container:
+                containers.append(container)
+            container_index.append(len(containers) - 1)
+            self.name.append(
+                names.setdefault(get_data(lot, LOT_NAME_KEYS), len(names))
+            )
+            self.quantity.append(quantity["amount"])
+            self.purchase_price.append(
+                NAN if price.get("amount") is None else price["amount"]
+            )
+            self.date.append(
+                datetime.fromisoformat(date["date"][:10]).toordinal()
+                if date.get("date")
+                else 0
+            )
+
+        # Market fields may follow the lots in a streamed container
+        markets: list[int] = [
+            self.markets.setdefault(
+                container.get("marketName"),
+                len(self.markets),
+            )
+            for container in containers
+        ]
+        prices: list[float] = [
+            (container.get("marketPrice") or {}).get("amount", NAN)
+            for container in containers
+        ]
+        self.plan.extend([plan] * (len(self.quantity) - start))
+        self.market.extend(markets[index] for index in container_index)
+        self.market_price.extend(prices[index] for index in container_index)
+
+    def extend(self, other: "LotTable") -> None:
+        names: list[int] = [
+            self.names.setdefault(name, len(self.names))
+            for name in other.names
+        ]
+        plans: list[int] = [
+            self.plans.setdefault(plan, len(self.plans))
+            for plan in other.plans
+        ]
+        markets: list[int] = [
+            self.markets.setdefault(market, len(self.markets))
+            for market in other.markets
+        ]
+        self.name.extend(names[code] for code in other.name)
+        self.plan.extend(plans[code] for code in other.plan)
+        self.market.extend(markets[code] for code in other.market)
+        self.quantity.extend(other.quantity)
+        self.purchase_price.extend(other.purchase_price)
+        self.market_price.extend(other.market_price)
+        self.date.extend(other.date)
+
+    def quantities(self) -> dict[str | None, float]:
+        totals: list[float] = [0.0] * len(self.names)
+        for name, quantity in zip(self.name, self.quantity):
+            totals[name] += quantity
+        return dict(zip(self.names, totals))
+
+    def average_purchase_prices(self) -> dict[str | None, float]:
+        # Weighted by quantity, over the lots with a purchase price
+        costs: list[float] = [0.0] * len(self.names)
+        quantities: list[float] = [0.0] * len(self.names)
+        for name, quantity, price in zip(
+            self.name,
+            self.quantity,
+            self.purchase_price,
+        ):
+            if price == price:
+                costs[name] += quantity * price
+                quantities[name] += quantity
+        return {
+            name: cost / quantity
+            for name, cost, quantity in zip(self.names, costs, quantities)
+            if quantity
+        }
+
+    def values_by_plan(self) -> dict[str, float]:
+        values: list[float] = [0.0] * len(self.plans)
+        for plan, quantity, price in zip(
+            self.plan,
+            self.quantity,
+            self.market_price,
+        ):
+            if price == price:
+                values[plan] += quantity * price
+        return dict(zip(self.plans, values))
+
+    def rows(self) -> Iterator[dict]:
+        names: list[str | None] = list(self.names)
+        plans: list[str] = list(self.plans)
+        markets: list[str | None] = list(self.markets)
+        for index in range(len(self)):
+            purchase_price: float = self.purchase_price[index]
+            market_price: float = self.market_price[index]
+            date: int = self.date[index]
+            yield {
+                "name": names[self.name[index]],
+                "plan": plans[self.plan[index]],
+                "market": markets[self.market[index]],
+                "quantity": self.quantity[index],
+                "purchase_price": (
+                    None if purchase_price != purchase_price
+                    else purchase_price
+                ),
+                "market_price": (
+                    None if market_price != market_price else market_price
+                ),
+                "date": (
+                    datetime.fromordinal(date).date().isoformat()
+                    if date
+                    else None
+                ),
+            }
+
+
+def iter_plan_lots(data: dict) -> Iterator[tuple[dict, dict]]:
+    for plan_groups in data["entries"]:
+        for plan_details in plan_groups["entries"]:
+            for lot in plan_details["entries"]:
+                yield plan_details, lot
+
+
+# ijson prefixes of a planDetails response
+CONTAINER_PREFIX: str = "entries.item.entries.item"
+LOT_PREFIX: str = CONTAINER_PREFIX + ".entries.item"
+CONTAINER_FIELDS: dict[str, tuple[str, ...]] = {
+    CONTAINER_PREFIX + ".marketName": ("marketName",),
+    CONTAINER_PREFIX + ".marketPrice.amount": ("marketPrice", "amount"),
+}
+
+
+def stream_plan_lots(chunks: Iterable[bytes]) -> Iterator[tuple[dict, dict]]:
+    # Only the current lot is built as objects, containers keep just the
+    # market fields
+    events = ijson.sendable_list()
+    parser = ijson.parse_coro(events, use_float=True)
+    container: dict = {}
+    lot = None
+    has_entries: bool = False
+    for chunk in chunks:
+        parser.send(chunk)
+        for prefix, event, value in events:
+            if lot is not None:
+                if prefix == LOT_PREFIX and event == "end_map":
+                    yield container, lot.value
+                    lot = None
+                else:
+                    lot.event(event, value)
+            elif prefix == LOT_PREFIX and event == "start_map":
+                lot = ijson.ObjectBuilder()
+                lot.event(event, value)
+            elif prefix == CONTAINER_PREFIX and event == "start_map":
+                container = {}
+            elif prefix in CONTAINER_FIELDS:
+                *path, field = CONTAINER_FIELDS[prefix]
+                target: dict = container
+                for key in path:
+                    target = target.setdefault(key, {})
+                target[field] = value
+            elif prefix == "entries" and event == "start_array":
+                has_entries = True
+        del events[:]
+    parser.close()
+    if not has_entries:
+        raise KeyError("entries")
+
+
+def plan_lots(chunks: Iterable[bytes]) -> Iterator[tuple[dict, dict]]:
+    if ijson is None:
+        return iter_plan_lots(loads(b"".join(chunks)))
+    return stream_plan_lots(chunks)
+
+
+def slices(content: bytes, size: int = 16 * 1024) -> Iterator[bytes]:
+    view = memoryview(content)
+    for start in range(0, len(view), size):
+        yield bytes(view[start:start + size])
 
 
-def get_amount(data: dict) -> float:
-    quantity = get_data(
-        data,
-        ("QUANTITY", "AVAIL_QTY", "LOCKED_QTY", "LOCKED_PERF_QTY"),
+def is_login_redirect(content: bytes) -> bool:
+    return any(
+        marker in content
+        for marker in (
+            b"eqp-login-application",
+            b'id="loginForm"',
+            b'id="eqUserId"',
+        )
+    )
+
+
+# Start of the JSON body sent instead of a document that failed
+TECHNICAL_ERROR: bytes = b"{\"$type\":\"TechnicalError\""
+# Downloads are streamed to disk in chunks of this many bytes
+DOWNLOAD_CHUNK_SIZE: int = 64 * 1024
+
+
+def is_technical_error(content: bytes) -> bool:
+    return content.startswith(TECHNICAL_ERROR)
+
+
+def resumes(status: int, content_range: str | None, offset: int) -> bool:
+    # Whether a download answer continues a part of offset bytes
+    return (
+        offset > 0
+        and status == 206
+        and (content_range or "").startswith(f"bytes {offset}-")
     )
-    if quantity is None:
+
+
+def download_validator(headers: Mapping[str, str]) -> str | None:
+    # Strong ETag or Last-Modified of a download, sent back as If-Range
+    # so a part is only resumed from the same version of the document
+    etag: str | None = headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
+
+def part_paths(file_path: Path) -> tuple[Path, Path]:
+    # The .part file a download streams into and its validator
+    part_path: Path = file_path.with_name(file_path.name + ".part")
+    return part_path, part_path.with_name(part_path.name + ".validator")
+
+
+def resume_offset(part_path: Path, validator_path: Path) -> tuple[int, str]:
+    # Bytes of the part that can be resumed, 0 without a validator
+    try:
+        return part_path.stat().st_size, validator_path.read_text()
+    except OSError:
+        return 0, ""
+
+
+def discard_part(part_path: Path, validator_path: Path) -> None:
+    part_path.unlink(missing_ok=True)
+    validator_path.unlink(missing_ok=True)
+
+
+def start_part(
+    part_path: Path,
+    validator_path: Path,
+    headers: Mapping[str, str],
+) -> None:
+    # Records the version a new part is downloaded from
+    part_path.parent.mkdir(parents=True, exist_ok=True)
+    validator: str | None = download_validator(headers)
+    if validator:
+        validator_path.write_text(validator)
+    else:
+        validator_path.unlink(missing_ok=True)
+
+
+# Without pypdf, text is taken from the literal strings that the text
+# objects of uncompressed or Flate compressed content streams show
+PDF_STREAM = re.compile(rb"stream\r?\n(.*?)\r?\nendstream", re.DOTALL)
+PDF_TEXT_OBJECT = re.compile(rb"\bBT\b(.*?)\bET\b", re.DOTALL)
+PDF_STRING = re.compile(rb"\(((?:\\.|[^\\)])*)\)", re.DOTALL)
+PDF_ESCAPE = re.compile(rb"\\([0-7]{1,3}|.)", re.DOTALL)
+PDF_ESCAPES: dict[bytes, bytes] = {
+    b"n": b"\n",
+    b"r": b"\r",
+    b"t": b"\t",
+    b"b": b"\b",
+    b"f": b"\f",
+}
+
+
+def unescape_pdf_string(match: re.Match) -> bytes:
+    value: bytes = match.group(1)
+    if value.isdigit():
+        return bytes((int(value, 8) & 0xFF,))
+    return PDF_ESCAPES.get(value, value)
+
+
+def pdf_text(content: bytes) -> str:
+    if pypdf is not None:
+        try:
+            reader = pypdf.PdfReader(BytesIO(content))
+            return "\n".join(
+                page.extract_text() or "" for page in reader.pages
+            )
+        except (pypdf.errors.PyPdfError, ValueError):
+            return ""
+    lines: list[str] = []
+    for stream in PDF_STREAM.findall(content):
+        try:
+            stream = zlib.decompress(stream)
+        except zlib.error:
+            pass
+        for text_object in PDF_TEXT_OBJECT.findall(stream):
+            lines.append(" ".join(
+                PDF_ESCAPE.sub(unescape_pdf_string, string).decode("latin-1")
+                for string in PDF_STRING.findall(text_object)
+            ))
+    return "\n".join(lines)
+
+
+def document_file_name(document: dict) -> str:
+    date: str = datetime.fromisoformat(document["date"]).strftime("%d.%m.%Y")
+    file_name: str = document["description"] + f" ({date}).pdf"
+    return file_name.replace("/", "-")
+
+
+def document_file_names(documents: list[dict]) -> dict[str, str]:
+    # Documents sharing description and date get their id in the name
+    names: dict[str, str] = {
+        document["id"]: document_file_name(document) for document in documents
+    }
+    counts: Counter = Counter(names.values())
+    return {
+        document_id: (
+            name
+            if counts[name] == 1
+            else name[:-len(".pdf")] + f" [{document_id}].pdf"
+        )
+        for document_id, name in names.items()
+    }
+
+
+def load_manifest(documents_dir: Path) -> dict[str, dict]:
+    try:
+        return loads((documents_dir / "manifest.json").read_text())
+    except (OSError, JSONDecodeError):
+        return {}
+
+
+def save_manifest(documents_dir: Path, manifest: dict[str, dict]) -> None:
+    documents_dir.mkdir(parents=True, exist_ok=True)
+    temp_path: Path = documents_dir / "manifest.tmp"
+    temp_path.write_text(dumps(manifest, indent=1, sort_keys=True))
+    temp_path.replace(documents_dir / "manifest.json")
+
+
+def load_state(state_path: Path | None) -> dict:
+    if state_path is None:
+        return {}
+    try:
+        return loads(state_path.read_text())
+    except (OSError, JSONDecodeError):
+        return {}
+
+
+def save_state(state_path: Path | None, state: dict) -> None:
+    if state_path is None:
+        return
+    state_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path: Path = state_path.with_suffix(f".{get_ident()}.tmp")
+    temp_path.write_text(dumps(state, indent=1, sort_keys=True))
+    temp_path.replace(state_path)
+
+
+def is_synced(
+    entry: dict | None,
+    document: dict,
+    file_path: Path,
+    store: "DocumentStore",
+) -> bool:
+    # Known document whose content and name are still complete on disk
+    if entry is None or entry.get("date") != document["date"]:
+        return False
+    if entry.get("file") != file_path.name or "sha256" not in entry:
+        return False
+    return store.contains(entry["sha256"], entry.get("size")) and (
+        store.compress or store.is_linked(entry["sha256"], file_path)
+    )
+
+
+def keep_chunks(chunks: Iterable[bytes], kept: list[bytes]) -> Iterator[bytes]:
+    for chunk in chunks:
+        kept.append(chunk)
+        yield chunk
+
+
+# Statements are downloaded below the working directory
+DOCUMENTS_DIR: Path = Path("documents")
+
+
+# Participant datacenters, as tried by EquatePlus.lua
+HOST_CANDIDATES: tuple[str, ...] = (
+    "https://www.equateplus.com",
+    "https://www.emea.equateplus.com",
+    "https://www.na.equateplus.com",
+    "https://participant.tst.equateplus.com",
+)
+# Answers of a datacenter that is down or in maintenance
+OUTAGE_STATUSES: frozenset[int] = frozenset((502, 503, 504))
+
+
+def probe_host(
+    session: requests.Session,
+    host: str,
+    timeout: float,
+) -> float | None:
+    # Seconds until the login page loaded, None for an unhealthy host
+    start: float = perf_counter()
+    try:
+        response: requests.Response = session.get(
+            f"{host}/EquatePlusParticipant2/?login",
+            timeout=timeout,
+        )
+    except requests.RequestException:
         return None
-    return quantity["amount"]
+    if (
+        response.status_code in OUTAGE_STATUSES
+        or b"isiwebuserid" not in response.content
+    ):
+        return None
+    return perf_counter() - start
+
+
+def probe_hosts(
+    session: requests.Session,
+    hosts: list[str],
+    timeout: float,
+) -> list[str]:
+    # Healthy hosts, fastest first
+    if not hosts:
+        return []
+    with ThreadPoolExecutor(max_workers=len(hosts)) as pool:
+        latencies: list[float | None] = list(
+            pool.map(lambda host: probe_host(session, host, timeout), hosts)
+        )
+    return [
+        host
+        for latency, host in sorted(
+            (latency, host)
+            for host, latency in zip(hosts, latencies)
+            if latency is not None
+        )
+    ]
+
+
+# Answers worth retrying: rate limited, or a transient server failure
+RETRY_STATUSES: frozenset[int] = frozenset((429, 500, 502, 503, 504))
+IDEMPOTENT_METHODS: frozenset[str] = frozenset(
+    ("GET", "HEAD", "OPTIONS", "PUT", "DELETE")
+)
+
+
+def retry_after(response: requests.Response) -> float | None:
+    # Seconds from a Retry-After header, given as seconds or HTTP date
+    value: str | None = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    # Allows rate requests per second on average and burst at once
+    def __init__(self, rate: float, burst: int) -> None:
+        self.rate: float = rate
+        self.burst: int = burst
+        self.tokens: float = float(burst)
+        self.updated: float = monotonic()
+        # Set by Retry-After, no token is handed out before it
+        self.blocked_until: float = 0.0
+        self.lock: Lock = Lock()
+
+    def reserve(self) -> float:
+        # Takes a token and returns how long to wait before using it
+        with self.lock:
+            now: float = monotonic()
+            self.tokens = min(
+                float(self.burst),
+                self.tokens + (now - self.updated) * self.rate,
+            )
+            self.updated = now
+            self.tokens -= 1.0
+            wait: float = max(0.0, -self.tokens / self.rate)
+            return max(wait, self.blocked_until - now)
+
+    def block(self, seconds: float) -> None:
+        with self.lock:
+            self.blocked_until = max(
+                self.blocked_until,
+                monotonic() + seconds,
+            )
+
+
+class RequestScheduler:
+    # Paces requests with a token bucket per host and retries transient
+    # failures with exponential backoff and jitter. May be shared by the
+    # clients of a batch, so all accounts count against the same limits.
+    def __init__(
+        self,
+        rate: float = 10.0,
+        burst: int = 10,
+        retries: int = 3,
+        backoff: float = 0.5,
+        max_wait: float = 60.0,
+    ) -> None:
+        self.rate: float = rate
+        self.burst: int = burst
+        self.retries: int = retries
+        self.backoff: float = backoff
+        # Longest single wait, a longer Retry-After is not waited for
+        self.max_wait: float = max_wait
+        self.buckets: dict[str, TokenBucket] = {}
+        # Requests waiting for a token now, and at most so far
+        self.queue_depth: int = 0
+        self.max_queue_depth: int = 0
+        self.throttled: int = 0
+        self.retried: int = 0
+        self.rate_limited: int = 0
+        self.lock: Lock = Lock()
+
+    def bucket(self, host: str) -> TokenBucket:
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.burst)
+            return self.buckets[host]
+
+    def acquire(self, host: str, tracer: "Tracer | None" = None) -> None:
+        wait: float = self.bucket(host).reserve()
+        if wait <= 0:
+            return
+        with self.lock:
+            self.throttled += 1
+            self.queue_depth += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+            depth: int = self.max_queue_depth
+        if tracer is not None:
+            tracer.count("throttled")
+            tracer.gauges["max_queue_depth"] = depth
+        try:
+            sleep(wait)
+        finally:
+            with self.lock:
+                self.queue_depth -= 1
+
+    def delay(self, attempt: int) -> float:
+        # Half the exponential backoff is fixed, half random
+        backoff: float = min(self.max_wait, self.backoff * 2 ** attempt)
+        return backoff / 2 + uniform(0, backoff / 2)
+
+    def send(
+        self,
+        session: requests.Session,
+        method: str,
+        url: str,
+        idempotent: bool | None = None,
+        retry: bool = True,
+        tracer: "Tracer | None" = None,
+        **kwargs,
+    ) -> requests.Response:
+        # 429 answers were not processed and are always retried, failed
+        # connections and 5xx answers only for idempotent requests
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        host: str = urlsplit(url).netloc
+        retries: int = self.retries if retry else 0
+        attempt: int = 0
+        while True:
+            self.acquire(host, tracer)
+            try:
+                response: requests.Response = session.request(
+                    method,
+                    url,
+                    **kwargs,
+                )
+            except (requests.ConnectionError, requests.Timeout):
+                if not idempotent or attempt == retries:
+                    raise
+                wait: float = self.delay(attempt)
+            else:
+                status: int = response.status_code
+                if status == 429:
+                    with self.lock:
+                        self.rate_limited += 1
+                    if tracer is not None:
+                        tracer.count("rate_limited")
+                if (
+                    status not in RETRY_STATUSES
+                    or attempt == retries
+                    or (status != 429 and not idempotent)
+                ):
+                    return response
+                wait = self.delay(attempt)
+                server_wait: float | None = retry_after(response)
+                if server_wait is not None:
+                    if server_wait > self.max_wait:
+                        return response
+                    # Every request to the host has to wait, not just this
+                    self.bucket(host).block(server_wait)
+                    wait = max(wait, server_wait)
+                response.close()
+            with self.lock:
+                self.retried += 1
+            if tracer is not None:
+                tracer.count("retries")
+            sleep(wait)
+            attempt += 1
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            return {
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "throttled": self.throttled,
+                "retried": self.retried,
+                "rate_limited": self.rate_limited,
+            }
+
+
+def endpoint(url: str) -> str:
+    parts = urlsplit(url)
+    if parts.query == "login" or parts.query.startswith("login&"):
+        return parts.path + "?login"
+    return parts.path
+
+
+@dataclass
+class Span:
+    step: str | None
+    method: str
+    endpoint: str
+    status: int
+    bytes: int
+    elapsed: float
+    started: float
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self.spans: list[Span] = []
+        # Step name and duration in completion order
+        self.steps: list[tuple[str, float]] = []
+        self.gauges: dict[str, float] = {}
+        self.counters: dict[str, int] = {}
+        self.current_step: str | None = None
+        self.lock: Lock = Lock()
+
+    @contextmanager
+    def step(self, name: str) -> Iterator[None]:
+        parent: str | None = self.current_step
+        self.current_step = name
+        start: float = perf_counter()
+        try:
+            yield
+        finally:
+            self.current_step = parent
+            with self.lock:
+                self.steps.append((name, perf_counter() - start))
+
+    def count(self, name: str) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + 1
+
+    def record(
+        self,
+        response: requests.Response,
+        stream: bool = False,
+        **_kwargs,
+    ) -> None:
+        size: str | None = response.headers.get("Content-Length")
+        if size is not None:
+            size_bytes: int = int(size)
+        else:
+            # Streamed bodies are left unread for the caller
+            size_bytes = 0 if stream else len(response.content)
+        elapsed: float = response.elapsed.total_seconds()
+        span = Span(
+            step=self.current_step,
+            method=response.request.method,
+            endpoint=endpoint(response.url),
+            status=response.status_code,
+            bytes=size_bytes,
+            elapsed=elapsed,
+            started=time() - elapsed,
+        )
+        with self.lock:
+            self.spans.append(span)
+
+    def to_json(self) -> str:
+        return dumps(
+            {
+                "steps": [
+                    {"step": name, "elapsed": elapsed}
+                    for name, elapsed in self.steps
+                ],
+                "spans": [asdict(span) for span in self.spans],
+                "gauges": self.gauges,
+                "counters": self.counters,
+            },
+            indent=1,
+        )
+
+    def to_prometheus(self) -> str:
+        requests_total: dict[tuple, list[float]] = {}
+        for span in self.spans:
+            key = (span.step or "", span.method, span.endpoint, span.status)
+            totals = requests_total.setdefault(key, [0, 0.0, 0])
+            totals[0] += 1
+            totals[1] += span.elapsed
+            totals[2] += span.bytes
+
+        lines: list[str] = []
+        for index, (metric, kind) in enumerate((
+            ("equateplus_requests_total", "counter"),
+            ("equateplus_request_seconds_total", "counter"),
+            ("equateplus_response_bytes_total", "counter"),
+        )):
+            lines.append(f"# TYPE {metric} {kind}")
+            for (step_name, method, path, status), totals in (
+                requests_total.items()
+            ):
+                labels = (
+                    f'step="{step_name}",method="{method}",'
+                    f'endpoint="{path}",status="{status}"'
+                )
+                lines.append(f"{metric}{{{labels}}} {totals[index]}")
+
+        step_seconds: dict[str, float] = {}
+        for name, elapsed in self.steps:
+            step_seconds[name] = step_seconds.get(name, 0.0) + elapsed
+        lines.append("# TYPE equateplus_step_seconds_total counter")
+        for name, elapsed in step_seconds.items():
+            lines.append(
+                f'equateplus_step_seconds_total{{step="{name}"}} {elapsed}'
+            )
+        for name, value in sorted(self.gauges.items()):
+            lines.append(f"# TYPE equateplus_{name} gauge")
+            lines.append(f"equateplus_{name} {value}")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE equateplus_{name}_total counter")
+            lines.append(f"equateplus_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, path: Path) -> None:
+        if path.suffix == ".prom":
+            path.write_text(self.to_prometheus())
+        else:
+            path.write_text(self.to_json())
+
+
+# Query parameters and form fields that differ between runs or are secret
+VOLATILE_PARAMS: frozenset[str] = frozenset({"_rId", "_cId", "csrfpId"})
+SECRET_FIELDS: frozenset[str] = frozenset({
+    "isiwebuserid",
+    "isiwebpasswd",
+    "otpCode",
+})
+
+
+def interaction_key(method: str, url: str, body: bytes | str | None) -> str:
+    # Identifies a request independent of ids, tokens and credentials
+    parts = urlsplit(url)
+    query: list[tuple[str, str]] = sorted(
+        (name, value)
+        for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if name not in VOLATILE_PARAMS
+    )
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", "replace")
+    body_key: str = ""
+    if body:
+        try:
+            body_key = dumps(loads(body), sort_keys=True)
+        except ValueError:
+            fields: list[tuple[str, str]] = [
+                (name, value)
+                for name, value in parse_qsl(body, keep_blank_values=True)
+                if name not in VOLATILE_PARAMS
+            ]
+            body_key = urlencode(sorted(
+                (name, "*") if name in SECRET_FIELDS and value != "null"
+                else (name, value)
+                for name, value in fields
+            ))
+    return f"{method} {parts.path}?{urlencode(query)} {body_key}"
+
+
+class Cassette:
+    # Request/response pairs recorded from a session. Interactions are
+    # kept in cassette.json, binary bodies in bodies/<sha256>.
+    def __init__(self, directory: Path) -> None:
+        self.directory: Path = directory
+        self.interactions: list[dict] = []
+        self.lock: Lock = Lock()
+
+    @classmethod
+    def load(cls, directory: Path) -> "Cassette":
+        cassette = cls(directory)
+        cassette.interactions = loads(
+            (directory / "cassette.json").read_text()
+        )["interactions"]
+        return cassette
+
+    def save(self) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        (self.directory / "cassette.json").write_text(
+            dumps({"version": 1, "interactions": self.interactions}, indent=1)
+        )
+
+    def record(self, response: requests.Response, **_kwargs) -> None:
+        content: bytes = response.content
+        interaction: dict = {
+            "key": interaction_key(
+                response.request.method,
+                response.request.url,
+                response.request.body,
+            ),
+            "status": response.status_code,
+            "content_type": response.headers.get("Content-Type"),
+            "text": None,
+            "sha256": None,
+        }
+        if is_text_content(interaction["content_type"]):
+            text: str = content.decode("utf-8", "replace")
+            for value, _ in extract_csrf(content).values():
+                text = text.replace(value, "REDACTED")
+            interaction["text"] = text
+        else:
+            digest: str = sha256(content).hexdigest()
+            body_path: Path = self.directory / "bodies" / digest
+            if not body_path.exists():
+                body_path.parent.mkdir(parents=True, exist_ok=True)
+                body_path.write_bytes(content)
+            interaction["sha256"] = digest
+        with self.lock:
+            self.interactions.append(interaction)
+
+    def mount(self, session: requests.Session) -> None:
+        adapter = ReplayAdapter(self)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+
+
+class ReplayAdapter(requests.adapters.BaseAdapter):
+    # Serves recorded responses in order, repeating the last one per key
+    def __init__(self, cassette: Cassette) -> None:
+        super().__init__()
+        self.cassette: Cassette = cassette
+        self.lock: Lock = Lock()
+        self.queues: dict[str, list[dict]] = {}
+        for interaction in cassette.interactions:
+            self.queues.setdefault(interaction["key"], []).append(interaction)
+
+    def send(
+        self,
+        request: requests.PreparedRequest,
+        stream: bool = False,
+        **_kwargs,
+    ) -> requests.Response:
+        key: str = interaction_key(request.method, request.url, request.body)
+        with self.lock:
+            queue: list[dict] | None = self.queues.get(key)
+            if not queue:
+                raise requests.ConnectionError(f"not recorded: {key}")
+            interaction: dict = queue.pop(0) if len(queue) > 1 else queue[0]
+
+        if interaction["text"] is not None:
+            content: bytes = interaction["text"].encode("utf-8")
+        else:
+            content = (
+                self.cassette.directory / "bodies" / interaction["sha256"]
+            ).read_bytes()
+        response = requests.Response()
+        response.status_code = interaction["status"]
+        response.reason = "Replayed"
+        response.url = request.url
+        response.request = request
+        response.raw = BytesIO(content)
+        response.headers["Content-Length"] = str(len(content))
+        if interaction["content_type"] is not None:
+            response.headers["Content-Type"] = interaction["content_type"]
+        response.encoding = requests.utils.get_encoding_from_headers(
+            response.headers
+        )
+        return response
+
+    def close(self) -> None:
+        pass
+
+
+class ResponseCache:
+    # Response bodies on disk, expired after ttl seconds and evicted least
+    # recently used first beyond max_entries
+    def __init__(
+        self,
+        directory: Path,
+        ttl: float = 3600.0,
+        max_entries: int = 256,
+    ) -> None:
+        self.directory: Path = directory
+        self.ttl: float = ttl
+        self.max_entries: int = max_entries
+        self.hits: int = 0
+        self.misses: int = 0
+        self.lock: Lock = Lock()
+
+    def path(self, key: str) -> Path:
+        return self.directory / sha256(key.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> bytes | None:
+        path: Path = self.path(key)
+        try:
+            modified: float = path.stat().st_mtime
+            if time() - modified <= self.ttl:
+                content: bytes | None = path.read_bytes()
+                # Access time drives eviction, write time drives expiry
+                utime(path, (time(), modified))
+            else:
+                content = None
+        except OSError:
+            content = None
+        with self.lock:
+            if content is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return content
+
+    def put(self, key: str, content: bytes) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path: Path = self.path(key)
+        temp_path: Path = path.with_suffix(f".{get_ident()}.tmp")
+        temp_path.write_bytes(content)
+        temp_path.replace(path)
+        with self.lock:
+            self.evict()
+
+    def evict(self) -> None:
+        entries: list[Path] = [
+            path for path in self.directory.iterdir() if not path.suffix
+        ]
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort(key=lambda path: path.stat().st_atime)
+        for path in entries[:len(entries) - self.max_entries]:
+            path.unlink(missing_ok=True)
+
+
+class DocumentStore:
+    # Documents stored once per content under .objects, named by their
+    # sha256 and optionally gzip compressed. Readable names are hardlinks
+    # to uncompressed objects, compressed ones are only in the manifest.
+    def __init__(self, directory: Path, compress: bool = False) -> None:
+        self.directory: Path = directory
+        self.objects: Path = directory / ".objects"
+        self.compress: bool = compress
+        self.written: int = 0
+        self.deduplicated: int = 0
+        self.lock: Lock = Lock()
+
+    def incoming(self, name: str) -> Path:
+        # Download target, moved into the store by add
+        path: Path = self.objects / "incoming" / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def find(self, digest: str) -> Path | None:
+        for path in (self.objects / digest, self.objects / f"{digest}.gz"):
+            if path.is_file():
+                return path
+        return None
+
+    def contains(self, digest: str, size: int | None) -> bool:
+        path: Path | None = self.find(digest)
+        # Compressed sizes differ, and compressed objects have no
+        # hardlinks to be truncated through
+        return path is not None and (
+            path.suffix == ".gz" or path.stat().st_size == size
+        )
+
+    def is_linked(self, digest: str, file_path: Path) -> bool:
+        path: Path | None = self.find(digest)
+        try:
+            return path is not None and file_path.samefile(path)
+        except OSError:
+            return False
+
+    def add(self, path: Path) -> str:
+        # Moves path into the store, or drops it when the content is known
+        with path.open("rb") as file:
+            digest: str = file_digest(file, "sha256").hexdigest()
+        size: int = path.stat().st_size
+        with self.lock:
+            if self.contains(digest, size):
+                path.unlink()
+                self.deduplicated += 1
+                return digest
+            target: Path = self.objects / (
+                f"{digest}.gz" if self.compress else digest
+            )
+            if self.compress:
+                temp_path: Path = target.with_suffix(f".{get_ident()}.tmp")
+                with path.open("rb") as source:
+                    with gzip.open(temp_path, "wb") as sink:
+                        copyfileobj(source, sink)
+                temp_path.replace(target)
+                path.unlink()
+            else:
+                path.replace(target)
+            self.written += 1
+        return digest
+
+    def link(self, digest: str, file_path: Path) -> None:
+        # Points the readable name at the object, unless it already does
+        path: Path | None = self.find(digest)
+        if path is None or path.suffix == ".gz":
+            return
+        if self.is_linked(digest, file_path):
+            return
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path: Path = file_path.with_name(
+            f".{file_path.name}.{get_ident()}.tmp"
+        )
+        try:
+            link(path, temp_path)
+        except OSError:
+            # File systems without hardlinks get a copy
+            copyfile(path, temp_path)
+        temp_path.replace(file_path)
+
+    def open(self, digest: str):
+        path: Path | None = self.find(digest)
+        if path is None:
+            raise FileNotFoundError(digest)
+        return gzip.open(path, "rb") if path.suffix == ".gz" else path.open("rb")
+
+    def verify(self) -> list[str]:
+        # Digests of objects whose content no longer matches their name
+        corrupt: list[str] = []
+        if not self.objects.is_dir():
+            return corrupt
+        for path in sorted(self.objects.iterdir()):
+            if not path.is_file() or path.suffix not in ("", ".gz"):
+                continue
+            digest: str = path.name.removesuffix(".gz")
+            try:
+                with self.open(digest) as file:
+                    ok: bool = file_digest(file, "sha256").hexdigest() == digest
+            except (OSError, EOFError):
+                ok = False
+            if not ok:
+                corrupt.append(digest)
+        return corrupt
+
+
+@contextmanager
+def sqlite_connection(
+    path: Path,
+    write: bool = False,
+) -> Iterator[sqlite3.Connection]:
+    db = sqlite3.connect(path, timeout=30.0, isolation_level=None)
+    try:
+        if write:
+            # Concurrent batch workers must not both append
+            db.execute("BEGIN IMMEDIATE")
+        yield db
+        if write:
+            db.execute("COMMIT")
+    except BaseException:
+        if db.in_transaction:
+            db.execute("ROLLBACK")
+        raise
+    finally:
+        db.close()
+
+
+class SnapshotStore:
+    # Append-only position history in SQLite. A run whose positions equal
+    # the latest snapshot of the account only moves its checked time.
+    SCHEMA: str = """
+        CREATE TABLE IF NOT EXISTS snapshots (
+            id INTEGER PRIMARY KEY,
+            account TEXT NOT NULL,
+            taken REAL NOT NULL,
+            checked REAL NOT NULL,
+            digest TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS snapshots_account
+            ON snapshots (account, taken);
+        CREATE TABLE IF NOT EXISTS positions (
+            snapshot INTEGER NOT NULL REFERENCES snapshots (id),
+            security TEXT,
+            quantity REAL NOT NULL,
+            purchase_price REAL,
+            PRIMARY KEY (snapshot, security)
+        );
+        CREATE INDEX IF NOT EXISTS positions_security
+            ON positions (security, snapshot);
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path: Path = path
+        with self.connect() as db:
+            db.executescript(self.SCHEMA)
+
+    def connect(
+        self,
+        write: bool = False,
+    ) -> AbstractContextManager[sqlite3.Connection]:
+        return sqlite_connection(self.path, write)
+
+    def record(
+        self,
+        account: str,
+        lots: LotTable,
+        taken: float | None = None,
+    ) -> int:
+        prices: dict[str | None, float] = lots.average_purchase_prices()
+        positions: list[tuple[str | None, float, float | None]] = sorted(
+            (
+                (name, quantity, prices.get(name))
+                for name, quantity in lots.quantities().items()
+            ),
+            key=lambda position: position[0] or "",
+        )
+        digest: str = sha256(dumps(positions).encode("utf-8")).hexdigest()
+        taken = time() if taken is None else taken
+        with self.connect(write=True) as db:
+            latest = db.execute(
+                "SELECT id, digest FROM snapshots WHERE account = ? "
+                "ORDER BY taken DESC LIMIT 1",
+                (account,),
+            ).fetchone()
+            if latest is not None and latest[1] == digest:
+                db.execute(
+                    "UPDATE snapshots SET checked = ? WHERE id = ?",
+                    (taken, latest[0]),
+                )
+                return latest[0]
+            snapshot: int = db.execute(
+                "INSERT INTO snapshots (account, taken, checked, digest) "
+                "VALUES (?, ?, ?, ?)",
+                (account, taken, taken, digest),
+            ).lastrowid
+            db.executemany(
+                "INSERT INTO positions VALUES (?, ?, ?, ?)",
+                [(snapshot, *position) for position in positions],
+            )
+            return snapshot
+
+    def holdings(
+        self,
+        account: str,
+        as_of: float | None = None,
+    ) -> dict[str | None, float]:
+        with self.connect() as db:
+            return dict(db.execute(
+                "SELECT security, quantity FROM positions WHERE snapshot = ("
+                "SELECT id FROM snapshots WHERE account = ? AND taken <= ? "
+                "ORDER BY taken DESC LIMIT 1)",
+                (account, float("inf") if as_of is None else as_of),
+            ))
+
+    def changes(
+        self,
+        account: str,
+    ) -> dict[str | None, tuple[float, float]]:
+        # Quantity before and after, for the latest run of the account
+        with self.connect() as db:
+            snapshots = db.execute(
+                "SELECT id, taken, checked FROM snapshots WHERE account = ? "
+                "ORDER BY taken DESC LIMIT 2",
+                (account,),
+            ).fetchall()
+            if not snapshots or snapshots[0][2] > snapshots[0][1]:
+                return {}
+            after: dict[str | None, float] = dict(db.execute(
+                "SELECT security, quantity FROM positions WHERE snapshot = ?",
+                (snapshots[0][0],),
+            ))
+            before: dict[str | None, float] = {}
+            if len(snapshots) > 1:
+                before = dict(db.execute(
+                    "SELECT security, quantity FROM positions "
+                    "WHERE snapshot = ?",
+                    (snapshots[1][0],),
+                ))
+        return {
+            name: (before.get(name, 0.0), after.get(name, 0.0))
+            for name in {**before, **after}
+            if before.get(name, 0.0) != after.get(name, 0.0)
+        }
+
+    def series(
+        self,
+        account: str,
+        security: str,
+    ) -> list[tuple[float, float]]:
+        # One point per distinct snapshot, 0 while not held
+        with self.connect() as db:
+            return db.execute(
+                "SELECT s.taken, COALESCE(p.quantity, 0.0) FROM snapshots s "
+                "LEFT JOIN positions p "
+                "ON p.snapshot = s.id AND p.security = ? "
+                "WHERE s.account = ? ORDER BY s.taken",
+                (security, account),
+            ).fetchall()
+
+
+class DocumentIndex:
+    # Full-text index of statement text and library metadata in SQLite
+    # FTS5. Each document is indexed once per content hash.
+    SCHEMA: str = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS documents USING fts5(
+            description,
+            text,
+            id UNINDEXED,
+            date UNINDEXED,
+            sha256 UNINDEXED
+        );
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path: Path = path
+        self.indexed_count: int = 0
+        # Ids of indexed documents no text could be extracted from, only
+        # their description is searchable
+        self.without_text: list[str] = []
+        with self.connect() as db:
+            db.executescript(self.SCHEMA)
+
+    def connect(
+        self,
+        write: bool = False,
+    ) -> AbstractContextManager[sqlite3.Connection]:
+        return sqlite_connection(self.path, write)
+
+    def indexed(self) -> dict[str, str]:
+        # Content hash per document id
+        with self.connect() as db:
+            return dict(db.execute("SELECT id, sha256 FROM documents"))
+
+    def update(
+        self,
+        documents: list[dict],
+        manifest: dict[str, dict],
+        store: DocumentStore,
+    ) -> int:
+        # Indexes stored documents whose content is new since the last run
+        indexed: dict[str, str] = self.indexed()
+        rows: list[tuple[str, str, str, str, str]] = []
+        for document in documents:
+            digest: str | None = manifest.get(document["id"], {}).get("sha256")
+            if digest is None or indexed.get(document["id"]) == digest:
+                continue
+            try:
+                with store.open(digest) as file:
+                    text: str = pdf_text(file.read())
+            except OSError:
+                continue
+            if not text.strip():
+                self.without_text.append(document["id"])
+            rows.append((
+                document["description"],
+                text,
+                document["id"],
+                document["date"],
+                digest,
+            ))
+        if rows:
+            with self.connect(write=True) as db:
+                db.executemany(
+                    "DELETE FROM documents WHERE id = ?",
+                    [(row[2],) for row in rows],
+                )
+                db.executemany(
+                    "INSERT INTO documents "
+                    "(description, text, id, date, sha256) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    rows,
+                )
+        self.indexed_count += len(rows)
+        return len(rows)
+
+    def search(
+        self,
+        query: str,
+        year: int | None = None,
+        limit: int = 50,
+    ) -> list[tuple[str, str, str, str]]:
+        # Id, date, description and a text snippet, best match first
+        with self.connect() as db:
+            return db.execute(
+                "SELECT id, date, description, "
+                "snippet(documents, 1, '[', ']', '...', 12) "
+                "FROM documents WHERE documents MATCH ? "
+                "AND (? IS NULL OR substr(date, 1, 4) = ?) "
+                "ORDER BY rank LIMIT ?",
+                (query, year, str(year), limit),
+            ).fetchall()
+
+
+@dataclass
+class Position:
+    name: str | None
+    quantity: float
+    purchase_price: float | None
+
+
+@dataclass
+class DocumentDownload:
+    id: str
+    path: Path
+    ok: bool
+    # 0 for documents that were already stored
+    attempts: int
+
+
+@dataclass
+class SyncResult:
+    username: str
+    logged_in: bool = False
+    # Positions came from cached responses, without a login
+    cached: bool = False
+    restored: bool = False
+    stored: bool = False
+    positions: list[Position] = field(default_factory=list)
+    documents: list[DocumentDownload] = field(default_factory=list)
+    # Quantity before and after per security, with a snapshot store
+    changes: dict[str | None, tuple[float, float]] | None = None
+    # Seconds per login or fetch step and per planDetails request
+    timings: dict[str, float] = field(default_factory=dict)
+    plan_timings: dict[str, float] = field(default_factory=dict)
+    elapsed: float = 0.0
+    error: str | None = None
+
+    @property
+    def securities(self) -> dict[str | None, float]:
+        return {position.name: position.quantity for position in self.positions}
+
+    def to_dict(self) -> dict:
+        # JSON-serializable, for reports and the daemon socket
+        data: dict = asdict(self)
+        for document in data["documents"]:
+            document["path"] = str(document["path"])
+        if self.changes is not None:
+            data["changes"] = {
+                str(name): change for name, change in self.changes.items()
+            }
+        return data
 
 
 class EquatePlus:
@@ -60,11 +1602,60 @@ class EquatePlus:
         username: str,
         password: str,
         qr_code_path: Path,
+        max_parallel: int = 4,
+        download_attempts: int = 3,
+        pace: float = 0.0,
+        qr_timeout: float = 60.0,
+        cache: "ResponseCache | None" = None,
+        refresh: bool = False,
+        state_path: Path | None = None,
+        compress_documents: bool = False,
+        document_index: "DocumentIndex | None" = None,
+        scheduler: RequestScheduler | None = None,
     ) -> None:
         self.username: str = username
         self.password: str = password
         self.qr_code_path: Path = qr_code_path
-        self.documents_dir: Path = Path("documents")
+        self.max_parallel: int = max_parallel
+        self.download_attempts: int = download_attempts
+        # Delay after each login and fetch step, in seconds
+        self.pace: float = pace
+        # Seconds to wait for the EquateAccess app approval
+        self.qr_timeout: float = qr_timeout
+        # planSummary/planDetails responses, refresh skips cached reads
+        self.cache: ResponseCache | None = cache
+        self.refresh: bool = refresh
+        self.tracer: Tracer = Tracer()
+        # Paces and retries every request, shared by the clients of a batch
+        self.scheduler: RequestScheduler = (
+            scheduler if scheduler is not None else RequestScheduler()
+        )
+        # Called with an event name and details as the sync progresses:
+        # step (name, result, elapsed), host (host), qr_poll (polls,
+        # status), plan (plan_id, elapsed), document (document_id, ok,
+        # attempts)
+        self.progress: Callable[..., None] | None = None
+        # Asks the user for an SMS code, without it OTP logins fail
+        self.otp_prompt: Callable[[], str] | None = None
+        # Told where the QR code to scan was written
+        self.qr_notify: Callable[[Path], None] | None = None
+        self.documents_dir: Path = DOCUMENTS_DIR
+        # Statements by content hash, gzip compressed if compress_documents
+        self.compress_documents: bool = compress_documents
+        self.document_store: DocumentStore | None = None
+        # Full-text index updated with the documents new in each run
+        self.document_index: DocumentIndex | None = document_index
+        # Datacenter host all requests are sent to, and the candidates
+        # it fails over to
+        self.host: str = "https://www.equateplus.com"
+        self.hosts: list[str] = list(HOST_CANDIDATES)
+        self.failed_hosts: set[str] = set()
+        self.host_lock: Lock = Lock()
+        self.probe_timeout: float = 10.0
+        # Learned across runs, such as the last good host
+        self.state_path: Path | None = state_path
+        self.state: dict = load_state(state_path)
+        self.state_lock: Lock = Lock()
 
         self.session: requests.Session = requests.Session()
         self.cookies: dict[str, str] = {}
@@ -75,45 +1666,205 @@ class EquatePlus:
         self.cid: str = "eqp." + str(random_digits(7))
         self.plan_ids: list[str] = []
         self.securities: dict[str, float] = {}
+        self.lots: LotTable = LotTable()
+        # Seconds spent per planDetails request, keyed by plan id
+        self.plan_timings: dict[str, float] = {}
+        # File path, success and attempts per document id
+        self.document_results: dict[str, tuple[Path, bool, int]] = {}
+        # Guards CSRF header updates from concurrent response hooks
+        self.csrf_lock: Lock = Lock()
         # True when SMS OTP flow completes login
         self.skip_equateaccess: bool = False
+        # True when a service request was answered with the login page
+        self.session_expired: bool = False
 
         self.session.hooks.update({
             "response": [
                 self.set_csrf,
+                self.tracer.record,
             ],
         })
         # Default headers
         self.session.headers["Accept"] = "*/*"
 
-    def set_csrf(self, response: requests.Response, **_kwargs) -> None:
-        prefix = b"csrfRegisterAjax(\"csrfpId\", \""
-        if prefix in response.content:
-            self.csrf = (
-                response.content.split(prefix)[1]
-                .split(b"\")")[0]
-                .decode("utf-8")
+    def notify(self, event: str, **details) -> None:
+        if self.progress is not None:
+            self.progress(event, **details)
+
+    def url(self, path: str = "") -> str:
+        return f"{self.host}/EquatePlusParticipant2/{path}"
+
+    def save_state(self) -> None:
+        with self.state_lock:
+            save_state(self.state_path, self.state)
+
+    def pin_host(self, host: str) -> None:
+        if host != self.host:
+            self.notify("host", host=host)
+        self.host = host
+        self.state["host"] = host
+        self.save_state()
+
+    def strategy(self, name: str) -> str | None:
+        # Method or login path that last worked for this host
+        return self.state.get("strategies", {}).get(self.host, {}).get(name)
+
+    def learn(self, name: str, value: str, learned: str | None) -> None:
+        self.tracer.count(
+            "strategy_hits" if value == learned else "strategy_misses"
+        )
+        if value == learned:
+            return
+        with self.state_lock:
+            self.state.setdefault("strategies", {}).setdefault(
+                self.host,
+                {},
+            )[name] = value
+        self.save_state()
+
+    def select_host(self) -> str | None:
+        # The last good host skips the probe, it is checked on first use
+        if self.state.get("host") in self.hosts:
+            self.host = self.state["host"]
+            return self.host
+        healthy: list[str] = probe_hosts(
+            self.session,
+            self.hosts,
+            self.probe_timeout,
+        )
+        if not healthy:
+            return None
+        self.pin_host(healthy[0])
+        return self.host
+
+    def failover(self) -> bool:
+        # Pins the fastest healthy host not yet failed in this login. Only
+        # called before login: cookies and tokens belong to one host.
+        with self.host_lock:
+            self.failed_hosts.add(self.host)
+            self.tracer.count("host_failover")
+            healthy: list[str] = probe_hosts(
+                self.session,
+                [host for host in self.hosts if host not in self.failed_hosts],
+                self.probe_timeout,
             )
-            self.session.headers["csrfpId"] = self.csrf
+            if not healthy:
+                return False
+            self.session.cookies.clear()
+            self.pin_host(healthy[0])
+            return True
 
-        # CSRF2 via JSON blob
-        prefix = b",\"equateCsrfToken2\":\""
-        if prefix in response.content:
+    def request(
+        self,
+        method: str,
+        path: str,
+        idempotent: bool | None = None,
+        retry: bool = True,
+        **kwargs,
+    ) -> requests.Response:
+        # Read-only POST services pass idempotent=True to be retried
+        return self.scheduler.send(
+            self.session,
+            method,
+            self.url(path),
+            idempotent=idempotent,
+            retry=retry,
+            tracer=self.tracer,
+            **kwargs,
+        )
+
+    def set_csrf(
+        self,
+        response: requests.Response,
+        stream: bool = False,
+        **_kwargs,
+    ) -> None:
+        # Skip downloads: reading a streamed body here would buffer it all
+        if stream or not is_text_content(response.headers.get("Content-Type")):
+            return
+        tokens: dict[str, tuple[str, str]] = extract_csrf(response.content)
+        with self.csrf_lock:
+            if "csrf" in tokens:
+                self.csrf = tokens["csrf"][0]
+                self.session.headers["csrfpId"] = self.csrf
+            if "csrf2" in tokens:
+                self.session.headers["EQUATE-CSRF2-TOKEN-PARTICIPANT2"] = (
+                    tokens["csrf2"][0]
+                )
+        for _, name in tokens.values():
+            self.tracer.count(f"csrf_pattern_{name}")
+
+    def csrf_headers(self) -> dict[str, str]:
+        # Snapshot of the CSRF headers for requests sent from worker threads
+        with self.csrf_lock:
+            return {
+                key: self.session.headers[key]
+                for key in ("csrfpId", "EQUATE-CSRF2-TOKEN-PARTICIPANT2")
+                if key in self.session.headers
+            }
+
+    def save_session(self, path: Path) -> None:
+        state = {
+            "host": self.host,
+            "cid": self.cid,
+            "csrf": self.session.headers.get("csrfpId"),
+            "csrf2": self.session.headers.get(
+                "EQUATE-CSRF2-TOKEN-PARTICIPANT2"
+            ),
+            "cookies": [
+                {
+                    "name": cookie.name,
+                    "value": cookie.value,
+                    "domain": cookie.domain,
+                    "path": cookie.path,
+                    "secure": cookie.secure,
+                    "expires": cookie.expires,
+                }
+                for cookie in self.session.cookies
+            ],
+        }
+        # Session cookies grant account access, so the file is never
+        # readable by others, not even while it is written
+        temp_path: Path = path.with_suffix(f".{get_ident()}.tmp")
+        temp_path.unlink(missing_ok=True)
+        fd: int = os_open(temp_path, O_WRONLY | O_CREAT | O_EXCL, 0o600)
+        with open(fd, "w", encoding="utf-8") as file:
+            file.write(dumps(state, indent=1))
+        temp_path.replace(path)
+
+    def restore_session(self, path: Path) -> bool:
+        try:
+            state = loads(path.read_text())
+            self.host = state["host"]
+            self.cid = state["cid"]
+            for cookie in state["cookies"]:
+                self.session.cookies.set(**cookie)
+        except (OSError, JSONDecodeError, KeyError, TypeError):
+            return False
+
+        if state.get("csrf"):
+            self.csrf = state["csrf"]
+            self.session.headers["csrfpId"] = state["csrf"]
+        if state.get("csrf2"):
             self.session.headers["EQUATE-CSRF2-TOKEN-PARTICIPANT2"] = (
-                response.content.split(prefix)[1]
-                .split(b"\",")[0]
-                .decode("utf-8")
+                state["csrf2"]
             )
-        else:
-            # CSRF2 via HTML hidden input
-            marker = b"name=\"EQUATE-CSRF2-TOKEN-PARTICIPANT2\" value=\""
-            if marker in response.content:
-                token = (
-                    response.content.split(marker)[1]
-                    .split(b"\"")[0]
-                    .decode("utf-8")
+        return True
+
+    def login(self) -> bool:
+        return (
+            self.initialize()
+            and self.send_user()
+            and self.send_credentials()
+            and (
+                self.skip_equateaccess or (
+                    self.request_devices()
+                    and self.request_qr_code()
+                    and self.verify_qr_code()
+                    and self.complete_login()
                 )
-                self.session.headers["EQUATE-CSRF2-TOKEN-PARTICIPANT2"] = token
+            )
+        )
 
     def ids(self) -> dict[str, str]:
         return {
@@ -121,18 +1872,31 @@ class EquatePlus:
             "_rId": str(random_digits(8)),
         }
 
-    @debug
+    @step
     def initialize(self) -> bool:
-        response: requests.Response = self.session.get(
-            "https://www.equateplus.com/EquatePlusParticipant2/?login",
-        )
-        
-        return b"isiwebuserid" in response.content
+        # Nothing is bound to the host yet, so an unreachable host or an
+        # outage landing page moves the login to the next healthy host
+        self.failed_hosts.clear()
+        while True:
+            try:
+                # Failing over is the retry here
+                response: requests.Response = self.request(
+                    "GET",
+                    "?login",
+                    retry=False,
+                )
+                if b"isiwebuserid" in response.content:
+                    return True
+            except (requests.ConnectionError, requests.Timeout):
+                pass
+            if not self.failover():
+                return False
 
-    @debug
+    @step
     def send_user(self) -> bool:
-        response: requests.Response = self.session.post(
-            "https://www.equateplus.com/EquatePlusParticipant2/?login",
+        response: requests.Response = self.request(
+            "POST",
+            "?login",
             params={
                 "csrfpId": self.csrf,
             },
@@ -146,10 +1910,11 @@ class EquatePlus:
             },)
         return b"isiwebpasswd" in response.content
 
-    @debug
+    @step
     def send_credentials(self) -> bool:
-        response: requests.Response = self.session.post(
-            "https://www.equateplus.com/EquatePlusParticipant2/?login",
+        response: requests.Response = self.request(
+            "POST",
+            "?login",
             data={
                 "csrfpId": self.csrf,
                 "isiwebuserid": self.username,
@@ -160,21 +1925,18 @@ class EquatePlus:
                 "Content-Type": "application/x-www-form-urlencoded",
             },
         )
-        # Detect SMS OTP flow
-        markers = (
-            b'id="otpCodeId"',
-            b'class="otpCodeSms"',
-            b'Security Step Code',
-        )
-        if any(m in response.content for m in markers):
+        # Detect SMS OTP flow first, an OTP page may mention the app too.
+        # The learned path only feeds the strategy hit rate.
+        learned: str | None = self.strategy("auth")
+        if any(m in response.content for m in OTP_MARKERS):
+            if self.otp_prompt is None:
+                return False
             # Prompt for OTP and verify
             for _ in range(3):
-                code = click.prompt(
-                    "Please enter the SMS code",
-                    hide_input=True,
-                )
-                verify: requests.Response = self.session.post(
-                    "https://www.equateplus.com/EquatePlusParticipant2/?login",
+                code = self.otp_prompt()
+                verify: requests.Response = self.request(
+                    "POST",
+                    "?login",
                     data={
                         "csrfpId": self.csrf,
                         # Field id is otpCodeId; name is typically otpCode
@@ -191,263 +1953,907 @@ class EquatePlus:
                 # Complete login and skip EquateAccess QR flow
                 ok = self.complete_login()
                 self.skip_equateaccess = ok
+                if ok:
+                    self.learn("auth", "otp", learned)
                 return ok
             return False
 
-        return b"EquateAccess app" in response.content
+        if b"EquateAccess app" in response.content:
+            self.learn("auth", "equateaccess", learned)
+            return True
+        return False
+
+    @step
+    def request_devices(self) -> bool:
+        response: requests.Response = self.request(
+            "POST",
+            "?login",
+            data={
+                "isiwebuserid": self.username,
+                "isiwebpasswd": "null",
+                "result": "null",
+            },
+            headers={
+                "Content-Type": "application/x-www-form-urlencoded",
+            },
+        )
+
+        try:
+            self.device_id = response.json()["dispatchTargets"][0]["id"]
+            return True
+        except (KeyError, IndexError):
+            return False
+
+    @step
+    def request_qr_code(self) -> bool:
+        response: requests.Response = self.request(
+            "GET",
+            "?login",
+            params={
+                "o.dispatchTargetId.v": self.device_id,
+                **self.ids(),
+            },
+            headers={
+                "Content-Type": "application/x-www-form-urlencoded",
+            },
+        )
+
+        try:
+            data = response.json()
+            self.qr_code_path.write_bytes(
+                b64decode(
+                    data["dispatcherInformation"]["response"] + "=="
+                )
+            )
+            self.session_id = data["sessionId"]
+            if self.qr_notify is not None:
+                self.qr_notify(self.qr_code_path)
+
+            return True
+        except (KeyError, IndexError):
+            return False
+
+    @step
+    def verify_qr_code(self) -> bool:
+        start: float = perf_counter()
+        deadline: float = start + self.qr_timeout
+        polls: int = 0
+        result: str | None = None
+        for delay in poll_delays():
+            remaining: float = deadline - perf_counter()
+            if remaining <= 0:
+                break
+            sleep(min(delay, remaining))
+            response: requests.Response = self.request(
+                "GET",
+                "?login",
+                params={
+                    "o.fidoUafSessionId.v": self.session_id,
+                    **self.ids(),
+                },
+                headers={
+                    "Content-Type": "application/x-www-form-urlencoded",
+                },
+            )
+            polls += 1
+
+            try:
+                result = response.json()["status"]
+            except (KeyError, IndexError):
+                break
+            finally:
+                self.notify("qr_poll", polls=polls, status=result)
+            if result in QR_FINAL_STATUSES:
+                break
+
+        self.tracer.gauges["qr_polls"] = polls
+        self.tracer.gauges.pop("qr_time_to_approval_seconds", None)
+        if result == "succeeded":
+            self.tracer.gauges["qr_time_to_approval_seconds"] = (
+                perf_counter() - start
+            )
+        return result == "succeeded"
+
+    @step
+    def complete_login(self) -> bool:
+        response: requests.Response = self.request(
+            "POST",
+            "?login",
+            data={
+                "result": "Continue",
+            },
+            headers={
+                "Content-Type": "application/x-www-form-urlencoded",
+            },
+        )
+        return b"TopLoaderSkeleton" in response.content
+
+    def cache_key(self, name: str) -> str:
+        return f"{self.host}|{self.username}|{name}"
+
+    def cached(self, name: str) -> bytes | None:
+        if self.cache is None or self.refresh:
+            return None
+        return self.cache.get(self.cache_key(name))
+
+    @step
+    def get_plan_summary(
+        self,
+        offline: bool = False,
+        probe: bool = False,
+    ) -> bool:
+        # A probe checks the session, so it always asks EquatePlus
+        self.session_expired = False
+        cached: bytes | None = None if probe else self.cached("planSummary")
+        if cached is not None:
+            summary = parse_plan_summary(cached)
+            if summary is not None and summary[1]:
+                self.plan_ids = summary[0]
+                return True
+        if offline:
+            return False
+
+        # POST and GET both serve planSummary, depending on the host.
+        # The one that worked last on this host goes first.
+        attempts: list[tuple[str, dict]] = [
+            ("POST", {"json": {"$type": "Object"}}),
+            ("GET", {}),
+        ]
+        learned: str | None = self.strategy("plan_summary")
+        attempts.sort(key=lambda attempt: attempt[0] != learned)
+        for method, kwargs in attempts:
+            response: requests.Response = self.request(
+                method,
+                "services/planSummary/get",
+                idempotent=True,
+                params=self.ids(),
+                headers={
+                    "Referer": self.url(),
+                },
+                **kwargs,
+            )
+            if is_login_redirect(response.content):
+                self.session_expired = True
+                continue
+            summary = parse_plan_summary(response.content)
+            if summary is None:
+                continue
+            self.plan_ids, ok = summary
+            if ok:
+                self.learn("plan_summary", method, learned)
+                if self.cache is not None:
+                    self.cache.put(
+                        self.cache_key("planSummary"),
+                        response.content,
+                    )
+                return True
+        return False
+
+    def fetch_plan_details(
+        self,
+        plan_id: str,
+        headers: dict[str, str],
+    ) -> tuple[LotTable, bytes | None, float]:
+        # Lots are parsed while the body streams in. The raw body is kept
+        # only when it goes to the cache.
+        start: float = perf_counter()
+        lots = LotTable()
+        kept: list[bytes] = []
+        with self.request(
+            "POST",
+            "services/planDetails/get",
+            idempotent=True,
+            params=self.ids(),
+            json={
+                "$type": "EntityIdentifier",
+                "id": plan_id,
+            },
+            headers={
+                "Referer": self.url(),
+                **headers,
+            },
+            stream=True,
+        ) as response:
+            if "html" in response.headers.get("Content-Type", ""):
+                # A dead session answers with the login page
+                if is_login_redirect(response.content):
+                    self.session_expired = True
+                raise ValueError(f"planDetails {plan_id}: HTML response")
+            chunks: Iterator[bytes] = response.iter_content(16 * 1024)
+            if self.cache is not None:
+                chunks = keep_chunks(chunks, kept)
+            lots.add_lots(plan_id, plan_lots(chunks))
+        content: bytes | None = (
+            b"".join(kept) if self.cache is not None else None
+        )
+        return lots, content, perf_counter() - start
+
+    @step
+    def get_plan_details(self, offline: bool = False) -> bool:
+        self.session_expired = False
+        tables: dict[str, LotTable | None] = {}
+        for plan_id in self.plan_ids:
+            cached: bytes | None = self.cached(f"planDetails|{plan_id}")
+            if cached is None:
+                continue
+            lots = LotTable()
+            try:
+                lots.add_lots(plan_id, plan_lots(slices(cached)))
+            except PLAN_DETAILS_ERRORS:
+                # Fetched again below
+                continue
+            tables[plan_id] = lots
+        missing: list[str] = [
+            plan_id for plan_id in self.plan_ids if plan_id not in tables
+        ]
+        if offline and missing:
+            return False
+
+        # All workers send the same CSRF tokens, even if a response hook
+        # updates the session headers while the requests are in flight
+        headers: dict[str, str] = self.csrf_headers()
+        with ThreadPoolExecutor(max_workers=max(1, self.max_parallel)) as pool:
+            futures = {
+                pool.submit(self.fetch_plan_details, plan_id, headers): plan_id
+                for plan_id in missing
+            }
+            for future in as_completed(futures):
+                plan_id: str = futures[future]
+                try:
+                    lots, content, self.plan_timings[plan_id] = (
+                        future.result()
+                    )
+                except PLAN_DETAILS_ERRORS:
+                    tables[plan_id] = None
+                    continue
+                tables[plan_id] = lots
+                if content is not None:
+                    self.cache.put(
+                        self.cache_key(f"planDetails|{plan_id}"),
+                        content,
+                    )
+                self.notify(
+                    "plan",
+                    plan_id=plan_id,
+                    elapsed=self.plan_timings[plan_id],
+                )
+
+        # Merge in plan order so the sums do not depend on completion order
+        ok: bool = True
+        for plan_id in self.plan_ids:
+            if tables[plan_id] is None:
+                ok = False
+                break
+            self.lots.extend(tables[plan_id])
+        self.securities = self.lots.quantities()
+        return ok
+
+    @step
+    def get_documents(self) -> bool:
+        response: requests.Response = self.request(
+            "POST",
+            "services/documents/library",
+            idempotent=True,
+            params=self.ids(),
+            json={
+                "$type": "Object",
+            },
+            headers={
+                "Referer": self.url(),
+            },
+        )
+        # Downloads start while the library list is still being processed
+        headers: dict[str, str] = self.csrf_headers()
+        manifest: dict[str, dict] = load_manifest(self.documents_dir)
+        self.document_store = DocumentStore(
+            self.documents_dir,
+            compress=self.compress_documents,
+        )
+        futures = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.max_parallel)) as pool:
+            try:
+                documents: list[dict] = response.json()["documents"]
+                names: dict[str, str] = document_file_names(documents)
+                for document in documents:
+                    file_path: Path = self.documents_dir / names[document["id"]]
+                    if is_synced(
+                        manifest.get(document["id"]),
+                        document,
+                        file_path,
+                        self.document_store,
+                    ):
+                        self.document_results[document["id"]] = (
+                            file_path,
+                            True,
+                            0,
+                        )
+                        continue
+
+                    future = pool.submit(
+                        self.download_document_with_retry,
+                        document["id"],
+                        self.document_store.incoming(f"{document['id']}.pdf"),
+                        headers,
+                    )
+                    futures[future] = (document, file_path)
+
+            except (KeyError, IndexError):
+                for future in futures:
+                    future.cancel()
+                return False
+
+            for future in as_completed(futures):
+                document, file_path = futures[future]
+                ok, attempts = future.result()
+                self.document_results[document["id"]] = (
+                    file_path,
+                    ok,
+                    attempts,
+                )
+                self.notify(
+                    "document",
+                    document_id=document["id"],
+                    ok=ok,
+                    attempts=attempts,
+                )
+                if not ok:
+                    continue
+                incoming: Path = self.document_store.incoming(
+                    f"{document['id']}.pdf"
+                )
+                size: int = incoming.stat().st_size
+                digest: str = self.document_store.add(incoming)
+                self.document_store.link(digest, file_path)
+                manifest[document["id"]] = {
+                    "date": document["date"],
+                    "file": file_path.name,
+                    "size": size,
+                    "sha256": digest,
+                }
+
+        save_manifest(self.documents_dir, manifest)
+        if self.document_index is not None:
+            self.document_index.update(
+                documents,
+                manifest,
+                self.document_store,
+            )
+        return True
+
+    def download_document_with_retry(
+        self,
+        document_id: str,
+        file_path: Path,
+        headers: dict[str, str] | None = None,
+    ) -> tuple[bool, int]:
+        # Failed documents are retried on their own, the batch goes on.
+        # The scheduler already backed off transient failures, and a
+        # broken transfer resumes where it stopped.
+        for attempt in range(1, self.download_attempts + 1):
+            try:
+                if self.download_document(document_id, file_path, headers):
+                    return True, attempt
+            except requests.RequestException:
+                pass
+        return False, self.download_attempts
+
+    def download_document(
+        self,
+        document_id: str,
+        file_path: Path,
+        headers: dict[str, str] | None = None,
+    ) -> bool:
+        # Streams into a .part file that is renamed once complete. The
+        # part left by an interrupted transfer is resumed with a Range
+        # request if the document did not change since (If-Range), or
+        # replaced if the server sends the whole document.
+        part_path, validator_path = part_paths(file_path)
+        offset, validator = resume_offset(part_path, validator_path)
+        request_headers: dict[str, str] = {
+            "Referer": self.url(),
+            **(headers or {}),
+        }
+        if offset:
+            request_headers["Range"] = f"bytes={offset}-"
+            request_headers["If-Range"] = validator
+        with self.request(
+            "GET",
+            "services/statements/download",
+            params={
+                "documentId": document_id,
+                "downloadType": "inline",
+                "source": "LIBRARY",
+            },
+            headers=request_headers,
+            stream=True,
+        ) as response:
+            if response.status_code == 416:
+                # The part does not fit the document (any more)
+                discard_part(part_path, validator_path)
+                return False
+            if not response.ok:
+                return False
+            if response.status_code == 206:
+                if not resumes(
+                    response.status_code,
+                    response.headers.get("Content-Range"),
+                    offset,
+                ):
+                    # A range the part does not end at, never a document
+                    discard_part(part_path, validator_path)
+                    return False
+            else:
+                offset = 0
+            chunks: Iterator[bytes] = response.iter_content(
+                DOWNLOAD_CHUNK_SIZE
+            )
+            head: bytes = b""
+            if offset == 0:
+                # Only the first bytes tell an error body from a document
+                for chunk in chunks:
+                    head += chunk
+                    if len(head) >= len(TECHNICAL_ERROR):
+                        break
+                if is_technical_error(head):
+                    return False
+
+            try:
+                if offset == 0:
+                    start_part(part_path, validator_path, response.headers)
+                with part_path.open("ab" if offset else "wb") as file:
+                    file.write(head)
+                    for chunk in chunks:
+                        file.write(chunk)
+                part_path.replace(file_path)
+                validator_path.unlink(missing_ok=True)
+            except OSError:
+                return False
+
+        return True
+
+    @step
+    def keepalive(self) -> bool:
+        # Cheapest authenticated request, also tells if the session died
+        response: requests.Response = self.request(
+            "GET",
+            "services/user/get",
+            params=self.ids(),
+            headers={
+                "Referer": self.url(),
+            },
+        )
+        self.session_expired = is_login_redirect(response.content)
+        return not self.session_expired
+
+    @step
+    def logout(self) -> None:
+        self.request(
+            "GET",
+            "services/participant/logout",
+        )
+
+    def positions(self) -> list[Position]:
+        prices: dict[str | None, float] = self.lots.average_purchase_prices()
+        return [
+            Position(name, quantity, prices.get(name))
+            for name, quantity in self.lots.quantities().items()
+        ]
+
+    def documents(self) -> list[DocumentDownload]:
+        return [
+            DocumentDownload(document_id, path, ok, attempts)
+            for document_id, (path, ok, attempts) in sorted(
+                self.document_results.items()
+            )
+        ]
+
+    def timings(self) -> dict[str, float]:
+        timings: dict[str, float] = {}
+        for name, elapsed in self.tracer.steps:
+            timings[name] = timings.get(name, 0.0) + elapsed
+        return timings
+
+
+def print_document_summary(
+    results: dict[str, tuple[Path, bool, int]],
+) -> None:
+    failed = [
+        (path, attempts) for path, ok, attempts in results.values() if not ok
+    ]
+    retried = sum(1 for _, ok, attempts in results.values() if attempts > 1)
+    skipped = sum(1 for _, ok, attempts in results.values() if attempts == 0)
+    print(
+        f"documents: {len(results) - len(failed) - skipped} downloaded, "
+        f"{skipped} unchanged, {len(failed)} failed, {retried} retried"
+    )
+    for path, attempts in sorted(failed):
+        print(f"  failed after {attempts} attempts: {path.name}")
+
+
+def print_strategy_summary(counters: dict[str, int]) -> None:
+    hits: int = counters.get("strategy_hits", 0)
+    misses: int = counters.get("strategy_misses", 0)
+    if hits + misses:
+        print(
+            f"strategy: {hits} hits, {misses} misses "
+            f"({hits / (hits + misses):.0%} hit rate)"
+        )
+
+
+def print_request_summary(stats: dict[str, int]) -> None:
+    if stats["throttled"] or stats["retried"]:
+        print(
+            f"requests: {stats['throttled']} throttled "
+            f"(queue depth up to {stats['max_queue_depth']}), "
+            f"{stats['retried']} retried, "
+            f"{stats['rate_limited']} rate limited"
+        )
+
+
+def print_progress(event: str, **details) -> None:
+    # Command line rendering of EquatePlus.progress events
+    if event == "step":
+        print(f"{details['name']} -> {details['result']}")
+    elif event == "host":
+        print(f"host: {details['host']}")
+    elif event == "qr_poll":
+        print(".", end="", flush=True)
+
+
+def print_qr_notice(path: Path) -> None:
+    print(f"scan {path} with the EquateAccess app")
+
+
+def attach_cli(equateplus: EquatePlus) -> None:
+    # Progress on stdout, SMS codes and QR notices on the terminal
+    equateplus.progress = print_progress
+    equateplus.otp_prompt = prompt_otp
+    equateplus.qr_notify = print_qr_notice
+
+
+def print_changes(changes: dict[str | None, tuple[float, float]]) -> None:
+    if not changes:
+        print("holdings: unchanged since last run")
+    for name, (before, after) in sorted(
+        changes.items(),
+        key=lambda change: change[0] or "",
+    ):
+        print(f"  {name}: {before:g} -> {after:g}")
+
 
-    @debug
-    def request_devices(self) -> bool:
-        response: requests.Response = self.session.post(
-            "https://www.equateplus.com/EquatePlusParticipant2/?login",
-            data={
-                "isiwebuserid": self.username,
-                "isiwebpasswd": "null",
-                "result": "null",
-            },
-            headers={
-                "Content-Type": "application/x-www-form-urlencoded",
-            },
+def read_accounts(credentials_path: Path) -> list[tuple[str, str]]:
+    # Username and password lines, one pair per account
+    lines: list[str] = [
+        line for line in credentials_path.read_text().split("\n")
+        if line.strip()
+    ]
+    if len(lines) % 2:
+        raise click.ClickException(
+            f"{credentials_path}: username {lines[-1]!r} has no password line"
         )
+    return list(zip(lines[::2], lines[1::2]))
 
-        try:
-            self.device_id = response.json()["dispatchTargets"][0]["id"]
-            return True
-        except (KeyError, IndexError):
-            return False
 
-    @debug
-    def request_qr_code(self) -> bool:
-        response: requests.Response = self.session.get(
-            "https://www.equateplus.com/EquatePlusParticipant2/?login",
-            params={
-                "o.dispatchTargetId.v": self.device_id,
-                **self.ids(),
-            },
-            headers={
-                "Content-Type": "application/x-www-form-urlencoded",
-            },
-        )
+class InteractionQueue:
+    # Hands SMS prompts and QR notices from account workers to the main
+    # thread, so a waiting account does not block the others
+    def __init__(self) -> None:
+        self.queue: Queue = Queue()
 
-        try:
-            data = response.json()
-            self.qr_code_path.write_bytes(
-                b64decode(
-                    data["dispatcherInformation"]["response"] + "=="
+    def otp_prompt(self, username: str) -> Callable[[], str]:
+        def prompt() -> str:
+            answer: Queue = Queue(maxsize=1)
+            self.queue.put(("otp", username, answer))
+            return answer.get()
+        return prompt
+
+    def qr_notify(self, username: str) -> Callable[[Path], None]:
+        def notify(path: Path) -> None:
+            self.queue.put(("qr", username, path))
+        return notify
+
+    def serve(self, futures: list[Future]) -> None:
+        pending: list[Future] = futures
+        while pending:
+            try:
+                kind, username, payload = self.queue.get(timeout=0.2)
+            except Empty:
+                pending = [future for future in pending if not future.done()]
+                continue
+            if kind == "otp":
+                payload.put(
+                    click.prompt(
+                        f"Please enter the SMS code for {username}",
+                        hide_input=True,
+                    )
                 )
-            )
-            self.session_id = data["sessionId"]
+            else:
+                print(f"{username}: scan {payload} with the EquateAccess app")
 
-            return True
-        except (KeyError, IndexError):
-            return False
 
-    @debug
-    def verify_qr_code(self) -> bool:
-        while True:
-            sleep(1.0)
-            response: requests.Response = self.session.get(
-                "https://www.equateplus.com/EquatePlusParticipant2/?login",
-                params={
-                    "o.fidoUafSessionId.v": self.session_id,
-                    **self.ids(),
-                },
-                headers={
-                    "Content-Type": "application/x-www-form-urlencoded",
-                },
+def sync_account(
+    equateplus: EquatePlus,
+    download_documents: bool = False,
+    history: SnapshotStore | None = None,
+    session_path: Path | None = None,
+    restore: bool = False,
+    store: bool = False,
+    logout: bool = True,
+) -> SyncResult:
+    # Fetches the account without printing anything; progress goes to
+    # equateplus.progress and errors end up in the result
+    start: float = perf_counter()
+    result = SyncResult(username=equateplus.username)
+    summary_successful: bool = False
+    details_successful: bool = False
+    try:
+        # Warm cache: no login needed at all
+        if (
+            equateplus.cache is not None
+            and not equateplus.refresh
+            and not download_documents
+        ):
+            result.cached = (
+                equateplus.get_plan_summary(offline=True)
+                and equateplus.get_plan_details(offline=True)
             )
-            
-            print(".", end="", flush=True)
+            details_successful = result.cached
 
-            try:
-                result = response.json()["status"]
-            except (KeyError, IndexError):
-                print(response.content)
-                break
-            if result in ("succeeded", "failed_retry_please", "failed"):
-                break
+        if (
+            not result.cached
+            and restore
+            and session_path is not None
+            and equateplus.restore_session(session_path)
+        ):
+            # The first data request doubles as session validity probe
+            summary_successful = equateplus.get_plan_summary(probe=True)
+            result.logged_in = not equateplus.session_expired
+            result.restored = result.logged_in
 
-        print(" ", end="", flush=True)
-        return result == "succeeded"
+        if not result.logged_in and not result.cached:
+            result.logged_in = equateplus.login()
+            summary_successful = False
 
-    @debug
-    def complete_login(self) -> bool:
-        response: requests.Response = self.session.post(
-            "https://www.equateplus.com/EquatePlusParticipant2/?login",
-            data={
-                "result": "Continue",
-            },
-            headers={
-                "Content-Type": "application/x-www-form-urlencoded",
-            },
-        )
-        return b"TopLoaderSkeleton" in response.content
+        if store and result.logged_in and session_path is not None:
+            equateplus.save_session(session_path)
+            result.stored = True
 
-    @debug
-    def get_plan_summary(self) -> bool:
-        # Try POST first
-        response: requests.Response = self.session.post(
-            (
-                "https://www.equateplus.com/EquatePlusParticipant2/"
-                "services/planSummary/get"
-            ),
-            params=self.ids(),
-            json={"$type": "Object"},
-            headers={
-                "Referer": (
-                    "https://www.equateplus.com/EquatePlusParticipant2/"
-                ),
-            },
-        )
+        if result.logged_in:
+            if not summary_successful:
+                equateplus.get_plan_summary()
+            details_successful = equateplus.get_plan_details()
+            if download_documents:
+                equateplus.get_documents()
 
-        def _parse_and_store(resp: requests.Response) -> bool:
+        if history is not None and details_successful:
+            history.record(equateplus.username, equateplus.lots)
+            result.changes = history.changes(equateplus.username)
+    # One failing account must not abort a batch
+    except Exception as error:  # pylint: disable=broad-except
+        result.error = repr(error)
+    finally:
+        if logout and not store and not result.cached:
             try:
-                data = resp.json()
-                self.plan_ids = [
-                    plan["id"] for plan in data.get("entries", [])
-                ]
-                return (
-                    not data.get("empty", False)
-                    and len(self.plan_ids) > 0
+                equateplus.logout()
+            except requests.RequestException:
+                pass
+
+    result.positions = equateplus.positions()
+    result.documents = equateplus.documents()
+    result.timings = equateplus.timings()
+    result.plan_timings = dict(equateplus.plan_timings)
+    result.elapsed = perf_counter() - start
+    return result
+
+
+def run_batch(
+    accounts: list[tuple[str, str]],
+    qr_code_path: Path,
+    workers: int,
+    download_documents: bool,
+    history: SnapshotStore | None = None,
+    hosts: tuple[str, ...] = (),
+    **options,
+) -> list[SyncResult]:
+    interaction = InteractionQueue()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures: list[Future] = []
+        for index, (username, password) in enumerate(accounts, start=1):
+            equateplus = EquatePlus(
+                username=username,
+                password=password,
+                qr_code_path=qr_code_path.with_stem(
+                    f"{qr_code_path.stem}_{index}"
+                ),
+                **options,
+            )
+            if hosts:
+                equateplus.hosts = list(hosts)
+            # Only the first account probes, the others start from its host
+            equateplus.select_host()
+            equateplus.otp_prompt = interaction.otp_prompt(username)
+            equateplus.qr_notify = interaction.qr_notify(username)
+            equateplus.documents_dir = (
+                equateplus.documents_dir / username.replace("/", "-")
+            )
+            futures.append(
+                pool.submit(
+                    sync_account,
+                    equateplus,
+                    download_documents,
+                    history,
                 )
-            except (
-                ValueError,
-                requests.exceptions.JSONDecodeError,
-                AttributeError,
-            ):
-                return False
+            )
+        interaction.serve(futures)
+    return [future.result() for future in futures]
+
+
+class Daemon:
+    # Keeps one logged-in session, pings it every keepalive seconds and
+    # syncs every interval seconds or when asked over a unix socket. A
+    # dead session is detected by the login page and logged in again.
+    def __init__(
+        self,
+        equateplus: EquatePlus,
+        interval: float = 3600.0,
+        keepalive: float = 300.0,
+        socket_path: Path | None = None,
+        history: SnapshotStore | None = None,
+        session_path: Path | None = None,
+    ) -> None:
+        self.equateplus: EquatePlus = equateplus
+        self.interval: float = interval
+        self.keepalive: float = keepalive
+        self.socket_path: Path | None = socket_path
+        self.history: SnapshotStore | None = history
+        # Sessions are stored here after each login, if set
+        self.session_path: Path | None = session_path
+        self.logged_in: bool = False
+        self.logins: int = 0
+        self.syncs: int = 0
+        self.last_report: dict | None = None
+        self.stopped: Event = Event()
+        # Set once the socket accepts commands
+        self.ready: Event = Event()
+        self.lock: Lock = Lock()
 
-        if _parse_and_store(response):
+    def ensure_login(self) -> bool:
+        if self.logged_in and not self.equateplus.session_expired:
             return True
+        self.equateplus.session.cookies.clear()
+        self.logins += 1
+        self.logged_in = self.equateplus.login()
+        self.equateplus.session_expired = not self.logged_in
+        if self.logged_in and self.session_path is not None:
+            self.equateplus.save_session(self.session_path)
+        return self.logged_in
 
-        # Fallback to GET
-        response = self.session.get(
-            (
-                "https://www.equateplus.com/EquatePlusParticipant2/"
-                "services/planSummary/get"
-            ),
-            params=self.ids(),
-            headers={
-                "Referer": (
-                    "https://www.equateplus.com/EquatePlusParticipant2/"
-                ),
-            },
-        )
-        return _parse_and_store(response)
+    def fetch(self, report: dict) -> bool:
+        equateplus: EquatePlus = self.equateplus
+        for attempt in range(2):
+            if not self.ensure_login():
+                report["error"] = "login failed"
+                return False
+            equateplus.lots = LotTable()
+            if equateplus.get_plan_summary() and equateplus.get_plan_details():
+                return True
+            # A session that died is logged in again once
+            if attempt or not equateplus.session_expired:
+                return False
+            report["relogin"] = True
+        return False
 
-    @debug
-    def get_plan_details(self) -> bool:
-        for plan_id in self.plan_ids:
-            response: requests.Response = self.session.post(
-                (
-                    "https://www.equateplus.com/EquatePlusParticipant2/"
-                    "services/planDetails/get"
-                ),
-                params=self.ids(),
-                json={
-                    "$type": "EntityIdentifier",
-                    "id": plan_id,
-                },
-                headers={
-                    "Referer": (
-                        "https://www.equateplus.com/EquatePlusParticipant2/"
-                    ),
+    def sync(self) -> dict:
+        with self.lock:
+            start: float = perf_counter()
+            equateplus: EquatePlus = self.equateplus
+            report: dict = {"ok": False, "relogin": False}
+            try:
+                report["ok"] = self.fetch(report)
+                if report["ok"] and self.history is not None:
+                    self.history.record(equateplus.username, equateplus.lots)
+            # One failed sync must not end the daemon, the next one starts
+            # with a fresh login (and host selection)
+            except Exception as error:  # pylint: disable=broad-except
+                report["error"] = repr(error)
+                self.logged_in = False
+            self.syncs += 1
+            report.update(
+                securities={
+                    str(name): amount
+                    for name, amount in equateplus.securities.items()
                 },
+                elapsed=perf_counter() - start,
+                synced=time(),
             )
-            print(".", end="", flush=True)
+            self.last_report = report
+            return report
+
+    def ping(self) -> bool:
+        with self.lock:
+            if not self.logged_in:
+                return False
             try:
-                for plan_groups in response.json()["entries"]:
-                    for plan_details in plan_groups["entries"]:
-                        for value in plan_details["entries"]:
-                            name = get_name(value)
-                            amount = get_amount(value)
-                            if amount is None:
-                                continue
-                            self.securities[name] = (
-                                self.securities.get(name, 0) + amount
-                            )
-            except (KeyError, IndexError):
+                return self.equateplus.keepalive() or self.ensure_login()
+            except requests.RequestException:
+                self.logged_in = False
                 return False
 
-        print(" ", end="", flush=True)
-        return True
+    def status(self) -> dict:
+        return {
+            "logged_in": self.logged_in,
+            "logins": self.logins,
+            "syncs": self.syncs,
+            "session_expired": self.equateplus.session_expired,
+            "requests": self.equateplus.scheduler.stats(),
+            "last": self.last_report,
+        }
 
-    @debug
-    def get_documents(self) -> bool:
-        response: requests.Response = self.session.post(
-            (
-                "https://www.equateplus.com/EquatePlusParticipant2/"
-                "services/documents/library"
-            ),
-            params=self.ids(),
-            json={
-                "$type": "Object",
-            },
-            headers={
-                "Referer": (
-                    "https://www.equateplus.com/EquatePlusParticipant2/"
-                ),
-            },
-        )
-        try:
-            for document in response.json()["documents"]:
-                date: str = datetime.fromisoformat(document["date"]).strftime(
-                    "%d.%m.%Y"
-                )
-                file_name: str = document["description"] + f" ({date}).pdf"
-                file_path: Path = self.documents_dir / file_name.replace(
-                    "/",
-                    "-",
-                )
+    def handle(self, command: str) -> dict:
+        if command == "sync":
+            return self.sync()
+        if command == "status":
+            return self.status()
+        if command == "stop":
+            self.stopped.set()
+            return {"ok": True}
+        return {"error": f"unknown command: {command}"}
 
-                if self.download_document(document["id"], file_path):
-                    print(".", end="", flush=True)
-                else:
-                    print("x", end="", flush=True)
+    def serve_socket(self) -> socketserver.BaseServer:
+        daemon = self
 
-        except (KeyError, IndexError):
-            return False
-        
-        print(" ", end="", flush=True)
-        return True
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                for line in self.rfile:
+                    reply: dict = daemon.handle(line.decode().strip())
+                    self.wfile.write(dumps(reply).encode() + b"\n")
 
-    def download_document(self, document_id: str, file_path: Path) -> bool:
-        response: requests.Response = self.session.get(
-            (
-                "https://www.equateplus.com/EquatePlusParticipant2/"
-                "services/statements/download"
-            ),
-            params={
-                "documentId": document_id,
-                "downloadType": "inline",
-                "source": "LIBRARY",
-            },
-            headers={
-                "Referer": (
-                    "https://www.equateplus.com/EquatePlusParticipant2/"
-                ),
-            },
-        )
-        if response.content.startswith(b"{\"$type\":\"TechnicalError\""):
-            return False
+        self.socket_path.unlink(missing_ok=True)
+        # Bound owner-only, a chmod afterwards leaves a window in which
+        # other local users can connect. Runs before the syncs start, so
+        # no other thread creates files under this umask.
+        previous: int = umask(0o177)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(
+                str(self.socket_path),
+                Handler,
+            )
+        finally:
+            umask(previous)
+        server.daemon_threads = True
+        Thread(target=server.serve_forever, daemon=True).start()
+        return server
 
+    def run(self) -> None:
+        server: socketserver.BaseServer | None = None
+        if self.socket_path is not None:
+            server = self.serve_socket()
+        self.ready.set()
         try:
-            file_path.parent.mkdir(parents=True, exist_ok=True)
-            file_path.write_bytes(response.content)
-        
-        except OSError:
-            return False
+            next_sync: float = perf_counter()
+            next_ping: float = perf_counter() + self.keepalive
+            while not self.stopped.is_set():
+                now: float = perf_counter()
+                if now >= next_sync:
+                    self.sync()
+                    next_sync = perf_counter() + self.interval
+                    next_ping = perf_counter() + self.keepalive
+                elif now >= next_ping:
+                    self.ping()
+                    next_ping = perf_counter() + self.keepalive
+                self.stopped.wait(max(0.0, min(next_sync, next_ping) - now))
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+                self.socket_path.unlink(missing_ok=True)
 
-        return True
 
-    @debug
-    def logout(self) -> None:
-        self.session.get(
-            (
-                "https://www.equateplus.com/EquatePlusParticipant2/"
-                "services/participant/logout"
-            ),
-        )
+def send_command(socket_path: Path, command: str) -> dict:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(str(socket_path))
+        client.sendall(command.encode() + b"\n")
+        return loads(client.makefile("rb").readline())
 
 
 # Path handling
@@ -470,32 +2876,262 @@ SCRIPT_DIR: Path = Path(__file__).resolve().parent
     show_default=True,
 )
 @click.option(
-    "--pickle-path",
+    "--session-path",
     type=Path,
-    default=SCRIPT_DIR / "equateplus.pckl",
+    default=SCRIPT_DIR / "equateplus_session.json",
     show_default=True,
 )
 @click.option("--download-documents", is_flag=True, help="download documents")
+@click.option(
+    "--compress-documents",
+    is_flag=True,
+    help="gzip newly stored documents (names are kept in the manifest only)",
+)
+@click.option(
+    "--verify-documents",
+    is_flag=True,
+    help="check stored documents against their content hash and exit",
+)
+@click.option(
+    "--index-path",
+    type=Path,
+    help="full-text index downloaded documents in this SQLite database",
+)
+@click.option(
+    "--search",
+    help="print documents of the index matching this FTS5 query and exit",
+)
+@click.option(
+    "--search-year",
+    type=int,
+    help="only search documents dated in this year",
+)
 @click.option(
     "--store",
     is_flag=True,
-    help="serialize EquatePlus object to file (and don't logout)",
+    help="save session cookies and tokens to file (and don't logout)",
 )
 @click.option(
     "--restore",
     is_flag=True,
-    help="deserialize EquatePlus object from file (and don't login)",
+    help="reuse saved session (and only login if it expired)",
 )
 @click.option("--no-logout", is_flag=True, help="don't logout")
+@click.option(
+    "--max-parallel",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="maximum number of concurrent planDetails requests and downloads",
+)
+@click.option(
+    "--pace",
+    type=click.FloatRange(min=0),
+    default=0.0,
+    show_default=True,
+    help="delay in seconds after each login and fetch step",
+)
+@click.option(
+    "--qr-timeout",
+    type=click.FloatRange(min=1),
+    default=60.0,
+    show_default=True,
+    help="seconds to wait for the QR code to be confirmed",
+)
+@click.option(
+    "--rate",
+    type=click.FloatRange(min=0, min_open=True),
+    default=10.0,
+    show_default=True,
+    help="requests per second per host, shared by all accounts",
+)
+@click.option(
+    "--burst",
+    type=click.IntRange(min=1),
+    default=10,
+    show_default=True,
+    help="requests per host sent at once before --rate applies",
+)
+@click.option(
+    "--retries",
+    type=click.IntRange(min=0),
+    default=3,
+    show_default=True,
+    help="retries of rate limited, failed or 5xx requests",
+)
+@click.option(
+    "--batch",
+    is_flag=True,
+    help="sync every username/password pair in the credentials file",
+)
+@click.option(
+    "--batch-workers",
+    type=click.IntRange(min=1),
+    default=4,
+    show_default=True,
+    help="number of accounts synced concurrently in batch mode",
+)
+@click.option(
+    "--report-path",
+    type=Path,
+    help="write the batch report as JSON",
+)
+@click.option(
+    "--cache-dir",
+    type=Path,
+    help="cache planSummary/planDetails responses in this directory",
+)
+@click.option(
+    "--cache-ttl",
+    type=click.FloatRange(min=0),
+    default=3600.0,
+    show_default=True,
+    help="seconds a cached response stays valid",
+)
+@click.option(
+    "--cache-size",
+    type=click.IntRange(min=1),
+    default=256,
+    show_default=True,
+    help="maximum number of cached responses",
+)
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="ignore cached responses (and refresh the cache)",
+)
+@click.option(
+    "--history-path",
+    type=Path,
+    help="append each run's positions to this SQLite snapshot store",
+)
+@click.option(
+    "--daemon",
+    is_flag=True,
+    help="stay logged in and sync on a schedule and on socket requests",
+)
+@click.option(
+    "--sync-interval",
+    type=click.FloatRange(min=1),
+    default=3600.0,
+    show_default=True,
+    help="seconds between scheduled syncs in daemon mode",
+)
+@click.option(
+    "--keepalive-interval",
+    type=click.FloatRange(min=1),
+    default=300.0,
+    show_default=True,
+    help="seconds between session keepalive requests in daemon mode",
+)
+@click.option(
+    "--socket-path",
+    type=Path,
+    default=SCRIPT_DIR / "equateplus.sock",
+    show_default=True,
+    help="unix socket of the daemon",
+)
+@click.option(
+    "--send",
+    type=click.Choice(["sync", "status", "stop"]),
+    help="send a command to a running daemon and print its reply",
+)
+@click.option(
+    "--state-path",
+    type=Path,
+    default=SCRIPT_DIR / "equateplus_state.json",
+    show_default=True,
+    help="learned state such as the last good datacenter host",
+)
+@click.option(
+    "--host",
+    "hosts",
+    multiple=True,
+    help="candidate datacenter hosts, fastest healthy one is used",
+)
+@click.option(
+    "--record",
+    "record_path",
+    type=Path,
+    help="record all requests and responses into this directory",
+)
+@click.option(
+    "--replay",
+    "replay_path",
+    type=Path,
+    help="serve recorded responses from this directory (no network)",
+)
+@click.option(
+    "--trace-path",
+    type=Path,
+    help="write request spans as JSON (or Prometheus text for *.prom)",
+)
 def main(
     credentials_path: Path,
     qr_code_path: Path,
-    pickle_path: Path,
+    session_path: Path,
     download_documents: bool,
+    compress_documents: bool,
+    verify_documents: bool,
+    index_path: Path | None,
+    search: str | None,
+    search_year: int | None,
     store: bool,
     restore: bool,
     no_logout: bool,
+    max_parallel: int,
+    pace: float,
+    qr_timeout: float,
+    rate: float,
+    burst: int,
+    retries: int,
+    batch: bool,
+    batch_workers: int,
+    report_path: Path | None,
+    cache_dir: Path | None,
+    cache_ttl: float,
+    cache_size: int,
+    refresh: bool,
+    history_path: Path | None,
+    daemon: bool,
+    sync_interval: float,
+    keepalive_interval: float,
+    socket_path: Path,
+    send: str | None,
+    state_path: Path,
+    hosts: tuple[str, ...],
+    record_path: Path | None,
+    replay_path: Path | None,
+    trace_path: Path | None,
 ) -> None:
+    if not socket_path.is_absolute():
+        socket_path = (SCRIPT_DIR / socket_path).resolve()
+    if send is not None:
+        print(dumps(send_command(socket_path, send), indent=1))
+        return
+    if verify_documents:
+        corrupt: list[str] = []
+        for objects in sorted(DOCUMENTS_DIR.glob("**/.objects")):
+            for digest in DocumentStore(objects.parent).verify():
+                corrupt.append(digest)
+                print(f"corrupt: {objects / digest}")
+        print(f"documents: {len(corrupt)} corrupt")
+        if corrupt:
+            raise SystemExit(1)
+        return
+    document_index: DocumentIndex | None = None
+    if index_path is not None:
+        document_index = DocumentIndex(index_path)
+    if search is not None:
+        if document_index is None:
+            raise click.UsageError("--search needs --index-path")
+        for document_id, date, description, snippet in document_index.search(
+            search,
+            year=search_year,
+        ):
+            print(f"{date[:10]} {document_id} {description}: {snippet}")
+        return
+
     # If a relative path is provided and does not exist in CWD,
     # also check relative to the script directory.
     if not credentials_path.exists():
@@ -508,63 +3144,163 @@ def main(
                 f"Credentials file not found: {credentials_path}"
             )
 
-    # Same handling for QR and pickle paths so artifacts end up in the
+    # Same handling for QR and session paths so artifacts end up in the
     # script directory
     if not qr_code_path.is_absolute():
         qr_code_path = (SCRIPT_DIR / qr_code_path).resolve()
-    if not pickle_path.is_absolute():
-        pickle_path = (SCRIPT_DIR / pickle_path).resolve()
+    if not session_path.is_absolute():
+        session_path = (SCRIPT_DIR / session_path).resolve()
+    if not state_path.is_absolute():
+        state_path = (SCRIPT_DIR / state_path).resolve()
+
+    cache: ResponseCache | None = None
+    if cache_dir is not None:
+        cache = ResponseCache(cache_dir, ttl=cache_ttl, max_entries=cache_size)
+    history: SnapshotStore | None = None
+    if history_path is not None:
+        history = SnapshotStore(history_path)
+    scheduler = RequestScheduler(rate=rate, burst=burst, retries=retries)
+
+    if batch:
+        results: list[SyncResult] = run_batch(
+            read_accounts(credentials_path),
+            qr_code_path,
+            workers=batch_workers,
+            download_documents=download_documents,
+            history=history,
+            max_parallel=max_parallel,
+            pace=pace,
+            qr_timeout=qr_timeout,
+            cache=cache,
+            refresh=refresh,
+            state_path=state_path,
+            compress_documents=compress_documents,
+            document_index=document_index,
+            scheduler=scheduler,
+            hosts=hosts,
+        )
+        reports: list[dict] = [result.to_dict() for result in results]
+        for result in results:
+            status: str = "ok" if result.logged_in else "login failed"
+            if result.error is not None:
+                status = result.error
+            print(f"{result.username}: {status} ({result.elapsed:.1f}s)")
+        print_request_summary(scheduler.stats())
+        if report_path is not None:
+            report_path.write_text(dumps(reports, indent=1))
+        else:
+            from pprint import pprint
+            pprint(reports)
+        return
 
     credentials: list[str] = credentials_path.read_text().strip().split("\n")
     equateplus = EquatePlus(
         username=credentials[0],
         password=credentials[1],
         qr_code_path=qr_code_path,
+        max_parallel=max_parallel,
+        pace=pace,
+        qr_timeout=qr_timeout,
+        cache=cache,
+        refresh=refresh,
+        state_path=state_path,
+        compress_documents=compress_documents,
+        document_index=document_index,
+        scheduler=scheduler,
     )
-    login_successful: bool = False
-    try:
-        if restore:
-            equateplus = loads(pickle_path.read_bytes())
-            print("equateplus restored")
-            login_successful = True
+    if hosts:
+        equateplus.hosts = list(hosts)
+    cassette: Cassette | None = None
+    if record_path is not None:
+        cassette = Cassette(record_path)
+        equateplus.session.hooks["response"].append(cassette.record)
+    if replay_path is not None:
+        # Recorded for one host, nothing to probe or fail over to
+        Cassette.load(replay_path).mount(equateplus.session)
+        equateplus.hosts = [equateplus.host]
+    elif equateplus.select_host() is None:
+        print("equateplus: no healthy datacenter host found")
+    # The daemon logs in again on its own, so it needs them as well
+    attach_cli(equateplus)
 
-        else:
-            login_successful = (
-                equateplus.initialize()
-                and equateplus.send_user()
-                and equateplus.send_credentials()
-                and (
-                    equateplus.skip_equateaccess or (
-                        equateplus.request_devices()
-                        and equateplus.request_qr_code()
-                        and equateplus.verify_qr_code()
-                        and equateplus.complete_login()
-                    )
-                )
-            )
-        
-        if store:
-            if login_successful:
-                pickle_path.write_bytes(dumps(equateplus))
-                print("equateplus stored")
-            else:
-                print("equateplus not stored - login failed")
-
-        if login_successful:
-            equateplus.get_plan_summary()
-            equateplus.get_plan_details()
-            if download_documents:
-                equateplus.get_documents()
+    if daemon:
+        runner = Daemon(
+            equateplus,
+            interval=sync_interval,
+            keepalive=keepalive_interval,
+            socket_path=socket_path,
+            history=history,
+            session_path=session_path if store else None,
+        )
+        runner.logged_in = restore and equateplus.restore_session(session_path)
+        print(f"equateplus daemon listening on {socket_path}")
+        try:
+            runner.run()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if not store and not no_logout:
+                equateplus.logout()
+            if trace_path is not None:
+                equateplus.tracer.export(trace_path)
+        return
 
+    try:
+        result = sync_account(
+            equateplus,
+            download_documents=download_documents,
+            history=history,
+            session_path=session_path,
+            restore=restore,
+            store=store,
+            logout=not no_logout,
+        )
     finally:
-        if not store and not no_logout:
-            equateplus.logout()
+        if trace_path is not None:
+            equateplus.tracer.export(trace_path)
+        if cassette is not None:
+            cassette.save()
+
+    if result.cached:
+        print("equateplus served from cache")
+    elif result.restored:
+        print("equateplus restored")
+    elif restore:
+        print("equateplus session expired")
+    if store:
+        if result.stored:
+            print("equateplus stored")
         else:
-            print("equateplus not logged out")
+            print("equateplus not stored - login failed")
+    for plan_id in equateplus.plan_ids:
+        if plan_id in result.plan_timings:
+            print(f"  plan {plan_id}: {result.plan_timings[plan_id]:.3f}s")
+    if download_documents and result.logged_in:
+        print_document_summary(equateplus.document_results)
+        if equateplus.document_store is not None:
+            print(
+                "document store: "
+                f"{equateplus.document_store.written} written, "
+                f"{equateplus.document_store.deduplicated} deduplicated"
+            )
+        if document_index is not None:
+            print(
+                f"index: {document_index.indexed_count} indexed, "
+                f"{len(document_index.without_text)} without text"
+            )
+    if result.changes is not None:
+        print_changes(result.changes)
+    if not result.cached and (store or no_logout):
+        print("equateplus not logged out")
+    if cache is not None:
+        print(f"cache: {cache.hits} hits, {cache.misses} misses")
+    print_strategy_summary(equateplus.tracer.counters)
+    print_request_summary(scheduler.stats())
+    if result.error is not None:
+        raise click.ClickException(result.error)
 
     from pprint import pprint
-    pprint(equateplus.securities)
-
+    pprint(result.securities)
 
 if __name__ == "__main__":
     # click decorates `main` and supplies arguments at runtime.
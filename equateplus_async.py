@@ -0,0 +1,470 @@
+"""
+Asynchronous EquatePlus client
+
+Runs the same steps as equateplus.EquatePlus on an httpx.AsyncClient, so a
+single event loop can drive many logins and fetches concurrently. Token
+extraction and response parsing are shared with the synchronous client.
+"""
+import asyncio
+from base64 import b64decode
+from pathlib import Path
+from time import perf_counter
+from typing import Awaitable, Callable
+from urllib.parse import urlencode
+
+import httpx
+
+from equateplus import (
+    DOCUMENTS_DIR,
+    DOWNLOAD_CHUNK_SIZE,
+    OTP_MARKERS,
+    PLAN_DETAILS_ERRORS,
+    DocumentIndex,
+    DocumentStore,
+    LotTable,
+    QR_FINAL_STATUSES,
+    TECHNICAL_ERROR,
+    document_file_names,
+    extract_csrf,
+    is_login_redirect,
+    is_synced,
+    is_technical_error,
+    is_text_content,
+    load_manifest,
+    parse_plan_summary,
+    poll_delays,
+    random_digits,
+    discard_part,
+    part_paths,
+    resume_offset,
+    resumes,
+    start_part,
+    save_manifest,
+)
+
+
+def without_none(values: dict) -> dict:
+    # requests drops None values from params and forms, httpx sends ""
+    return {key: value for key, value in values.items() if value is not None}
+
+
+class AsyncEquatePlus:
+    def __init__(
+        self,
+        username: str,
+        password: str,
+        qr_code_path: Path,
+        otp_prompt: Callable[[], Awaitable[str]] | None = None,
+        max_parallel: int = 4,
+        download_attempts: int = 3,
+        qr_timeout: float = 60.0,
+        compress_documents: bool = False,
+        document_index: DocumentIndex | None = None,
+    ) -> None:
+        self.username: str = username
+        self.password: str = password
+        self.qr_code_path: Path = qr_code_path
+        # Called for each SMS code attempt
+        self.otp_prompt: Callable[[], Awaitable[str]] | None = otp_prompt
+        self.max_parallel: int = max_parallel
+        self.download_attempts: int = download_attempts
+        self.qr_timeout: float = qr_timeout
+        self.documents_dir: Path = DOCUMENTS_DIR
+        self.compress_documents: bool = compress_documents
+        self.document_store: DocumentStore | None = None
+        self.document_index: DocumentIndex | None = document_index
+        self.host: str = "https://www.equateplus.com"
+
+        self.client: httpx.AsyncClient = httpx.AsyncClient(
+            headers={"Accept": "*/*"},
+            event_hooks={"response": [self.set_csrf]},
+            follow_redirects=True,
+            timeout=60.0,
+        )
+        self.csrf: str | None = None
+        self.device_id: str | None = None
+        self.session_id: str | None = None
+        self.cid: str = "eqp." + str(random_digits(7))
+        self.plan_ids: list[str] = []
+        self.securities: dict[str, float] = {}
+        self.lots: LotTable = LotTable()
+        self.plan_timings: dict[str, float] = {}
+        self.document_results: dict[str, tuple[Path, bool, int]] = {}
+        self.gauges: dict[str, float] = {}
+        self.skip_equateaccess: bool = False
+        self.session_expired: bool = False
+
+    async def __aenter__(self) -> "AsyncEquatePlus":
+        return self
+
+    async def __aexit__(self, *_exc_info) -> None:
+        await self.client.aclose()
+
+    def url(self, path: str = "") -> str:
+        return f"{self.host}/EquatePlusParticipant2/{path}"
+
+    def login_url(self, params: dict) -> str:
+        # httpx replaces the ?login query when given params=, requests
+        # appends to it
+        return self.url("?login&" + urlencode(without_none(params)))
+
+    async def set_csrf(self, response: httpx.Response) -> None:
+        if not is_text_content(response.headers.get("Content-Type")):
+            return
+        await response.aread()
+        tokens: dict[str, tuple[str, str]] = extract_csrf(response.content)
+        if "csrf" in tokens:
+            self.csrf = tokens["csrf"][0]
+            self.client.headers["csrfpId"] = self.csrf
+        if "csrf2" in tokens:
+            self.client.headers["EQUATE-CSRF2-TOKEN-PARTICIPANT2"] = (
+                tokens["csrf2"][0]
+            )
+
+    def ids(self) -> dict[str, str]:
+        return {
+            "_cId": self.cid,
+            "_rId": str(random_digits(8)),
+        }
+
+    async def login(self) -> bool:
+        return (
+            await self.initialize()
+            and await self.send_user()
+            and await self.send_credentials()
+            and (
+                self.skip_equateaccess or (
+                    await self.request_devices()
+                    and await self.request_qr_code()
+                    and await self.verify_qr_code()
+                    and await self.complete_login()
+                )
+            )
+        )
+
+    async def initialize(self) -> bool:
+        response: httpx.Response = await self.client.get(self.url("?login"))
+        return b"isiwebuserid" in response.content
+
+    async def send_user(self) -> bool:
+        response: httpx.Response = await self.client.post(
+            self.login_url({"csrfpId": self.csrf}),
+            data=without_none({
+                "csrfpId": self.csrf,
+                "isiwebuserid": self.username,
+                "result": "Continue Login",
+            }),
+        )
+        return b"isiwebpasswd" in response.content
+
+    async def send_credentials(self) -> bool:
+        response: httpx.Response = await self.client.post(
+            self.url("?login"),
+            data=without_none({
+                "csrfpId": self.csrf,
+                "isiwebuserid": self.username,
+                "isiwebpasswd": self.password,
+                "result": "Continue",
+            }),
+        )
+        if any(m in response.content for m in OTP_MARKERS):
+            if self.otp_prompt is None:
+                return False
+            for _ in range(3):
+                code: str = await self.otp_prompt()
+                verify: httpx.Response = await self.client.post(
+                    self.url("?login"),
+                    data=without_none({
+                        "csrfpId": self.csrf,
+                        "otpCode": code,
+                        "result": "verify",
+                    }),
+                )
+                if b'id="otpCodeId"' in verify.content:
+                    continue
+                ok = await self.complete_login()
+                self.skip_equateaccess = ok
+                return ok
+            return False
+
+        return b"EquateAccess app" in response.content
+
+    async def request_devices(self) -> bool:
+        response: httpx.Response = await self.client.post(
+            self.url("?login"),
+            data={
+                "isiwebuserid": self.username,
+                "isiwebpasswd": "null",
+                "result": "null",
+            },
+        )
+        try:
+            self.device_id = response.json()["dispatchTargets"][0]["id"]
+            return True
+        except (KeyError, IndexError):
+            return False
+
+    async def request_qr_code(self) -> bool:
+        response: httpx.Response = await self.client.get(
+            self.login_url({
+                "o.dispatchTargetId.v": self.device_id,
+                **self.ids(),
+            }),
+        )
+        try:
+            data = response.json()
+            self.qr_code_path.write_bytes(
+                b64decode(data["dispatcherInformation"]["response"] + "==")
+            )
+            self.session_id = data["sessionId"]
+            return True
+        except (KeyError, IndexError):
+            return False
+
+    async def verify_qr_code(self) -> bool:
+        start: float = perf_counter()
+        deadline: float = start + self.qr_timeout
+        polls: int = 0
+        result: str | None = None
+        for delay in poll_delays():
+            remaining: float = deadline - perf_counter()
+            if remaining <= 0:
+                break
+            await asyncio.sleep(min(delay, remaining))
+            response: httpx.Response = await self.client.get(
+                self.login_url({
+                    "o.fidoUafSessionId.v": self.session_id,
+                    **self.ids(),
+                }),
+            )
+            polls += 1
+            try:
+                result = response.json()["status"]
+            except (KeyError, IndexError):
+                break
+            if result in QR_FINAL_STATUSES:
+                break
+
+        self.gauges["qr_polls"] = polls
+        self.gauges.pop("qr_time_to_approval_seconds", None)
+        if result == "succeeded":
+            self.gauges["qr_time_to_approval_seconds"] = perf_counter() - start
+        return result == "succeeded"
+
+    async def complete_login(self) -> bool:
+        response: httpx.Response = await self.client.post(
+            self.url("?login"),
+            data={"result": "Continue"},
+        )
+        return b"TopLoaderSkeleton" in response.content
+
+    async def get_plan_summary(self) -> bool:
+        self.session_expired = False
+        for method, kwargs in (
+            ("POST", {"json": {"$type": "Object"}}),
+            ("GET", {}),
+        ):
+            response: httpx.Response = await self.client.request(
+                method,
+                self.url("services/planSummary/get"),
+                params=self.ids(),
+                headers={"Referer": self.url()},
+                **kwargs,
+            )
+            if is_login_redirect(response.content):
+                self.session_expired = True
+                continue
+            summary = parse_plan_summary(response.content)
+            if summary is None:
+                continue
+            self.plan_ids, ok = summary
+            if ok:
+                return True
+        return False
+
+    async def fetch_plan_details(
+        self,
+        plan_id: str,
+        semaphore: asyncio.Semaphore,
+    ) -> httpx.Response:
+        async with semaphore:
+            start: float = perf_counter()
+            response: httpx.Response = await self.client.post(
+                self.url("services/planDetails/get"),
+                params=self.ids(),
+                json={
+                    "$type": "EntityIdentifier",
+                    "id": plan_id,
+                },
+                headers={"Referer": self.url()},
+            )
+            self.plan_timings[plan_id] = perf_counter() - start
+            return response
+
+    async def get_plan_details(self) -> bool:
+        self.session_expired = False
+        semaphore = asyncio.Semaphore(max(1, self.max_parallel))
+        responses: list[httpx.Response] = await asyncio.gather(*(
+            self.fetch_plan_details(plan_id, semaphore)
+            for plan_id in self.plan_ids
+        ))
+        # gather keeps plan order, so the sums are deterministic
+        ok: bool = True
+        for plan_id, response in zip(self.plan_ids, responses):
+            lots = LotTable()
+            try:
+                lots.add_plan(plan_id, response.json())
+            except PLAN_DETAILS_ERRORS:
+                # A dead session answers with the login page
+                self.session_expired = is_login_redirect(response.content)
+                ok = False
+                break
+            self.lots.extend(lots)
+        self.securities = self.lots.quantities()
+        return ok
+
+    async def get_documents(self) -> bool:
+        response: httpx.Response = await self.client.post(
+            self.url("services/documents/library"),
+            params=self.ids(),
+            json={"$type": "Object"},
+            headers={"Referer": self.url()},
+        )
+        manifest: dict[str, dict] = load_manifest(self.documents_dir)
+        store = self.document_store = DocumentStore(
+            self.documents_dir,
+            compress=self.compress_documents,
+        )
+        semaphore = asyncio.Semaphore(max(1, self.max_parallel))
+        downloads: list[tuple[dict, Path]] = []
+        try:
+            documents: list[dict] = response.json()["documents"]
+            names: dict[str, str] = document_file_names(documents)
+            for document in documents:
+                file_path: Path = self.documents_dir / names[document["id"]]
+                entry: dict | None = manifest.get(document["id"])
+                if is_synced(entry, document, file_path, store):
+                    self.document_results[document["id"]] = (
+                        file_path,
+                        True,
+                        0,
+                    )
+                    continue
+                downloads.append((document, file_path))
+        except (KeyError, IndexError):
+            return False
+
+        results: list[tuple[bool, int]] = await asyncio.gather(*(
+            self.download_document_with_retry(
+                document["id"],
+                store.incoming(f"{document['id']}.pdf"),
+                semaphore,
+            )
+            for document, _ in downloads
+        ))
+        for (document, file_path), (ok, attempts) in zip(downloads, results):
+            self.document_results[document["id"]] = (file_path, ok, attempts)
+            if not ok:
+                continue
+            incoming: Path = store.incoming(f"{document['id']}.pdf")
+            size: int = incoming.stat().st_size
+            digest: str = await asyncio.to_thread(store.add, incoming)
+            store.link(digest, file_path)
+            manifest[document["id"]] = {
+                "date": document["date"],
+                "file": file_path.name,
+                "size": size,
+                "sha256": digest,
+            }
+
+        save_manifest(self.documents_dir, manifest)
+        if self.document_index is not None:
+            await asyncio.to_thread(
+                self.document_index.update,
+                documents,
+                manifest,
+                store,
+            )
+        return True
+
+    async def download_document_with_retry(
+        self,
+        document_id: str,
+        file_path: Path,
+        semaphore: asyncio.Semaphore,
+    ) -> tuple[bool, int]:
+        for attempt in range(1, self.download_attempts + 1):
+            try:
+                async with semaphore:
+                    if await self.download_document(document_id, file_path):
+                        return True, attempt
+            except httpx.HTTPError:
+                pass
+            if attempt < self.download_attempts:
+                await asyncio.sleep(0.5 * attempt)
+        return False, self.download_attempts
+
+    async def download_document(
+        self,
+        document_id: str,
+        file_path: Path,
+    ) -> bool:
+        # Same .part file and If-Range resume as
+        # EquatePlus.download_document
+        part_path, validator_path = part_paths(file_path)
+        offset, validator = resume_offset(part_path, validator_path)
+        headers: dict[str, str] = {"Referer": self.url()}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = validator
+        async with self.client.stream(
+            "GET",
+            self.url("services/statements/download"),
+            params={
+                "documentId": document_id,
+                "downloadType": "inline",
+                "source": "LIBRARY",
+            },
+            headers=headers,
+        ) as response:
+            if response.status_code == 416:
+                discard_part(part_path, validator_path)
+                return False
+            if not response.is_success:
+                return False
+            if response.status_code == 206:
+                if not resumes(
+                    response.status_code,
+                    response.headers.get("Content-Range"),
+                    offset,
+                ):
+                    discard_part(part_path, validator_path)
+                    return False
+            else:
+                offset = 0
+            chunks = response.aiter_bytes(DOWNLOAD_CHUNK_SIZE)
+            head: bytes = b""
+            if offset == 0:
+                async for chunk in chunks:
+                    head += chunk
+                    if len(head) >= len(TECHNICAL_ERROR):
+                        break
+                if is_technical_error(head):
+                    return False
+
+            try:
+                if offset == 0:
+                    start_part(part_path, validator_path, response.headers)
+                with part_path.open("ab" if offset else "wb") as file:
+                    await asyncio.to_thread(file.write, head)
+                    async for chunk in chunks:
+                        await asyncio.to_thread(file.write, chunk)
+                part_path.replace(file_path)
+                validator_path.unlink(missing_ok=True)
+            except OSError:
+                return False
+
+        return True
+
+    async def logout(self) -> None:
+        await self.client.get(self.url("services/participant/logout"))
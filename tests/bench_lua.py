@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Benchmark EquatePlus.lua's RefreshAccount and FetchStatements in lupa.
+
+Reports CPU time and KiB allocated per call with the MoneyMoney API
+stubbed by LuaHarness, so a change to the extension can be compared
+with another version of it, e.g. one from `git show HEAD:EquatePlus.lua`.
+"""
+import json
+from pathlib import Path
+
+import click
+
+from lua_harness import EXTENSION, LuaHarness
+from standin import StandIn
+
+FUNCTIONS = ("RefreshAccount", "FetchStatements")
+
+
+def measure(source: Path, config: dict, repeat: int) -> dict:
+    standin = StandIn(**config)
+    standin.server.server_close()
+    harness = LuaHarness(standin, source)
+    arguments = {
+        "RefreshAccount": ({}, 0),
+        "FetchStatements": ({}, harness.lua.table()),
+    }
+    result = {}
+    for function in FUNCTIONS:
+        # The first call decodes and caches the JSON bodies
+        harness.run(function, *arguments[function])
+        runs = [
+            harness.run(function, *arguments[function])
+            for _ in range(repeat)
+        ]
+        # Best of n for the time, allocations are deterministic
+        result[function] = {
+            "seconds": min(seconds for seconds, _ in runs),
+            "kib": min(kib for _, kib in runs),
+        }
+    return result
+
+
+@click.command()
+@click.option("--plans", default=20, show_default=True)
+@click.option("--lots", default=50, show_default=True)
+@click.option("--documents", default=50, show_default=True)
+@click.option("--document-size", default=64 * 1024, show_default=True)
+@click.option("--repeat", default=5, show_default=True)
+@click.option("--source", type=Path, default=EXTENSION, show_default=True)
+@click.option("--baseline", type=Path, help="other EquatePlus.lua to compare")
+@click.option("--output", type=Path, help="write results as JSON")
+def main(
+    plans: int,
+    lots: int,
+    documents: int,
+    document_size: int,
+    repeat: int,
+    source: Path,
+    baseline: Path | None,
+    output: Path | None,
+) -> None:
+    config = {
+        "plans": plans,
+        "lots": lots,
+        "documents": documents,
+        "document_size": document_size,
+    }
+    results = {"source": measure(source, config, repeat)}
+    if baseline is not None:
+        results["baseline"] = measure(baseline, config, repeat)
+    for name, result in results.items():
+        for function, metrics in result.items():
+            print(
+                f"{name:>8} {function:>15}: "
+                f"{metrics['seconds'] * 1000:8.2f} ms "
+                f"{metrics['kib']:10.1f} KiB"
+            )
+    if output is not None:
+        results["config"] = config
+        output.write_text(json.dumps(results, indent=1))
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
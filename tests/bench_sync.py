@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""Benchmark a full EquatePlus sync against the local stand-in server.
+
+Reports wall time, request count and peak Python memory for login, plan
+summary/details and document download. The server runs in a separate
+process so its allocations do not count. With --baseline, exits non-zero
+when a metric regressed by more than --tolerance.
+"""
+import json
+import multiprocessing
+import sys
+import tracemalloc
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import click
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from equateplus import EquatePlus  # noqa: E402
+from standin import StandIn  # noqa: E402
+
+# Metrics compared against the baseline; wall times vary most
+REGRESSION_METRICS = ("sync_seconds", "requests", "peak_bytes")
+
+
+def serve(config: dict, urls: multiprocessing.Queue) -> None:
+    standin = StandIn(**config)
+    urls.put(standin.url)
+    standin.server.serve_forever()
+
+
+def run_sync(url: str, config: dict, max_parallel: int) -> dict:
+    with TemporaryDirectory() as temp_dir:
+        equateplus = EquatePlus(
+            username=config["username"],
+            password=config["password"],
+            qr_code_path=Path(temp_dir) / "qr.png",
+            max_parallel=max_parallel,
+        )
+        equateplus.host = url
+        equateplus.hosts = [url]
+        equateplus.documents_dir = Path(temp_dir) / "documents"
+
+        tracemalloc.start()
+        start = perf_counter()
+        assert equateplus.login(), "login failed"
+        login_done = perf_counter()
+        assert equateplus.get_plan_summary(), "planSummary failed"
+        assert equateplus.get_plan_details(), "planDetails failed"
+        assert equateplus.get_documents(), "documents failed"
+        end = perf_counter()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        requests = len(equateplus.tracer.spans)
+        equateplus.logout()
+
+    return {
+        "login_seconds": login_done - start,
+        "sync_seconds": end - login_done,
+        "wall_seconds": end - start,
+        "requests": requests,
+        "peak_bytes": peak,
+    }
+
+
+@click.command()
+@click.option("--plans", default=20, show_default=True)
+@click.option("--lots", default=50, show_default=True)
+@click.option("--documents", default=50, show_default=True)
+@click.option("--document-size", default=256 * 1024, show_default=True)
+@click.option("--latency", default=0.02, show_default=True)
+@click.option("--max-parallel", default=4, show_default=True)
+@click.option("--repeat", default=3, show_default=True)
+@click.option("--output", type=Path, help="write results as JSON")
+@click.option("--baseline", type=Path, help="JSON results to compare with")
+@click.option("--tolerance", default=0.2, show_default=True)
+def main(
+    plans: int,
+    lots: int,
+    documents: int,
+    document_size: int,
+    latency: float,
+    max_parallel: int,
+    repeat: int,
+    output: Path | None,
+    baseline: Path | None,
+    tolerance: float,
+) -> None:
+    config = {
+        "plans": plans,
+        "lots": lots,
+        "documents": documents,
+        "document_size": document_size,
+        "latency": latency,
+        "pending_polls": 0,
+        "username": "user",
+        "password": "secret",
+    }
+    urls: multiprocessing.Queue = multiprocessing.Queue()
+    server = multiprocessing.Process(
+        target=serve,
+        args=(config, urls),
+        daemon=True,
+    )
+    server.start()
+    try:
+        url = urls.get(timeout=10)
+        runs = [run_sync(url, config, max_parallel) for _ in range(repeat)]
+    finally:
+        server.terminate()
+
+    # Best of n for timings, the other metrics are deterministic
+    result = {
+        key: min(run[key] for run in runs)
+        for key in runs[0]
+    }
+    result["config"] = {**config, "max_parallel": max_parallel}
+    for key, value in result.items():
+        if isinstance(value, float):
+            print(f"{key:>14}: {value:.3f}")
+        elif key != "config":
+            print(f"{key:>14}: {value}")
+    if output is not None:
+        output.write_text(json.dumps(result, indent=1))
+
+    if baseline is not None:
+        reference = json.loads(baseline.read_text())
+        regressions = [
+            f"{key}: {result[key]} > {reference[key]} (+{tolerance:.0%})"
+            for key in REGRESSION_METRICS
+            if result[key] > reference[key] * (1 + tolerance)
+        ]
+        for regression in regressions:
+            print("REGRESSION", regression)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()  # pylint: disable=no-value-for-parameter
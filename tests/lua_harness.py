@@ -0,0 +1,212 @@
+"""Runs EquatePlus.lua outside MoneyMoney.
+
+Loads the extension into lupa with the MoneyMoney API it uses stubbed
+out (Connection, JSON, HTML, MM, WebBanking) and answers its requests
+from the StandIn fixtures in-process, so RefreshAccount and
+FetchStatements can be timed and checked without a server.
+"""
+import json
+from pathlib import Path
+from urllib.parse import parse_qs, urlsplit
+
+try:
+    from lupa.lua54 import LuaRuntime
+except ImportError:  # older lupa without versioned modules
+    from lupa import LuaRuntime
+
+from standin import LOGIN_PAGE, StandIn
+
+EXTENSION = Path(__file__).parent.parent / "EquatePlus.lua"
+
+# InitializeSession2 sets these up during login, which the harness skips
+SESSION_STATE = (
+    ("local connection\n", "local connection = Connection()\n"),
+    ("local debugging=true\n", "local debugging=false\n"),
+    ("local cummulate=false\n", "local cummulate=true\n"),
+)
+
+STUBS = """
+local respond, decode, output = ...
+
+function Connection()
+  return {
+    request = function(self, method, url, body, contentType, headers)
+      return respond(method, url, body, headers)
+    end,
+  }
+end
+
+function JSON(content)
+  return {
+    dictionary = function(self)
+      return decode(content)
+    end,
+  }
+end
+
+function HTML(content)
+  return {
+    xpath = function(self, query)
+      return {length = function() return 0 end}
+    end,
+  }
+end
+
+MM = {
+  sleep = function(seconds) end,
+  printStatus = function(...) end,
+  localizeDate = function(timestamp) return os.date("%d.%m.%Y", timestamp) end,
+}
+
+function WebBanking(info) end
+ProtocolWebBanking = "WebBanking"
+AccountTypePortfolio = "AccountTypePortfolio"
+
+function print(...)
+  local parts = {}
+  for i = 1, select("#", ...) do
+    parts[i] = tostring(select(i, ...))
+  end
+  output(table.concat(parts, "\\t"))
+end
+"""
+
+# Times a call and counts the KiB it allocates, with the collector
+# stopped so nothing allocated is freed before it is counted
+MEASURE = """
+return function(fn, ...)
+  collectgarbage("collect")
+  collectgarbage("stop")
+  local before = collectgarbage("count")
+  local started = os.clock()
+  fn(...)
+  local elapsed = os.clock() - started
+  local allocated = collectgarbage("count") - before
+  collectgarbage("restart")
+  return elapsed, allocated
+end
+"""
+
+# Statement PDFs are binary and cannot cross back into Python as str
+STATEMENTS = """
+return function(knownIdentifiers)
+  local result = {}
+  for i, statement in ipairs(FetchStatements({}, knownIdentifiers).statements) do
+    result[i] = {
+      identifier = statement.identifier,
+      name = statement.name,
+      filename = statement.filename,
+      creationDate = statement.creationDate,
+      size = #statement.pdf,
+      head = statement.pdf:sub(1, 8),
+    }
+  end
+  return result
+end
+"""
+
+
+class LuaHarness:
+    def __init__(self, standin: StandIn, source: Path = EXTENSION) -> None:
+        self.standin = standin
+        self.requests: dict[str, int] = {}
+        # Bodies and MIME types served instead of the fixtures, by path
+        self.pages: dict[str, tuple[str | bytes, str]] = {}
+        self.headers: dict[str, str] = {}
+        self.output: list[str] = []
+        self.bodies: dict[tuple[str, str | None], str] = {}
+        self.decoded: dict[str, object] = {}
+
+        self.lua = LuaRuntime(unpack_returned_tuples=True)
+        self.lua.execute(STUBS, self.respond, self.decode, self.output.append)
+        text = Path(source).read_text()
+        for line, replacement in SESSION_STATE:
+            assert line in text, f"{source} has no {line.strip()!r}"
+            text = text.replace(line, replacement, 1)
+        self.lua.execute(text)
+        self.measure = self.lua.execute(MEASURE)
+        self.fetch_statements = self.lua.execute(STATEMENTS)
+        # GETs a page and drops the body, which may be binary
+        self.connect = self.lua.eval(
+            'function(path) connectWithCSRF("GET", path) end'
+        )
+
+    def respond(self, method: str, url: str, body: str | None, headers):
+        self.headers = dict(headers.items()) if headers else {}
+        parts = urlsplit(url)
+        if parts.path in self.pages:
+            content, mime_type = self.pages[parts.path]
+            return content, None, mime_type, None, {}
+        name = parts.path.partition("/services/")[2]
+        self.requests[name] = self.requests.get(name, 0) + 1
+        standin = self.standin
+        if (name, body) in self.bodies:
+            return self.bodies[name, body], "UTF-8", "application/json", None, {}
+        if name in ("planSummary/get", "planDetails/get", "user/get",
+                    "documents/library"):
+            if name == "planSummary/get":
+                data = {
+                    "entries": [{"id": plan_id} for plan_id in standin.plan_ids()],
+                    "empty": standin.plans == 0,
+                }
+            elif name == "planDetails/get":
+                data = standin.plan_details(json.loads(body)["id"])
+            elif name == "user/get":
+                data = {"companyId": "ACME"}
+            else:
+                data = standin.library()
+            # Built once per request so repeated runs time the extension only
+            self.bodies[name, body] = json.dumps(data)
+            return self.bodies[name, body], "UTF-8", "application/json", None, {}
+        if name == "statements/download":
+            document_id = parse_qs(parts.query)["documentId"][0]
+            content = standin.document(document_id)
+            return content, None, "application/pdf", None, {}
+        if name == "participant/logout":
+            return "", "UTF-8", "text/html", None, {}
+        page = LOGIN_PAGE.format(csrf=standin.csrf)
+        return page, "UTF-8", "text/html", None, {}
+
+    def decode(self, content: str):
+        # Likewise decoded once per body
+        if content not in self.decoded:
+            self.decoded[content] = self.lua.table_from(
+                json.loads(content),
+                recursive=True,
+            )
+        return self.decoded[content]
+
+    def refresh_account(self) -> list[dict]:
+        securities = self.lua.globals().RefreshAccount({}, 0).securities
+        # Merged lots are also keyed by name, the list part is the result
+        return [
+            dict(securities[index].items())
+            for index in range(1, len(securities) + 1)
+        ]
+
+    def statements(self, known: tuple[str, ...] = ()) -> list[dict]:
+        known = self.lua.table_from({identifier: True for identifier in known})
+        return [
+            dict(statement.items())
+            for statement in self.fetch_statements(known).values()
+        ]
+
+    def tokens_after(
+        self,
+        content: str | bytes,
+        mime_type: str = "text/html;charset=UTF-8",
+        path: str = "/EquatePlusParticipant2/page",
+    ) -> tuple[str | None, str | None]:
+        """csrfpId and CSRF2 tokens sent once the extension read content."""
+        self.pages[path] = (content, mime_type)
+        self.connect(path)
+        self.pages["/next"] = ("", "text/plain")
+        self.connect("/next")
+        return (
+            self.headers.get("csrfpId"),
+            self.headers.get("EQUATE-CSRF2-TOKEN-PARTICIPANT2"),
+        )
+
+    def run(self, function: str, *args) -> tuple[float, float]:
+        """Seconds of CPU time and KiB allocated by one call of function."""
+        return self.measure(self.lua.globals()[function], *args)
@@ -0,0 +1,414 @@
+"""Local stand-in for the EquatePlus participant site.
+
+Emulates the ?login flow (CSRF tokens, SMS OTP page, dispatchTargets,
+FIDO status transitions) and the planSummary, planDetails,
+documents/library and statements/download services, with configurable
+latency, plan count, library size and injected service failures.
+"""
+import json
+import threading
+import time
+from base64 import b64encode
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from secrets import token_hex
+from urllib.parse import parse_qs, urlsplit
+
+LOGIN_PAGE = (
+    '<html><body><div class="eqp-login-application">'
+    '<form id="loginForm" action="?login" method="post">'
+    '<input id="eqUserId" name="isiwebuserid" value="">'
+    '<input id="submitField" name="result" value="">'
+    "</form>"
+    '<script>csrfRegisterAjax("csrfpId", "{csrf}");</script>'
+    "</div></body></html>"
+)
+PASSWORD_PAGE = (
+    '<html><body><form id="loginForm" action="?login">'
+    '<input type="password" name="isiwebpasswd">'
+    '<script>csrfRegisterAjax("csrfpId", "{csrf}");</script>'
+    "</form></body></html>"
+)
+OTP_PAGE = (
+    '<html><body><form id="loginForm" action="?login">'
+    '<p>Security Step Code</p>'
+    '<input id="otpCodeId" class="otpCodeSms" name="otpCode">'
+    '<script>csrfRegisterAjax("csrfpId", "{csrf}");</script>'
+    "</form></body></html>"
+)
+EQUATEACCESS_PAGE = (
+    "<html><body>Please confirm with the EquateAccess app"
+    '<script>csrfRegisterAjax("csrfpId", "{csrf}");</script>'
+    "</body></html>"
+)
+HOME_PAGE = (
+    '<html><body><div id="TopLoaderSkeleton"></div>'
+    '<script>var config = {{"user":"x","equateCsrfToken2":"{csrf2}",'
+    '"locale":"en"}};</script></body></html>'
+)
+# 1x1 PNG, served base64 encoded without padding like EquatePlus does
+QR_PNG = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000154a24f5d0000000049454e44"
+    "ae426082"
+)
+
+
+class StandIn:
+    def __init__(
+        self,
+        plans: int = 3,
+        lots: int = 4,
+        documents: int = 5,
+        document_size: int = 64 * 1024,
+        latency: float = 0.0,
+        otp: bool = False,
+        pending_polls: int = 2,
+        username: str = "user",
+        password: str = "secret",
+        otp_code: str = "123456",
+        summary_methods: tuple[str, ...] = ("POST", "GET"),
+        otp_accounts: dict[str, str] | None = None,
+    ) -> None:
+        self.plans = plans
+        self.lots = lots
+        self.documents = documents
+        self.document_size = document_size
+        self.latency = latency
+        self.otp = otp
+        self.pending_polls = pending_polls
+        self.username = username
+        self.password = password
+        # Further accounts that always log in with the SMS code, by username
+        self.otp_accounts = dict(otp_accounts or {})
+        self.otp_code = otp_code
+        # planSummary/get answers only these methods, like some hosts
+        self.summary_methods = summary_methods
+        # Status and headers answered instead of a service, by service name
+        self.failures: dict[str, list[tuple[int, dict[str, str]]]] = {}
+        # Downloads that break off halfway, and the Range headers received
+        self.interrupted_downloads = 0
+        self.ranges: list[str] = []
+        # Range requests answered with a 206 from the start of the document
+        self.misaligned_ranges = 0
+
+        self.csrf = token_hex(8)
+        self.csrf2 = token_hex(8)
+        self.sessions: dict[str, dict] = {}
+        self.requests: dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.thread: threading.Thread | None = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StandIn":
+        self.thread = threading.Thread(
+            target=self.server.serve_forever,
+            daemon=True,
+        )
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> "StandIn":
+        return self.start()
+
+    def __exit__(self, *_exc_info) -> None:
+        self.stop()
+
+    def handler(self) -> type:
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *_args) -> None:
+                pass
+
+            def do_GET(self) -> None:
+                standin.dispatch(self, "GET")
+
+            def do_POST(self) -> None:
+                standin.dispatch(self, "POST")
+
+        return Handler
+
+    # Fixtures
+
+    def plan_ids(self) -> list[str]:
+        return [f"PLAN{index:03d}" for index in range(self.plans)]
+
+    def plan_details(self, plan_id: str) -> dict:
+        index = int(plan_id[4:])
+        return {
+            "$type": "PlanDetails",
+            "name": f"Plan {index}",
+            "entries": [{
+                "entries": [{
+                    "marketName": "XETRA",
+                    "marketPrice": {"amount": 42.5, "unit": {"code": "EUR"}},
+                    "canTrade": True,
+                    "entries": [
+                        {
+                            "VEHICLE": f"Security {index % 2}",
+                            "QUANTITY": {"amount": 1.0 + lot},
+                            "PURCHASE_PRICE": {
+                                "amount": 10.0 + lot,
+                                "unit": {"code": "EUR"},
+                            },
+                            "ALLOC_DATE": {
+                                "date": f"2020-{lot % 12 + 1:02d}-15"
+                                "T00:00:00.000",
+                            },
+                        }
+                        for lot in range(self.lots)
+                    ],
+                }],
+            }],
+        }
+
+    def library(self) -> dict:
+        return {
+            "documents": [
+                {
+                    "id": f"DOC{index:05d}",
+                    "date": f"{2015 + index % 10}-03-{index % 28 + 1:02d}"
+                    "T00:00:00",
+                    "description": f"Statement {index}/{2015 + index % 10}",
+                }
+                for index in range(self.documents)
+            ],
+        }
+
+    def document(self, document_id: str) -> bytes:
+        header = b"%PDF-1.4\n% " + document_id.encode() + b"\n"
+        return header + b"0" * max(0, self.document_size - len(header))
+
+    # Request handling
+
+    def dispatch(self, request: BaseHTTPRequestHandler, method: str) -> None:
+        if self.latency:
+            time.sleep(self.latency)
+        parts = urlsplit(request.path)
+        query = parse_qs(parts.query, keep_blank_values=True)
+        length = int(request.headers.get("Content-Length") or 0)
+        body = request.rfile.read(length) if length else b""
+        key = parts.path + ("?login" if "login" in query else "")
+        with self.lock:
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+        session_id, new = self.session_id(request)
+        session = self.sessions[session_id]
+        cookie = session_id if new else None
+
+        if parts.path == "/EquatePlusParticipant2/" and "login" in query:
+            self.login(request, method, query, body, session, cookie)
+        elif parts.path == "/EquatePlusParticipant2/":
+            self.respond(request, HOME_PAGE.format(csrf2=self.csrf2), cookie)
+        elif parts.path.startswith("/EquatePlusParticipant2/services/"):
+            name = parts.path.split("/services/", 1)[1]
+            self.service(request, method, name, query, body, session)
+        else:
+            self.respond(request, "not found", cookie, status=404)
+
+    def session_id(self, request: BaseHTTPRequestHandler) -> tuple[str, bool]:
+        # Session id from the cookie, or a new one that still has to be set
+        for part in (request.headers.get("Cookie") or "").split(";"):
+            name, _, value = part.strip().partition("=")
+            if name == "JSESSIONID" and value in self.sessions:
+                return value, False
+        session_id = token_hex(8)
+        with self.lock:
+            self.sessions[session_id] = {"polls": 0}
+        return session_id, True
+
+    def login(self, request, method, query, body, session, cookie) -> None:
+        form = {
+            key: values[0]
+            for key, values in parse_qs(body.decode()).items()
+        }
+        if "o.dispatchTargetId.v" in query:
+            self.respond_json(request, {
+                "sessionId": "FIDO-" + token_hex(4),
+                "dispatcherInformation": {
+                    "response": b64encode(QR_PNG).decode().rstrip("="),
+                },
+            }, cookie)
+        elif "o.fidoUafSessionId.v" in query:
+            session["polls"] += 1
+            status = (
+                "succeeded"
+                if session["polls"] > self.pending_polls
+                else "pending"
+            )
+            if status == "succeeded":
+                session["confirmed"] = True
+            self.respond_json(request, {"status": status}, cookie)
+        elif method == "GET":
+            self.respond(request, LOGIN_PAGE.format(csrf=self.csrf), cookie)
+        elif form.get("result") == "Continue Login":
+            self.respond(request, PASSWORD_PAGE.format(csrf=self.csrf), cookie)
+        elif form.get("isiwebpasswd") == "null":
+            self.respond_json(request, {
+                "dispatchTargets": [{"id": "DEVICE1", "name": "Phone"}],
+            }, cookie)
+        elif form.get("result") == "Continue" and "isiwebpasswd" in form:
+            username = form.get("isiwebuserid")
+            passwords = {self.username: self.password, **self.otp_accounts}
+            if (
+                username not in passwords
+                or form.get("isiwebpasswd") != passwords[username]
+            ):
+                self.respond(
+                    request,
+                    LOGIN_PAGE.format(csrf=self.csrf),
+                    cookie,
+                )
+            elif self.otp or username in self.otp_accounts:
+                self.respond(request, OTP_PAGE.format(csrf=self.csrf), cookie)
+            else:
+                self.respond(
+                    request,
+                    EQUATEACCESS_PAGE.format(csrf=self.csrf),
+                    cookie,
+                )
+        elif form.get("result") == "verify":
+            if form.get("otpCode") == self.otp_code:
+                session["confirmed"] = True
+                self.respond(request, "<html>verified</html>", cookie)
+            else:
+                self.respond(request, OTP_PAGE.format(csrf=self.csrf), cookie)
+        elif form.get("result") == "Continue" and session.get("confirmed"):
+            session["authenticated"] = True
+            self.respond(request, HOME_PAGE.format(csrf2=self.csrf2), cookie)
+        else:
+            self.respond(request, LOGIN_PAGE.format(csrf=self.csrf), cookie)
+
+    def service(self, request, method, name, query, body, session) -> None:
+        authorized = (
+            session.get("authenticated")
+            and request.headers.get("csrfpId") == self.csrf
+        )
+        with self.lock:
+            failures = self.failures.get(name)
+            failure = failures.pop(0) if failures else None
+        if failure is not None:
+            status, headers = failure
+            self.respond(request, "", None, status=status, headers=headers)
+        elif name == "participant/logout":
+            session.clear()
+            session["polls"] = 0
+            self.respond(request, "", None)
+        elif not authorized:
+            self.respond(request, LOGIN_PAGE.format(csrf=self.csrf), None)
+        elif name == "planSummary/get" and method not in self.summary_methods:
+            self.respond(request, "method not allowed", None, status=405)
+        elif name == "planSummary/get":
+            self.respond_json(request, {
+                "entries": [{"id": plan_id} for plan_id in self.plan_ids()],
+                "empty": self.plans == 0,
+            }, None)
+        elif name == "planDetails/get":
+            plan_id = json.loads(body or b"{}").get("id", "")
+            if plan_id not in self.plan_ids():
+                self.respond_json(request, {"$type": "TechnicalError"}, None)
+            else:
+                self.respond_json(request, self.plan_details(plan_id), None)
+        elif name == "user/get":
+            self.respond_json(request, {"companyId": "ACME"}, None)
+        elif name == "documents/library":
+            self.respond_json(request, self.library(), None)
+        elif name == "statements/download":
+            document_id = query["documentId"][0]
+            if document_id[3:].isdigit() and int(document_id[3:]) < self.documents:
+                self.download(request, document_id)
+            else:
+                # Compact like the error bodies EquatePlus sends instead
+                self.respond(
+                    request,
+                    '{"$type":"TechnicalError","message":"not found"}',
+                    None,
+                    content_type="application/json;charset=UTF-8",
+                )
+        else:
+            self.respond(request, "not found", None, status=404)
+
+    def download(self, request, document_id: str) -> None:
+        content = self.document(document_id)
+        status = 200
+        etag = f'"{sha256(content).hexdigest()[:16]}"'
+        headers = {"Accept-Ranges": "bytes", "ETag": etag}
+        ranges = request.headers.get("Range", "")
+        if ranges:
+            with self.lock:
+                self.ranges.append(ranges)
+        if request.headers.get("If-Range", etag) != etag:
+            # Changed since the part was downloaded: the whole document
+            ranges = ""
+        with self.lock:
+            interrupted = self.interrupted_downloads > 0
+            self.interrupted_downloads -= interrupted
+        if interrupted:
+            request.send_response(200)
+            request.send_header("Content-Type", "application/pdf")
+            request.send_header("Content-Length", str(len(content)))
+            request.send_header("ETag", etag)
+            request.end_headers()
+            request.wfile.write(content[:len(content) // 2])
+            request.close_connection = True
+            return
+        if ranges.startswith("bytes=") and ranges.endswith("-"):
+            start = int(ranges[6:-1])
+            with self.lock:
+                if self.misaligned_ranges > 0:
+                    self.misaligned_ranges -= 1
+                    start = 0
+            headers["Content-Range"] = (
+                f"bytes {start}-{len(content) - 1}/{len(content)}"
+            )
+            content = content[start:]
+            status = 206
+        self.respond(
+            request,
+            content,
+            None,
+            status=status,
+            content_type="application/pdf",
+            headers=headers,
+        )
+
+    def respond_json(self, request, data: dict, cookie: str | None) -> None:
+        self.respond(
+            request,
+            json.dumps(data),
+            cookie,
+            content_type="application/json;charset=UTF-8",
+        )
+
+    def respond(
+        self,
+        request: BaseHTTPRequestHandler,
+        content: str | bytes,
+        cookie: str | None,
+        status: int = 200,
+        content_type: str = "text/html;charset=UTF-8",
+        headers: dict[str, str] | None = None,
+    ) -> None:
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        request.send_response(status)
+        request.send_header("Content-Type", content_type)
+        request.send_header("Content-Length", str(len(content)))
+        if cookie is not None:
+            request.send_header("Set-Cookie", f"JSESSIONID={cookie}; Path=/")
+        for name, value in (headers or {}).items():
+            request.send_header(name, value)
+        request.end_headers()
+        request.wfile.write(content)
@@ -0,0 +1,864 @@
+"""End-to-end tests of equateplus.py against the local stand-in server."""
+import json
+import os
+import re
+import socket
+import sys
+import threading
+import time
+import zlib
+from pathlib import Path
+
+import click
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import equateplus as module  # noqa: E402
+from equateplus import (  # noqa: E402
+    Cassette,
+    PLAN_DETAILS_ERRORS,
+    RequestScheduler,
+    Daemon,
+    DocumentIndex,
+    EquatePlus,
+    LotTable,
+    ResponseCache,
+    SnapshotStore,
+    iter_plan_lots,
+    read_accounts,
+    send_command,
+    slices,
+    stream_plan_lots,
+    sync_account,
+)
+from standin import OTP_PAGE, StandIn  # noqa: E402
+
+
+@pytest.fixture
+def standin():
+    with StandIn(pending_polls=0) as server:
+        yield server
+
+
+def make_client(standin: StandIn, tmp_path: Path, **kwargs) -> EquatePlus:
+    tmp_path.mkdir(parents=True, exist_ok=True)
+    equateplus = EquatePlus(
+        username=standin.username,
+        password=standin.password,
+        qr_code_path=tmp_path / "qr.png",
+        **kwargs,
+    )
+    equateplus.host = standin.url
+    equateplus.hosts = [standin.url]
+    equateplus.documents_dir = tmp_path / "documents"
+    return equateplus
+
+
+def test_qr_login_and_full_sync(standin, tmp_path):
+    equateplus = make_client(standin, tmp_path)
+
+    assert equateplus.login()
+    assert equateplus.qr_code_path.read_bytes().startswith(b"\x89PNG")
+    assert equateplus.get_plan_summary()
+    assert equateplus.plan_ids == standin.plan_ids()
+    assert equateplus.get_plan_details()
+    assert equateplus.securities == {"Security 0": 20.0, "Security 1": 10.0}
+    assert equateplus.get_documents()
+    assert len(list(equateplus.documents_dir.glob("*.pdf"))) == 5
+
+
+def test_qr_approval_is_polled_with_backoff(tmp_path):
+    with StandIn(pending_polls=2) as standin:
+        equateplus = make_client(standin, tmp_path)
+        statuses = []
+        equateplus.progress = lambda event, **details: (
+            statuses.append(details["status"]) if event == "qr_poll" else None
+        )
+        start = time.perf_counter()
+        assert equateplus.login()
+        elapsed = time.perf_counter() - start
+
+    gauges = equateplus.tracer.gauges
+    assert gauges["qr_polls"] == 3
+    assert statuses[-1] == "succeeded" and len(statuses) == 3
+    # Three backed off delays of about 0.5, 0.75 and 1.1 seconds
+    assert 1.5 < gauges["qr_time_to_approval_seconds"] <= elapsed
+
+
+def test_qr_login_gives_up_at_the_deadline(tmp_path):
+    with StandIn(pending_polls=1000) as standin:
+        equateplus = make_client(standin, tmp_path, qr_timeout=2.0)
+        start = time.perf_counter()
+        assert not equateplus.login()
+        elapsed = time.perf_counter() - start
+
+    gauges = equateplus.tracer.gauges
+    assert 2.0 <= elapsed < 3.0
+    # Polled after about 0.5, 1.25 and the remaining 0.75 seconds
+    assert 2 <= gauges["qr_polls"] <= 4
+    assert "qr_time_to_approval_seconds" not in gauges
+
+
+PROMETHEUS_SAMPLE = re.compile(r"^(\w+)(?:\{(.*)\})? (\S+)$")
+
+
+def test_trace_groups_spans_by_step_and_exports(tmp_path):
+    with StandIn(pending_polls=1) as standin:
+        equateplus = make_client(standin, tmp_path)
+        assert equateplus.login()
+        assert equateplus.get_plan_summary()
+    tracer = equateplus.tracer
+
+    steps = {}
+    for span in tracer.spans:
+        steps.setdefault(span.step, []).append(span.endpoint)
+    assert list(steps) == [name for name, _ in tracer.steps]
+    assert len(steps["verify_qr_code"]) == 2
+    assert steps["get_plan_summary"] == [
+        "/EquatePlusParticipant2/services/planSummary/get",
+    ]
+
+    tracer.export(tmp_path / "trace.json")
+    trace = json.loads((tmp_path / "trace.json").read_text())
+    assert len(trace["spans"]) == len(tracer.spans)
+    assert trace["spans"][0]["step"] == "initialize"
+    assert trace["gauges"]["qr_polls"] == 2
+
+    tracer.export(tmp_path / "trace.prom")
+    samples = {}
+    for line in (tmp_path / "trace.prom").read_text().splitlines():
+        if line.startswith("#"):
+            continue
+        name, labels, value = PROMETHEUS_SAMPLE.match(line).groups()
+        samples[name, labels] = float(value)
+    assert samples[
+        "equateplus_requests_total",
+        'step="verify_qr_code",method="GET",'
+        'endpoint="/EquatePlusParticipant2/?login",status="200"',
+    ] == 2
+    assert samples[
+        "equateplus_step_seconds_total",
+        'step="complete_login"',
+    ] > 0
+    assert samples["equateplus_qr_polls", None] == 2
+
+
+def test_sms_otp_login(tmp_path):
+    with StandIn(otp=True) as standin:
+        equateplus = make_client(standin, tmp_path)
+        codes = iter(["000000", standin.otp_code])
+        equateplus.otp_prompt = lambda: next(codes)
+
+        assert equateplus.login()
+        assert equateplus.skip_equateaccess
+        assert equateplus.get_plan_summary()
+
+
+def test_otp_page_mentioning_the_app_is_not_taken_for_qr(
+    tmp_path,
+    monkeypatch,
+):
+    monkeypatch.setattr(
+        "standin.OTP_PAGE",
+        OTP_PAGE.replace(
+            "</form>",
+            "<p>No SMS? Use the EquateAccess app</p></form>",
+        ),
+    )
+    with StandIn(otp=True) as standin:
+        equateplus = make_client(standin, tmp_path)
+        # EquateAccess worked last time on this host
+        equateplus.state = {
+            "strategies": {standin.url: {"auth": "equateaccess"}},
+        }
+        equateplus.otp_prompt = lambda: standin.otp_code
+
+        assert equateplus.login()
+        assert equateplus.skip_equateaccess
+        assert equateplus.strategy("auth") == "otp"
+        assert equateplus.tracer.counters["strategy_misses"] == 1
+
+
+def test_sync_account_reports_without_printing(standin, tmp_path, capsys):
+    equateplus = make_client(standin, tmp_path)
+    events = []
+    equateplus.progress = lambda event, **details: events.append(
+        (event, details)
+    )
+
+    result = sync_account(equateplus, download_documents=True)
+
+    assert result.error is None
+    assert result.logged_in and not result.cached
+    assert result.securities == {"Security 0": 20.0, "Security 1": 10.0}
+    assert sorted(result.plan_timings) == sorted(standin.plan_ids())
+    assert len(result.documents) == 5
+    assert all(document.ok for document in result.documents)
+    assert "send_credentials" in result.timings
+    assert json.loads(json.dumps(result.to_dict()))["username"] == (
+        standin.username
+    )
+    names = [details["name"] for event, details in events if event == "step"]
+    assert names[-1] == "logout"
+    assert sum(event == "document" for event, _ in events) == 5
+    assert capsys.readouterr().out == ""
+
+
+def test_sync_account_without_otp_prompt_fails_login(tmp_path):
+    with StandIn(otp=True) as standin:
+        equateplus = make_client(standin, tmp_path)
+
+        result = sync_account(equateplus)
+
+        assert not result.logged_in
+        assert result.positions == []
+        assert result.error is None
+
+
+def test_plan_details_do_not_depend_on_parallelism(standin, tmp_path):
+    results = []
+    for max_parallel in (1, 8):
+        equateplus = make_client(standin, tmp_path, max_parallel=max_parallel)
+        assert equateplus.login()
+        assert equateplus.get_plan_summary()
+        assert equateplus.get_plan_details()
+        results.append(equateplus.securities)
+    assert results[0] == results[1]
+
+
+def test_unchanged_documents_are_not_downloaded_again(standin, tmp_path):
+    equateplus = make_client(standin, tmp_path)
+    assert equateplus.login()
+    assert equateplus.get_documents()
+
+    truncated = next(equateplus.documents_dir.glob("*.pdf"))
+    truncated.write_bytes(b"%PDF")
+    downloads = standin.requests[
+        "/EquatePlusParticipant2/services/statements/download"
+    ]
+    equateplus.document_results.clear()
+    assert equateplus.get_documents()
+
+    attempts = [result[2] for result in equateplus.document_results.values()]
+    assert sorted(attempts) == [0, 0, 0, 0, 1]
+    assert standin.requests[
+        "/EquatePlusParticipant2/services/statements/download"
+    ] == downloads + 1
+    assert truncated.stat().st_size == standin.document_size
+
+
+class ReissuingStandIn(StandIn):
+    """Reissues DOC00000 as DOC00002, DOC00001 shares its name and date."""
+
+    def library(self) -> dict:
+        library = super().library()
+        first, second = library["documents"][:2]
+        second.update(date=first["date"], description=first["description"])
+        return library
+
+    def document(self, document_id: str) -> bytes:
+        return super().document(document_id.replace("DOC00002", "DOC00000"))
+
+
+def test_document_store_deduplicates_content(tmp_path):
+    with ReissuingStandIn(documents=3, pending_polls=0) as standin:
+        equateplus = make_client(standin, tmp_path)
+        assert equateplus.login()
+        assert equateplus.get_documents()
+        store = equateplus.document_store
+        documents_dir = equateplus.documents_dir
+
+        assert store.written == 2
+        assert store.deduplicated == 1
+        assert sorted(path.name for path in documents_dir.glob("*.pdf")) == [
+            "Statement 0-2015 (01.03.2015) [DOC00000].pdf",
+            "Statement 0-2015 (01.03.2015) [DOC00001].pdf",
+            "Statement 2-2017 (03.03.2017).pdf",
+        ]
+        objects = sorted(store.objects.glob("[0-9a-f]*"))
+        assert len(objects) == 2
+        modified = [path.stat().st_mtime_ns for path in objects]
+
+        # Downloaded again, but known content is not written again
+        (documents_dir / "manifest.json").unlink()
+        assert equateplus.get_documents()
+        assert equateplus.document_store.written == 0
+        assert [path.stat().st_mtime_ns for path in objects] == modified
+
+    assert store.verify() == []
+    objects[0].write_bytes(b"%PDF")
+    assert store.verify() == [objects[0].name]
+
+
+def test_compressed_documents_are_only_in_the_manifest(standin, tmp_path):
+    equateplus = make_client(standin, tmp_path, compress_documents=True)
+    assert equateplus.login()
+    assert equateplus.get_documents()
+
+    store = equateplus.document_store
+    assert not list(equateplus.documents_dir.glob("*.pdf"))
+    manifest = json.loads(
+        (equateplus.documents_dir / "manifest.json").read_text()
+    )
+    with store.open(manifest["DOC00003"]["sha256"]) as file:
+        assert file.read() == standin.document("DOC00003")
+    assert store.verify() == []
+
+    downloads = standin.requests[
+        "/EquatePlusParticipant2/services/statements/download"
+    ]
+    assert equateplus.get_documents()
+    assert standin.requests[
+        "/EquatePlusParticipant2/services/statements/download"
+    ] == downloads
+
+
+class TextStandIn(StandIn):
+    """Statements with a Flate compressed text object."""
+
+    def document(self, document_id: str) -> bytes:
+        index = int(document_id[3:])
+        kind = "Vesting" if index % 2 == 0 else "Trade"
+        content = zlib.compress(
+            f"BT /F1 12 Tf ({kind} confirmation) Tj "
+            f"[(Plan) -250 (\\(PLAN{index % 3:03d}\\))] TJ ET".encode()
+        )
+        return (
+            b"%PDF-1.4\n1 0 obj\n<< /Filter /FlateDecode >>\nstream\n"
+            + content
+            + b"\nendstream\nendobj\n%%EOF\n"
+        )
+
+
+def test_new_documents_are_indexed_for_search(tmp_path, monkeypatch):
+    monkeypatch.setattr(module, "pypdf", None)
+    index = DocumentIndex(tmp_path / "index.sqlite")
+    with TextStandIn(documents=12, pending_polls=0) as standin:
+        equateplus = make_client(standin, tmp_path, document_index=index)
+        assert equateplus.login()
+        assert equateplus.get_documents()
+        assert index.indexed_count == 12
+        assert index.without_text == []
+
+        assert equateplus.get_documents()
+        assert index.indexed_count == 12
+
+    # 2015 + index % 10: DOC00000 and DOC00010 are from 2015
+    matches = index.search("vesting AND PLAN001", year=2015)
+    assert [match[0] for match in matches] == ["DOC00010"]
+    assert matches[0][2] == "Statement 10/2015"
+    assert "[Vesting] confirmation" in matches[0][3]
+    assert len(index.search("trade")) == 6
+    assert len(index.search("description:statement", year=2016)) == 2
+
+
+def test_documents_without_text_are_reported(standin, tmp_path, monkeypatch):
+    monkeypatch.setattr(module, "pypdf", None)
+    index = DocumentIndex(tmp_path / "index.sqlite")
+    equateplus = make_client(standin, tmp_path, document_index=index)
+    assert equateplus.login()
+    assert equateplus.get_documents()
+
+    assert index.indexed_count == 5
+    assert sorted(index.without_text) == [
+        f"DOC{number:05d}" for number in range(5)
+    ]
+    assert len(index.search("description:statement")) == 5
+
+
+def test_interrupted_download_is_resumed(tmp_path):
+    size = 8 * module.DOWNLOAD_CHUNK_SIZE
+    with StandIn(documents=1, document_size=size, pending_polls=0) as standin:
+        standin.interrupted_downloads = 1
+        equateplus = make_client(standin, tmp_path)
+        assert equateplus.login()
+        assert equateplus.get_documents()
+
+    (file_path, ok, attempts), = equateplus.document_results.values()
+    assert ok and attempts == 2
+    # Only the chunk being read when the transfer broke off is lost
+    range_header, = standin.ranges
+    assert 0 < int(range_header[6:-1]) <= size // 2
+    assert file_path.read_bytes() == standin.document("DOC00000")
+    assert not list(tmp_path.glob("**/*.part*"))
+
+
+def test_misaligned_range_is_not_stored(tmp_path):
+    size = 8 * module.DOWNLOAD_CHUNK_SIZE
+    with StandIn(documents=1, document_size=size, pending_polls=0) as standin:
+        standin.interrupted_downloads = 1
+        standin.misaligned_ranges = 1
+        equateplus = make_client(standin, tmp_path)
+        assert equateplus.login()
+        assert equateplus.get_documents()
+
+    # The 206 from offset 0 fails and drops the part, the next is whole
+    (file_path, ok, attempts), = equateplus.document_results.values()
+    assert ok and attempts == 3
+    assert len(standin.ranges) == 1
+    assert file_path.read_bytes() == standin.document("DOC00000")
+    assert not list(tmp_path.glob("**/*.part*"))
+
+
+class ReissuedDuringDownload(StandIn):
+    """Reissues each document after an interrupted transfer of it."""
+
+    version = 0
+
+    def document(self, document_id: str) -> bytes:
+        content = bytearray(super().document(document_id))
+        content[16] = ord("0") + self.version
+        return bytes(content)
+
+    def download(self, request, document_id: str) -> None:
+        interrupted = self.interrupted_downloads > 0
+        super().download(request, document_id)
+        self.version += interrupted
+
+
+def test_reissued_document_is_not_spliced(tmp_path):
+    size = 8 * module.DOWNLOAD_CHUNK_SIZE
+    with ReissuedDuringDownload(
+        documents=1,
+        document_size=size,
+        pending_polls=0,
+    ) as standin:
+        standin.interrupted_downloads = 1
+        equateplus = make_client(standin, tmp_path)
+        assert equateplus.login()
+        assert equateplus.get_documents()
+
+    # The part of the old version is resumed only if it is still current
+    (file_path, ok, attempts), = equateplus.document_results.values()
+    assert ok and attempts == 2
+    assert len(standin.ranges) == 1
+    assert file_path.read_bytes() == standin.document("DOC00000")
+    assert standin.version == 1
+
+
+def test_technical_error_leaves_no_part(standin, tmp_path):
+    equateplus = make_client(standin, tmp_path)
+    assert equateplus.login()
+    file_path = tmp_path / "missing.pdf"
+
+    assert not equateplus.download_document("DOC99999", file_path)
+    assert not file_path.exists()
+    assert not file_path.with_name("missing.pdf.part").exists()
+
+
+def test_restored_session_needs_no_login(standin, tmp_path):
+    equateplus = make_client(standin, tmp_path)
+    assert equateplus.login()
+    equateplus.save_session(tmp_path / "session.json")
+
+    restored = make_client(standin, tmp_path)
+    assert restored.restore_session(tmp_path / "session.json")
+    assert restored.get_plan_summary()
+    assert not restored.session_expired
+
+    equateplus.logout()
+    assert not restored.get_plan_summary()
+    assert restored.session_expired
+
+
+def test_tokens_are_not_scanned_in_documents(standin, tmp_path):
+    equateplus = make_client(standin, tmp_path)
+    assert equateplus.login()
+    counters = dict(equateplus.tracer.counters)
+    assert equateplus.get_documents()
+    # Only the library listing may be scanned, it carries no tokens
+    assert equateplus.tracer.counters == counters
+
+
+def test_replay_runs_without_server(tmp_path):
+    with StandIn(pending_polls=0) as standin:
+        cassette = Cassette(tmp_path / "cassette")
+        recorded = make_client(standin, tmp_path / "recorded")
+        recorded.session.hooks["response"].append(cassette.record)
+        assert recorded.login()
+        assert recorded.get_plan_summary()
+        assert recorded.get_plan_details()
+        assert recorded.get_documents()
+        cassette.save()
+
+    saved = (tmp_path / "cassette" / "cassette.json").read_text()
+    assert standin.csrf not in saved
+    assert standin.password not in saved
+
+    replayed = make_client(standin, tmp_path / "replayed")
+    Cassette.load(tmp_path / "cassette").mount(replayed.session)
+    assert replayed.login()
+    assert replayed.get_plan_summary()
+    assert replayed.get_plan_details()
+    assert replayed.get_documents()
+    assert replayed.securities == recorded.securities
+    for path in (tmp_path / "recorded" / "documents").glob("*.pdf"):
+        copy = tmp_path / "replayed" / "documents" / path.name
+        assert copy.read_bytes() == path.read_bytes()
+
+
+def test_warm_cache_serves_without_server(standin, tmp_path):
+    cache = ResponseCache(tmp_path / "cache")
+    equateplus = make_client(standin, tmp_path, cache=cache)
+    assert equateplus.login()
+    assert equateplus.get_plan_summary()
+    assert equateplus.get_plan_details()
+
+    requests = dict(standin.requests)
+    cached = make_client(standin, tmp_path, cache=cache)
+    assert cached.get_plan_summary(offline=True)
+    assert cached.get_plan_details(offline=True)
+    assert cached.securities == equateplus.securities
+    assert standin.requests == requests
+
+    refreshed = make_client(standin, tmp_path, cache=cache, refresh=True)
+    assert not refreshed.get_plan_summary(offline=True)
+    assert standin.requests == requests
+
+
+def test_lot_table_aggregations(standin, tmp_path):
+    equateplus = make_client(standin, tmp_path)
+    assert equateplus.login()
+    assert equateplus.get_plan_summary()
+    assert equateplus.get_plan_details()
+
+    lots = equateplus.lots
+    assert len(lots) == standin.plans * standin.lots
+    assert lots.quantities() == equateplus.securities
+    # Quantities 1..4 bought at 10..13
+    assert lots.average_purchase_prices() == {
+        "Security 0": 12.0,
+        "Security 1": 12.0,
+    }
+    assert lots.values_by_plan() == {
+        plan_id: 10.0 * 42.5 for plan_id in standin.plan_ids()
+    }
+    row = next(lots.rows())
+    assert row["date"] == "2020-01-15"
+    assert row["market"] == "XETRA"
+
+
+def test_streamed_lots_match_parsed_lots(standin):
+    data = standin.plan_details("PLAN001")
+    # Market fields after the lots, as the streaming parser sees them last
+    container = data["entries"][0]["entries"][0]
+    container["marketPrice"] = container.pop("marketPrice")
+    container["marketName"] = container.pop("marketName")
+    content = json.dumps(data).encode()
+
+    parsed, streamed = LotTable(), LotTable()
+    parsed.add_lots("PLAN001", iter_plan_lots(data))
+    streamed.add_lots("PLAN001", stream_plan_lots(slices(content, 7)))
+    assert list(streamed.rows()) == list(parsed.rows())
+
+    with pytest.raises(KeyError):
+        LotTable().add_lots("", stream_plan_lots([b'{"$type": "X"}']))
+
+
+def test_plan_details_without_ijson(standin, tmp_path, monkeypatch):
+    monkeypatch.setattr(module, "ijson", None)
+    equateplus = make_client(standin, tmp_path)
+    assert equateplus.login()
+    assert equateplus.get_plan_summary()
+    assert equateplus.get_plan_details()
+    assert equateplus.securities == {"Security 0": 20.0, "Security 1": 10.0}
+
+
+def test_snapshot_store_deduplicates_and_answers_queries(standin, tmp_path):
+    equateplus = make_client(standin, tmp_path)
+    assert equateplus.login()
+    assert equateplus.get_plan_summary()
+    assert equateplus.get_plan_details()
+
+    history = SnapshotStore(tmp_path / "history.sqlite")
+    first = history.record("user", equateplus.lots, taken=100.0)
+    assert history.changes("user") == {
+        "Security 0": (0.0, 20.0),
+        "Security 1": (0.0, 10.0),
+    }
+    assert history.record("user", equateplus.lots, taken=200.0) == first
+    assert history.changes("user") == {}
+
+    fewer = LotTable()
+    fewer.add_plan("PLAN000", standin.plan_details("PLAN000"))
+    history.record("user", fewer, taken=300.0)
+    assert history.changes("user") == {
+        "Security 0": (20.0, 10.0),
+        "Security 1": (10.0, 0.0),
+    }
+    assert history.holdings("user", as_of=250.0) == equateplus.securities
+    assert history.holdings("user") == {"Security 0": 10.0}
+    assert history.holdings("other") == {}
+    assert history.series("user", "Security 1") == [
+        (100.0, 10.0),
+        (300.0, 0.0),
+    ]
+
+
+def test_daemon_syncs_on_request_and_logs_in_again(standin, tmp_path):
+    equateplus = make_client(standin, tmp_path)
+    socket_path = tmp_path / "daemon.sock"
+    daemon = Daemon(equateplus, keepalive=3600.0, socket_path=socket_path)
+    thread = threading.Thread(target=daemon.run)
+    thread.start()
+    assert daemon.ready.wait(timeout=10)
+    try:
+        report = send_command(socket_path, "sync")
+        assert report["ok"] and not report["relogin"]
+        assert report["securities"] == {"Security 0": 20.0, "Security 1": 10.0}
+        assert daemon.ping()
+
+        # Server side session loss shows up as the login page
+        standin.sessions.clear()
+        report = send_command(socket_path, "sync")
+        assert report["ok"] and report["relogin"]
+        assert send_command(socket_path, "status")["logins"] == 2
+    finally:
+        send_command(socket_path, "stop")
+        thread.join(timeout=10)
+    assert not thread.is_alive()
+    assert not socket_path.exists()
+
+
+def test_daemon_logs_in_with_sms_code_from_cli(tmp_path, monkeypatch, capsys):
+    with StandIn(otp=True) as standin:
+        equateplus = make_client(standin, tmp_path)
+        monkeypatch.setattr(module, "prompt_otp", lambda: standin.otp_code)
+        module.attach_cli(equateplus)
+        daemon = Daemon(equateplus)
+
+        report = daemon.sync()
+
+        assert report["ok"]
+        assert report["securities"] == {"Security 0": 20.0, "Security 1": 10.0}
+        assert equateplus.skip_equateaccess
+        assert "send_credentials -> True" in capsys.readouterr().out
+
+
+def test_failover_pins_healthy_host_and_remembers_it(standin, tmp_path):
+    with StandIn(pending_polls=0) as other:
+        # A closed port refuses connections like a datacenter that is down
+        with socket.socket() as closed:
+            closed.bind(("127.0.0.1", 0))
+            down_url = f"http://127.0.0.1:{closed.getsockname()[1]}"
+
+        state_path = tmp_path / "state.json"
+        equateplus = make_client(standin, tmp_path, state_path=state_path)
+        equateplus.hosts = [down_url, standin.url, other.url]
+        assert equateplus.select_host() in (standin.url, other.url)
+        equateplus.host = down_url
+        assert equateplus.login()
+        assert equateplus.host in (standin.url, other.url)
+        assert equateplus.tracer.counters["host_failover"] == 1
+        assert equateplus.get_plan_summary()
+
+        restarted = make_client(standin, tmp_path, state_path=state_path)
+        restarted.hosts = [down_url, standin.url, other.url]
+        probes = standin.requests.get("/EquatePlusParticipant2/?login", 0)
+        assert restarted.select_host() == equateplus.host
+        assert standin.requests.get(
+            "/EquatePlusParticipant2/?login", 0
+        ) == probes
+
+
+def test_saved_session_is_private(standin, tmp_path):
+    equateplus = make_client(standin, tmp_path)
+    assert equateplus.login()
+    session_path = tmp_path / "session.json"
+    session_path.write_text("{}")
+    session_path.chmod(0o644)
+    equateplus.save_session(session_path)
+    assert session_path.stat().st_mode & 0o777 == 0o600
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_daemon_socket_is_private_from_bind(standin, tmp_path, monkeypatch):
+    modes = []
+
+    class Server(module.socketserver.ThreadingUnixStreamServer):
+        def server_bind(self) -> None:
+            super().server_bind()
+            modes.append(Path(self.server_address).stat().st_mode & 0o777)
+
+    monkeypatch.setattr(
+        module.socketserver,
+        "ThreadingUnixStreamServer",
+        Server,
+    )
+    previous = os.umask(0o022)
+    try:
+        daemon = Daemon(
+            make_client(standin, tmp_path),
+            socket_path=tmp_path / "daemon.sock",
+        )
+        server = daemon.serve_socket()
+    finally:
+        os.umask(previous)
+    server.shutdown()
+    server.server_close()
+
+    assert modes == [0o600]
+
+
+def test_batch_serves_prompts_and_keeps_accounts_apart(
+    tmp_path,
+    monkeypatch,
+    capsys,
+):
+    monkeypatch.chdir(tmp_path)
+    prompts = []
+
+    def prompt(text, **_kwargs):
+        prompts.append(text)
+        return standin.otp_code
+
+    monkeypatch.setattr(module.click, "prompt", prompt)
+    with StandIn(pending_polls=1, otp_accounts={"sms": "code"}) as standin:
+        results = module.run_batch(
+            [(standin.username, standin.password), ("sms", "code")],
+            tmp_path / "qr.png",
+            workers=2,
+            download_documents=True,
+            hosts=(standin.url,),
+        )
+
+    assert [result.username for result in results] == [standin.username, "sms"]
+    assert all(result.logged_in and result.error is None for result in results)
+    assert all(
+        result.securities == {"Security 0": 20.0, "Security 1": 10.0}
+        for result in results
+    )
+    # The SMS code was asked for on the main thread, naming the account
+    assert prompts == ["Please enter the SMS code for sms"]
+    assert (tmp_path / "qr_1.png").exists()
+    assert not (tmp_path / "qr_2.png").exists()
+    assert f"{standin.username}: scan {tmp_path / 'qr_1.png'}" in (
+        capsys.readouterr().out
+    )
+    for result in results:
+        assert len(result.documents) == 5
+        assert {document.path.parent for document in result.documents} == {
+            module.DOCUMENTS_DIR / result.username,
+        }
+        assert all(document.path.exists() for document in result.documents)
+
+
+def test_read_accounts_rejects_username_without_password(tmp_path):
+    credentials_path = tmp_path / "credentials.txt"
+    credentials_path.write_text("alice\nsecret\n\nbob\n")
+    with pytest.raises(click.ClickException, match="'bob'"):
+        read_accounts(credentials_path)
+    credentials_path.write_text("alice\nsecret\nbob\npassword\n")
+    assert read_accounts(credentials_path) == [
+        ("alice", "secret"),
+        ("bob", "password"),
+    ]
+
+
+@pytest.mark.parametrize("streaming", [True, False])
+def test_plan_details_after_session_loss(
+    standin,
+    tmp_path,
+    monkeypatch,
+    streaming,
+):
+    if not streaming:
+        monkeypatch.setattr(module, "ijson", None)
+    equateplus = make_client(standin, tmp_path)
+    assert equateplus.login()
+    assert equateplus.get_plan_summary()
+    standin.sessions.clear()
+    assert not equateplus.get_plan_details()
+    assert equateplus.session_expired
+
+    with pytest.raises(PLAN_DETAILS_ERRORS):
+        LotTable().add_lots("", module.plan_lots([b'{"entries": [{']))
+
+
+def test_daemon_survives_failed_sync(standin, tmp_path):
+    equateplus = make_client(standin, tmp_path)
+    daemon = Daemon(equateplus)
+    assert daemon.sync()["ok"]
+
+    # The host goes away: the sync fails, but is reported
+    equateplus.host = equateplus.hosts[0] = "http://127.0.0.1:9"
+    report = daemon.sync()
+    assert not report["ok"]
+    assert "ConnectionError" in report["error"]
+    assert not daemon.logged_in
+
+    equateplus.host = equateplus.hosts[0] = standin.url
+    report = daemon.sync()
+    assert report["ok"]
+    assert daemon.logins == 2
+
+
+def test_plan_summary_method_is_learned_per_host(tmp_path):
+    state_path = tmp_path / "state.json"
+    with StandIn(pending_polls=0, summary_methods=("GET",)) as standin:
+        first = make_client(standin, tmp_path, state_path=state_path)
+        assert first.login()
+        assert first.get_plan_summary()
+        assert first.tracer.counters["strategy_misses"] == 2
+
+        path = "/EquatePlusParticipant2/services/planSummary/get"
+        requests = standin.requests[path]
+        second = make_client(standin, tmp_path, state_path=state_path)
+        assert second.login()
+        assert second.get_plan_summary()
+        assert standin.requests[path] == requests + 1
+        assert second.tracer.counters["strategy_hits"] == 2
+        assert "strategy_misses" not in second.tracer.counters
+
+        # The host starts to accept POST only: learned again
+        standin.summary_methods = ("POST",)
+        assert second.get_plan_summary()
+        assert second.strategy("plan_summary") == "POST"
+
+
+def test_transient_failures_are_retried(standin, tmp_path):
+    equateplus = make_client(standin, tmp_path)
+    assert equateplus.login()
+    standin.failures["planSummary/get"] = [
+        (429, {"Retry-After": "0.3"}),
+        (503, {}),
+    ]
+
+    started = time.monotonic()
+    assert equateplus.get_plan_summary()
+    # Retry-After holds back every request to the host
+    assert time.monotonic() - started >= 0.3
+    assert equateplus.plan_ids == standin.plan_ids()
+    assert equateplus.tracer.counters["rate_limited"] == 1
+    assert equateplus.tracer.counters["retries"] == 2
+
+    # A POST not marked idempotent gets the 503
+    standin.failures["planDetails/get"] = [(503, {})]
+    response = equateplus.request(
+        "POST",
+        "services/planDetails/get",
+        json={"$type": "EntityIdentifier", "id": "PLAN000"},
+    )
+    assert response.status_code == 503
+    assert equateplus.tracer.counters["retries"] == 2
+
+
+def test_token_bucket_paces_requests_per_host(standin, tmp_path):
+    scheduler = RequestScheduler(rate=20.0, burst=2)
+    clients = [
+        make_client(standin, tmp_path / str(index), scheduler=scheduler)
+        for index in range(2)
+    ]
+
+    started = time.monotonic()
+    for _ in range(3):
+        for equateplus in clients:
+            equateplus.request("GET", "?login")
+    # 2 at once, then 4 at 20 per second
+    assert time.monotonic() - started >= 0.19
+    assert scheduler.stats()["throttled"] == 4
+    assert scheduler.stats()["queue_depth"] == 0
+    assert sum(
+        equateplus.tracer.counters["throttled"] for equateplus in clients
+    ) == 4
@@ -0,0 +1,83 @@
+"""Tests of equateplus_async.py against the local stand-in server."""
+import asyncio
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from equateplus_async import AsyncEquatePlus  # noqa: E402
+from standin import StandIn  # noqa: E402
+
+
+@pytest.fixture
+def standin():
+    with StandIn(pending_polls=1) as server:
+        yield server
+
+
+def make_client(
+    standin: StandIn,
+    tmp_path: Path,
+    **kwargs,
+) -> AsyncEquatePlus:
+    equateplus = AsyncEquatePlus(
+        username=standin.username,
+        password=standin.password,
+        qr_code_path=tmp_path / "qr.png",
+        **kwargs,
+    )
+    equateplus.host = standin.url
+    equateplus.documents_dir = tmp_path / "documents"
+    return equateplus
+
+
+def test_qr_login_and_full_sync(standin, tmp_path):
+    async def sync() -> AsyncEquatePlus:
+        async with make_client(standin, tmp_path) as equateplus:
+            assert await equateplus.login()
+            assert equateplus.qr_code_path.read_bytes().startswith(b"\x89PNG")
+            assert equateplus.gauges["qr_polls"] == 2
+            assert await equateplus.get_plan_summary()
+            assert await equateplus.get_plan_details()
+            assert await equateplus.get_documents()
+            await equateplus.logout()
+        return equateplus
+
+    equateplus = asyncio.run(sync())
+    assert equateplus.plan_ids == standin.plan_ids()
+    assert equateplus.securities == {"Security 0": 20.0, "Security 1": 10.0}
+    assert len(list(equateplus.documents_dir.glob("*.pdf"))) == 5
+
+
+def test_sms_otp_login(tmp_path):
+    async def login(standin: StandIn) -> bool:
+        codes = iter(["000000", standin.otp_code])
+
+        async def prompt() -> str:
+            return next(codes)
+
+        async with make_client(standin, tmp_path, otp_prompt=prompt) as client:
+            return (
+                await client.login()
+                and client.skip_equateaccess
+                and await client.get_plan_summary()
+            )
+
+    with StandIn(otp=True) as standin:
+        assert asyncio.run(login(standin))
+
+
+def test_plan_details_after_session_loss(tmp_path):
+    async def sync(standin: StandIn) -> AsyncEquatePlus:
+        async with make_client(standin, tmp_path) as equateplus:
+            assert await equateplus.login()
+            assert await equateplus.get_plan_summary()
+            standin.sessions.clear()
+            assert not await equateplus.get_plan_details()
+        return equateplus
+
+    with StandIn(pending_polls=0) as standin:
+        equateplus = asyncio.run(sync(standin))
+    assert equateplus.session_expired
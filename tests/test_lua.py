@@ -0,0 +1,172 @@
+"""Tests of EquatePlus.lua run in lupa against the stand-in fixtures."""
+import random
+
+import pytest
+
+pytest.importorskip("lupa")
+
+from lua_harness import LuaHarness  # noqa: E402
+from standin import HOME_PAGE, LOGIN_PAGE, StandIn  # noqa: E402
+
+
+class LotKeys(StandIn):
+    """One plan whose lots use the alternative quantity/price/date/name keys."""
+
+    def plan_details(self, plan_id: str) -> dict:
+        return {
+            "name": "Fallback Plan",
+            "entries": [{
+                "entries": [{
+                    "marketName": "XETRA",
+                    "marketPrice": {"amount": 42.5},
+                    "canTrade": False,
+                    "entries": [
+                        {
+                            "VEHICLE": "Vehicle",
+                            "VEHICLE_NAME": "Named",
+                            "QUANTITY": {"amount": 1.0},
+                            "LOCKED_QTY": {"amount": 5.0},
+                            "SELL_PURCHASE_PRICE": {"amount": 1.0},
+                            "MARKET_PRICE": {
+                                "amount": 30.0,
+                                "unit": {"code": "USD"},
+                            },
+                            "ALLOC_DATE": {"date": "2019-01-01T00:00:00.000"},
+                            "TRANSACTION_DATE": {
+                                "date": "2021-06-30T00:00:00.000",
+                            },
+                        },
+                        # neither quantity nor price: skipped
+                        {"VEHICLE": "Empty"},
+                        # unusable quantity: reported, the rest still parses
+                        {"VEHICLE": "Broken", "QUANTITY": {"amount": "n/a"}},
+                        {"AVAIL_QTY": {"amount": 2.0}},
+                    ],
+                }],
+            }],
+        }
+
+
+def make_harness(standin: StandIn) -> LuaHarness:
+    standin.server.server_close()
+    return LuaHarness(standin)
+
+
+def test_refresh_account_merges_lots():
+    harness = make_harness(StandIn(plans=3, lots=4))
+
+    securities = harness.refresh_account()
+
+    assert [security["name"] for security in securities] == [
+        "Security 0",
+        "Security 1",
+    ]
+    first = securities[0]
+    # plans 0 and 2, lots of 1..4 shares bought at 10..13
+    assert first["quantity"] == 20.0
+    assert first["purchasePrice"] == pytest.approx(2 * 120.0 / 20.0)
+    assert first["price"] == 42.5
+    assert first["market"] == "XETRA"
+    assert first["currencyOfPrice"] == "EUR"
+    assert harness.requests["planDetails/get"] == 3
+
+
+def test_refresh_account_key_priority():
+    harness = make_harness(LotKeys(plans=1))
+
+    securities = harness.refresh_account()
+
+    named, fallback = securities
+    assert named["name"] == "Named"
+    assert named["quantity"] == 5.0
+    assert named["purchasePrice"] == 30.0
+    assert named["currencyOfPrice"] == "USD"
+    transaction = harness.lua.eval("os.time({year=2021, month=6, day=30})")
+    assert named["tradeTimestamp"] == transaction
+    assert fallback["name"] == "Fallback Plan"
+    assert fallback["quantity"] == 2.0
+    assert "purchasePrice" not in fallback
+    assert "These shares are not tradable: Named" in harness.output
+    assert sum("please report this bug" in line for line in harness.output) == 2
+
+
+def test_fetch_statements_skips_known():
+    harness = make_harness(StandIn(documents=3, document_size=1024))
+
+    statements = harness.statements(known=("DOC00001",))
+
+    assert [statement["identifier"] for statement in statements] == [
+        "DOC00000",
+        "DOC00002",
+    ]
+    assert statements[0]["filename"] == "Statement 0-2015(01.03.2015).pdf"
+    assert statements[0]["head"] == "%PDF-1.4"
+    assert statements[0]["size"] == 1024
+    assert harness.requests["statements/download"] == 2
+
+
+# connectWithCSRF's token scan before it became a single pass
+PATTERN_SCAN = """
+local CSRF_TOKEN, CSRF2_TOKEN
+return function(content)
+  local csrfpIdTemp = string.match(content, '"csrfpId"%s*:%s*"([^"]+)"')
+  if csrfpIdTemp == nil or csrfpIdTemp == '' then
+    csrfpIdTemp = string.match(content, 'csrfRegisterAjax%(%s*"csrfpId"%s*,%s*"([^"]+)"')
+  end
+  if csrfpIdTemp == nil or csrfpIdTemp == '' then
+    csrfpIdTemp = string.match(content, 'csrfModifyLinks%(%s*"csrfpId"%s*,%s*"([^"]+)"')
+  end
+  if csrfpIdTemp ~= nil and csrfpIdTemp ~= '' then
+    CSRF_TOKEN=csrfpIdTemp
+  end
+  local csrf2Temp
+  csrf2Temp = string.match(content, "['\\"]equateCsrfToken2['\\"]%s*:%s*['\\"]([^'\\"]+)['\\"]")
+  if csrf2Temp == nil or csrf2Temp == '' then
+    csrf2Temp = string.match(content, "name=['\\"]EQUATE%-CSRF2%-TOKEN%-PARTICIPANT2['\\"]%s+value=['\\"]([^'\\"]+)['\\"]")
+  end
+  if csrf2Temp ~= nil and csrf2Temp ~= '' then
+    CSRF2_TOKEN = csrf2Temp
+  end
+  return CSRF_TOKEN, CSRF2_TOKEN
+end
+"""
+
+TOKEN_FRAGMENTS = (
+    LOGIN_PAGE.format(csrf="register"),
+    HOME_PAGE.format(csrf2="config"),
+    '{"csrfpId" : "json"}',
+    '{"csrfpId": ""}',
+    'csrfModifyLinks( "csrfpId" ,"links")',
+    'csrfRegisterAjax("other", "x")',
+    "<input name='EQUATE-CSRF2-TOKEN-PARTICIPANT2'  value='input'>",
+    '<input name="EQUATE-CSRF2-TOKEN-PARTICIPANT2"value="none">',
+    "'equateCsrfToken2':'quoted'",
+    "CSRFPID Csrf csrf csrfcsrf",
+    "<p>no tokens here</p>",
+)
+
+
+def test_csrf_scan_matches_pattern_scan():
+    harness = make_harness(StandIn())
+    reference = harness.lua.execute(PATTERN_SCAN)
+    generator = random.Random(1)
+    bodies = list(TOKEN_FRAGMENTS) + [
+        "".join(generator.choices(TOKEN_FRAGMENTS, k=generator.randint(1, 4)))
+        for _ in range(200)
+    ]
+
+    for body in bodies:
+        assert harness.tokens_after(body) == reference(body), body
+
+
+def test_csrf_scan_skips_binary_bodies():
+    harness = make_harness(StandIn())
+    harness.tokens_after(LOGIN_PAGE.format(csrf="login"))
+    pdf = b"%PDF-1.4\n\xff" + LOGIN_PAGE.format(csrf="pdf").encode()
+
+    assert harness.tokens_after(pdf, "application/pdf") == ("login", None)
+    assert harness.tokens_after(
+        LOGIN_PAGE.format(csrf="download"),
+        path="/EquatePlusParticipant2/services/statements/download",
+    ) == ("login", None)
+    assert harness.tokens_after('{"csrfpId":"json"}', None) == ("json", None)